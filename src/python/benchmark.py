@@ -0,0 +1,413 @@
+import argparse
+import json
+import os
+import time
+import platform
+import subprocess
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from generate_data import generate_sample_data
+from predict import load_models, predict_patient_outcomes, predict_batch
+from model_registry import clear_registry_cache, read_manifest
+
+TARGET_COLUMNS = ['mortality', 'mortality_rate', 'length_of_stay']
+
+SCENARIOS = ['generate', 'train', 'load', 'predict', 'batch', 'knn']
+
+MMAP_NOTE = ("mmap loading copies the node arrays of scikit-learn trees (Tree.__setstate__), "
+             "so forest memory is not shared between processes; only load time is compared")
+
+def sample_patients(n_patients, seed=0):
+    """
+    Draw synthetic patients without outcome columns, as sent for prediction
+    
+    Parameters:
+    n_patients (int): Number of patients
+    seed (int): Random seed
+    
+    Returns:
+    list: Patient dictionaries
+    """
+    data = generate_sample_data(n_patients, seed=seed)
+    return data.drop(columns=TARGET_COLUMNS).to_dict(orient='records')
+
+def summarize_ms(seconds):
+    """
+    Summarize a list of durations
+    
+    Parameters:
+    seconds (list): Durations in seconds
+    
+    Returns:
+    dict: Mean, median, p99, min and max in milliseconds
+    """
+    ms = np.asarray(seconds) * 1000
+    return {
+        'mean': float(ms.mean()),
+        'p50': float(np.percentile(ms, 50)),
+        'p99': float(np.percentile(ms, 99)),
+        'min': float(ms.min()),
+        'max': float(ms.max()),
+        'n': int(ms.size)
+    }
+
+def time_call(func, repeats=1):
+    """
+    Time repeated calls of a function
+    
+    Parameters:
+    func (callable): Function called without arguments
+    repeats (int): Number of calls
+    
+    Returns:
+    list: Duration of every call in seconds
+    """
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+def machine_info():
+    """
+    Describe the machine and software the benchmark ran on
+    
+    Returns:
+    dict: Platform, CPU, memory, library versions and git commit
+    """
+    import sklearn
+    import xgboost
+    
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    
+    try:
+        memory_bytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        memory_bytes = None
+    
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'memory_bytes': memory_bytes,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'sklearn': sklearn.__version__,
+        'xgboost': xgboost.__version__,
+        'git_commit': commit
+    }
+
+def ensure_models(model_dir, n_samples=500, mmap_forests=False):
+    """
+    Train and save models into model_dir unless it already holds them
+    
+    A directory with a manifest is reused as is, except that with
+    mmap_forests=True it is retrained when a random forest was saved
+    without its joblib copy, since the registry would otherwise load the
+    pickle and the 'mmap' measurement would repeat the 'pickle' one.
+    
+    Parameters:
+    model_dir (str): Directory for the saved models
+    n_samples (int): Number of synthetic samples to train on
+    mmap_forests (bool): Also save random forests for memory-mapped loading
+    """
+    manifest, _ = read_manifest(model_dir)
+    if manifest is not None:
+        forests = [task_models['random_forest'] for task_models in manifest['models'].values()
+                   if 'random_forest' in task_models]
+        if not mmap_forests or all(entry.get('mmap_path') for entry in forests):
+            return
+        print(f"Random forests in {model_dir} were saved without mmap_forests, retraining")
+    
+    from train_models import train_models, save_models
+    results, _ = train_models(generate_sample_data(n_samples))
+    save_models(results, model_dir, mmap_forests=mmap_forests)
+
+def benchmark_generate(sizes, repeats=1):
+    """
+    Measure generate_sample_data at several dataset sizes
+    
+    Parameters:
+    sizes (list): Numbers of rows to generate
+    repeats (int): Repetitions per size
+    
+    Returns:
+    dict: Per size, latency summary and rows per second
+    """
+    results = {}
+    for n_rows in sizes:
+        durations = time_call(lambda: generate_sample_data(n_rows), repeats)
+        results[str(n_rows)] = {
+            'latency_ms': summarize_ms(durations),
+            'rows_per_second': n_rows / float(np.median(durations))
+        }
+    return results
+
+def benchmark_train(n_samples=500, repeats=1):
+    """
+    Measure the fit (plus evaluation) time of every model of every task
+    
+    Parameters:
+    n_samples (int): Number of synthetic training samples
+    repeats (int): Repetitions per model
+    
+    Returns:
+    dict: Latency summary per task and model, plus the shared preprocessing
+    """
+    from train_models import MODEL_SPECS, prepare_training_data, fit_model
+    
+    data = generate_sample_data(n_samples)
+    results = {'n_samples': n_samples,
+               'prepare_training_data': summarize_ms(time_call(lambda: prepare_training_data(data), repeats))}
+    prepared = prepare_training_data(data)
+    
+    for spec in MODEL_SPECS:
+        durations = time_call(lambda: fit_model(spec, prepared['X_train'], prepared['y_train'][spec['task']],
+                                                prepared['X_test'], prepared['y_test'][spec['task']],
+                                                prepared['feature_names']), repeats)
+        results.setdefault(spec['task'], {})[spec['name']] = summarize_ms(durations)
+    return results
+
+def benchmark_model_loading(model_dir='models', repeats=5, mmap=False):
+    """
+    Measure cold- and warm-start latency of load_models plus a first prediction
+    
+    Cold start clears the in-process registry so every model is read from disk;
+    warm start repeats the call with the registry populated.
+    
+    With mmap=True only the joblib file is memory-mapped: unpickling a
+    scikit-learn tree (Tree.__setstate__) copies its node arrays into
+    private memory, so the loaded forests do not share pages between
+    processes and the comparison measures load time only, see MMAP_NOTE.
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    repeats (int): Number of cold/warm rounds
+    mmap (bool): Memory-map random forests saved with mmap_forests=True
+    
+    Returns:
+    dict: Latency summaries for 'cold' and 'warm'
+    """
+    patient = sample_patients(1)[0]
+    cold, warm = [], []
+    
+    for _ in range(repeats):
+        clear_registry_cache()
+        start = time.perf_counter()
+        predict_patient_outcomes(patient, load_models(model_dir, mmap=mmap))
+        cold.append(time.perf_counter() - start)
+        
+        start = time.perf_counter()
+        predict_patient_outcomes(patient, load_models(model_dir, mmap=mmap))
+        warm.append(time.perf_counter() - start)
+    
+    return {'cold_ms': summarize_ms(cold), 'warm_ms': summarize_ms(warm)}
+
+def benchmark_predict(model_dir='models', n_calls=200, compiled=False):
+    """
+    Measure single-patient predict_patient_outcomes latency with warm models
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    n_calls (int): Number of calls, each with a different patient
+    compiled (bool): Use the compiled tree ensembles
+    
+    Returns:
+    dict: Latency summary including p50 and p99
+    """
+    models = load_models(model_dir, compiled=compiled)
+    patients = sample_patients(n_calls)
+    predict_patient_outcomes(patients[0], models)
+    
+    durations = []
+    for patient in patients:
+        start = time.perf_counter()
+        predict_patient_outcomes(patient, models)
+        durations.append(time.perf_counter() - start)
+    return summarize_ms(durations)
+
+def benchmark_batch(model_dir='models', batch_sizes=(100, 1000, 10000), repeats=3, compiled=False):
+    """
+    Measure predict_batch throughput at several batch sizes
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    batch_sizes (list): Numbers of patients per batch
+    repeats (int): Repetitions per batch size
+    compiled (bool): Use the compiled tree ensembles
+    
+    Returns:
+    dict: Per batch size, latency summary and patients per second
+    """
+    models = load_models(model_dir, compiled=compiled)
+    results = {}
+    for batch_size in batch_sizes:
+        batch = pd.DataFrame(sample_patients(batch_size))
+        durations = time_call(lambda: predict_batch(batch, models), repeats)
+        results[str(batch_size)] = {
+            'latency_ms': summarize_ms(durations),
+            'patients_per_second': batch_size / float(np.median(durations))
+        }
+    return results
+
+def benchmark_knn(n_samples=100000, n_probes=(1, 2, 4, 8, 16), n_queries=1000, repeats=3):
+    """
+    Compare the approximate IVF index with exact KNN on every task
+    
+    Parameters:
+    n_samples (int): Number of synthetic samples the KNN models are trained on
+    n_probes (list): Index cells scanned per query, one measurement each
+    n_queries (int): Test patients used for latency and accuracy
+    repeats (int): Repetitions per latency measurement
+    
+    Returns:
+    dict: Per task, the exact model's and every n_probe setting's batch and
+          single-row latency, neighbor recall and AUROC (classification) or R²
+    """
+    from sklearn.metrics import roc_auc_score, r2_score
+    from train_models import MODEL_SPECS, prepare_training_data
+    from knn_index import build_ivf_index, neighbor_recall
+    
+    prepared = prepare_training_data(generate_sample_data(n_samples))
+    X = prepared['X_test'][:n_queries]
+    results = {'n_samples': n_samples, 'n_queries': len(X)}
+    
+    for spec in MODEL_SPECS:
+        if spec['name'] != 'knn':
+            continue
+        task = spec['task']
+        y = np.asarray(prepared['y_test'][task])[:n_queries]
+        exact = spec['estimator'](**spec['params']).fit(prepared['X_train'], prepared['y_train'][task])
+        
+        start = time.perf_counter()
+        index = build_ivf_index(exact)
+        task_results = {'n_lists': index.n_lists, 'build_seconds': time.perf_counter() - start}
+        
+        def measure(model):
+            if task == 'mortality_classification':
+                score = roc_auc_score(y, model.predict_proba(X)[:, 1])
+            else:
+                score = r2_score(y, model.predict(X))
+            return {
+                'batch_ms': summarize_ms(time_call(lambda: model.predict(X), repeats)),
+                'single_row_ms': summarize_ms(time_call(lambda: model.predict(X[:1]), 100)),
+                'auroc' if task == 'mortality_classification' else 'r2': float(score)
+            }
+        
+        task_results['exact'] = measure(exact)
+        for n_probe in n_probes:
+            index.n_probe = n_probe
+            task_results[f"n_probe_{n_probe}"] = measure(index)
+            task_results[f"n_probe_{n_probe}"]['recall'] = neighbor_recall(exact, index, X)
+        results[task] = task_results
+    return results
+
+def run_benchmarks(scenarios=SCENARIOS, model_dir='models', sizes=(1000, 10000, 100000, 1000000),
+                   batch_sizes=(100, 1000, 10000), repeats=3):
+    """
+    Run the selected benchmark scenarios
+    
+    Parameters:
+    scenarios (list): Scenario names, see SCENARIOS
+    model_dir (str): Directory with saved models, trained first if missing
+    sizes (list): Dataset sizes for the 'generate' scenario
+    batch_sizes (list): Batch sizes for the 'batch' scenario
+    repeats (int): Repetitions per measurement
+    
+    Returns:
+    dict: Machine info, timestamp and results keyed by scenario
+    """
+    if {'load', 'predict', 'batch'} & set(scenarios):
+        ensure_models(model_dir, mmap_forests=True)
+    
+    results = {}
+    if 'generate' in scenarios:
+        results['generate'] = benchmark_generate(sizes, repeats)
+    if 'train' in scenarios:
+        results['train'] = benchmark_train(repeats=repeats)
+    if 'load' in scenarios:
+        results['load'] = {
+            'pickle': benchmark_model_loading(model_dir, repeats),
+            'mmap': benchmark_model_loading(model_dir, repeats, mmap=True),
+            'note': MMAP_NOTE
+        }
+    if 'predict' in scenarios:
+        results['predict'] = benchmark_predict(model_dir)
+        results['predict_compiled'] = benchmark_predict(model_dir, compiled=True)
+    if 'batch' in scenarios:
+        results['batch'] = benchmark_batch(model_dir, batch_sizes, repeats)
+        results['batch_compiled'] = benchmark_batch(model_dir, batch_sizes, repeats, compiled=True)
+    if 'knn' in scenarios:
+        results['knn'] = benchmark_knn(repeats=repeats)
+    
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'machine': machine_info(),
+        'results': results
+    }
+
+def _flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name))
+        elif isinstance(value, (int, float)):
+            flat[name] = value
+    return flat
+
+def compare_results(baseline, current, threshold=0.1):
+    """
+    Compare the latencies of two benchmark runs
+    
+    Parameters:
+    baseline (dict): Earlier output of run_benchmarks
+    current (dict): Later output of run_benchmarks
+    threshold (float): Relative slowdown reported as a regression
+    
+    Returns:
+    dict: current/baseline ratio of every median latency ('p50') present in both
+          runs, and the names of those slower than 1 + threshold under 'regressions'
+    """
+    old = _flatten(baseline['results'])
+    new = _flatten(current['results'])
+    ratios = {name: new[name] / old[name] for name in new
+              if name.endswith('.p50') and name in old and old[name] > 0}
+    return {
+        'ratios': ratios,
+        'regressions': sorted(name for name, ratio in ratios.items() if ratio > 1 + threshold)
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark data generation, training, loading and prediction")
+    parser.add_argument('--scenarios', nargs='+', default=SCENARIOS, choices=SCENARIOS, help="Scenarios to run")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000, 1000000],
+                        help="Dataset sizes for the generate scenario (up to 10000000)")
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[100, 1000, 10000],
+                        help="Batch sizes for the batch scenario")
+    parser.add_argument('--repeats', type=int, default=3, help="Number of repetitions")
+    parser.add_argument('--output', default='benchmark_results.json', help="Write results to this JSON file")
+    parser.add_argument('--compare', default=None, help="Earlier results JSON to compare against")
+    args = parser.parse_args()
+    
+    report = run_benchmarks(args.scenarios, args.model_dir, args.sizes, args.batch_sizes, args.repeats)
+    
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {args.output}")
+    if 'load' in report['results']:
+        print(f"Note: {MMAP_NOTE}")
+    
+    if args.compare:
+        with open(args.compare, "r") as f:
+            comparison = compare_results(json.load(f), report)
+        print(json.dumps(comparison, indent=2))
@@ -0,0 +1,98 @@
+import os
+import pandas as pd
+
+def iter_csv_chunks(file_path, chunksize=100000, usecols=None):
+    """
+    Read a CSV file lazily in fixed-size chunks
+    
+    Parameters:
+    file_path (str): Path to the CSV file
+    chunksize (int): Number of rows per chunk
+    usecols (list): Optional subset of columns to read
+    
+    Returns:
+    generator: Yields pd.DataFrame chunks of at most chunksize rows
+    """
+    with pd.read_csv(file_path, chunksize=chunksize, usecols=usecols) as reader:
+        for chunk in reader:
+            yield chunk
+
+def infer_file_format(path):
+    """
+    Infer the tabular file format from a file name
+    
+    Parameters:
+    path (str): Output or input file path
+    
+    Returns:
+    str: 'parquet' for .parquet/.pq files, 'csv' otherwise
+    """
+    return 'parquet' if path.endswith(('.parquet', '.pq')) else 'csv'
+
+class ChunkWriter:
+    """
+    Append DataFrame chunks to a CSV or Parquet file as they are produced, so
+    only one chunk is ever held in memory. Parquet output requires pyarrow.
+    """
+    
+    def __init__(self, path, file_format=None):
+        self.path = path
+        self.file_format = file_format or infer_file_format(path)
+        self.rows_written = 0
+        self._handle = None
+        self._parquet_writer = None
+        self._schema = None
+        
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+    
+    def write(self, df):
+        """
+        Write one chunk
+        
+        Parameters:
+        df (pd.DataFrame): Chunk to append; must have the same columns as the first chunk
+        """
+        if self.file_format == 'parquet':
+            self._write_parquet(df)
+        else:
+            if self._handle is None:
+                self._handle = open(self.path, 'w', newline='')
+                df.to_csv(self._handle, index=False)
+            else:
+                df.to_csv(self._handle, index=False, header=False)
+        self.rows_written += len(df)
+    
+    def _write_parquet(self, df):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("Writing Parquet output requires pyarrow (pip install pyarrow)") from e
+        
+        if self._parquet_writer is None:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            self._schema = table.schema
+            self._parquet_writer = pq.ParquetWriter(self.path, self._schema)
+        else:
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._parquet_writer.write_table(table)
+    
+    def close(self):
+        """
+        Flush and close the output file
+        """
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,417 @@
+import os
+import json
+import time
+import pickle
+import argparse
+import numpy as np
+from tree_compiler import CompiledTreeEnsemble, compile_random_forest, load_compiled, save_compiled
+from knn_index import build_ivf_index, load_index, quantize_points
+from model_registry import file_sha256, read_manifest, write_manifest
+
+# Variants from least to most compressed:
+# - float32: random forests as compiled trees with float32 thresholds and
+#   leaf values, KNN indexes with float32 points
+# - pruned: like float32, with the forests cut to the shallowest depth that
+#   stays within half the metric tolerance
+# - compact: like pruned, keeping the fewest trees that stay within the
+#   tolerance, and KNN points quantized to one byte per feature
+VARIANTS = ('float32', 'pruned', 'compact')
+
+# Model types that get compressed variants; other models load unchanged
+COMPRESSED_MODEL_TYPES = ('random_forest', 'knn')
+
+# Largest tolerated drop of the validation AUROC (classification) or R²
+# (regression) against the original model
+DEFAULT_TOLERANCE = 0.01
+
+DEPTH_CANDIDATES = (4, 6, 8, 10, 12, 16, 20)
+TREE_COUNT_CANDIDATES = (10, 20, 30, 40, 50, 75)
+
+def variant_path(task, model_name, variant):
+    """
+    Relative path of a compressed artifact within the model directory
+    
+    Parameters:
+    task (str): Prediction task name
+    model_name (str): Model name within the task
+    variant (str): Variant name
+    
+    Returns:
+    str: e.g. 'mortality_classification/random_forest.compact.npz'
+    """
+    return f"{task}/{model_name}.{variant}.npz"
+
+def to_float32(compiled):
+    """
+    Store a compiled random forest in float32, without changing any split
+    
+    sklearn compares float32 feature values against float64 thresholds, so
+    rounding every threshold down to the nearest float32 keeps every split
+    decision. Only the leaf values lose precision (about 1e-7 relative).
+    
+    Parameters:
+    compiled (CompiledTreeEnsemble): Compiled random forest
+    
+    Returns:
+    CompiledTreeEnsemble: Copy with float32 thresholds and values and 16-bit feature indices
+    """
+    threshold = compiled.threshold.astype(np.float32)
+    rounded_up = threshold > compiled.threshold
+    threshold[rounded_up] = np.nextafter(threshold[rounded_up], np.float32(-np.inf))
+    feature_dtype = np.int16 if compiled.feature.max(initial=0) < np.iinfo(np.int16).max else np.int32
+    return CompiledTreeEnsemble(compiled.feature.astype(feature_dtype), threshold, compiled.children,
+                                compiled.default_left, compiled.value.astype(np.float32), compiled.roots,
+                                compiled.max_depth, compiled.strict_less, compiled.aggregate,
+                                compiled.base_margin, compiled.is_classifier)
+
+def prune_depth(compiled, max_depth):
+    """
+    Cut every tree of a compiled random forest at a maximum depth
+    
+    Nodes at max_depth become leaves predicting the value stored for them at
+    training time (the class fraction or mean target of their samples), and
+    the nodes below them are dropped.
+    
+    Parameters:
+    compiled (CompiledTreeEnsemble): Compiled random forest
+    max_depth (int): Depth of the deepest remaining nodes
+    
+    Returns:
+    CompiledTreeEnsemble: Pruned copy
+    """
+    n_nodes = len(compiled.feature)
+    depth = np.full(n_nodes, -1)
+    depth[compiled.roots] = 0
+    frontier = compiled.roots
+    for level in range(1, max_depth + 1):
+        children = compiled.children[frontier].ravel()
+        # Leaves point to themselves and are already labeled
+        children = np.unique(children[depth[children] < 0])
+        if not len(children):
+            break
+        depth[children] = level
+        frontier = children
+    
+    feature = compiled.feature.copy()
+    threshold = compiled.threshold.copy()
+    children = compiled.children.copy()
+    cut = depth == max_depth
+    feature[cut] = 0
+    threshold[cut] = np.inf
+    children[cut] = np.flatnonzero(cut)[:, None]
+    
+    keep = depth >= 0
+    new_index = (np.cumsum(keep) - 1).astype(np.int32)
+    return CompiledTreeEnsemble(feature[keep], threshold[keep], np.ascontiguousarray(new_index[children[keep]]),
+                                compiled.default_left[keep], compiled.value[keep], new_index[compiled.roots],
+                                min(compiled.max_depth, max_depth), compiled.strict_less, compiled.aggregate,
+                                compiled.base_margin, compiled.is_classifier)
+
+def keep_trees(compiled, n_trees):
+    """
+    Keep the first trees of a compiled random forest
+    
+    The trees of a random forest are exchangeable, so the first n_trees are
+    an unbiased smaller forest.
+    
+    Parameters:
+    compiled (CompiledTreeEnsemble): Compiled random forest
+    n_trees (int): Trees to keep
+    
+    Returns:
+    CompiledTreeEnsemble: Copy with n_trees trees
+    """
+    if n_trees >= compiled.n_trees:
+        return compiled
+    end = compiled.roots[n_trees]
+    return CompiledTreeEnsemble(compiled.feature[:end], compiled.threshold[:end], compiled.children[:end],
+                                compiled.default_left[:end], compiled.value[:end], compiled.roots[:n_trees],
+                                compiled.max_depth, compiled.strict_less, compiled.aggregate,
+                                compiled.base_margin, compiled.is_classifier)
+
+def validation_score(task, model, X, y):
+    """
+    Score a model on validation data with the metric used to bound compression loss
+    
+    Parameters:
+    task (str): Prediction task name
+    model (object): Fitted or compressed model
+    X (np.ndarray): Scaled validation features
+    y (np.ndarray): Validation targets
+    
+    Returns:
+    float: AUROC for classification, R² for regression
+    """
+    from sklearn.metrics import r2_score, roc_auc_score
+    
+    if task == 'mortality_classification':
+        return float(roc_auc_score(y, model.predict_proba(X)[:, 1]))
+    return float(r2_score(y, model.predict(X)))
+
+def compress_random_forest(task, model, X, y, tolerance=DEFAULT_TOLERANCE):
+    """
+    Build the compressed variants of a random forest
+    
+    Parameters:
+    task (str): Prediction task name
+    model (RandomForestClassifier or RandomForestRegressor): Fitted forest
+    X (np.ndarray): Scaled validation features
+    y (np.ndarray): Validation targets
+    tolerance (float): Largest tolerated drop of the validation metric
+    
+    Returns:
+    dict: {variant: (CompiledTreeEnsemble, settings dict)}
+    """
+    baseline = validation_score(task, model, X, y)
+    full = to_float32(compile_random_forest(model))
+    
+    pruned, depth = full, full.max_depth
+    for candidate in DEPTH_CANDIDATES:
+        if candidate >= full.max_depth:
+            break
+        candidate_model = prune_depth(full, candidate)
+        if baseline - validation_score(task, candidate_model, X, y) <= tolerance / 2:
+            pruned, depth = candidate_model, candidate
+            break
+    
+    compact, n_trees = pruned, pruned.n_trees
+    for candidate in TREE_COUNT_CANDIDATES:
+        if candidate >= pruned.n_trees:
+            break
+        candidate_model = keep_trees(pruned, candidate)
+        if baseline - validation_score(task, candidate_model, X, y) <= tolerance:
+            compact, n_trees = candidate_model, candidate
+            break
+    
+    return {
+        'float32': (full, {'max_depth': full.max_depth, 'n_trees': full.n_trees}),
+        'pruned': (pruned, {'max_depth': depth, 'n_trees': pruned.n_trees}),
+        'compact': (compact, {'max_depth': depth, 'n_trees': n_trees})
+    }
+
+def compress_knn(model):
+    """
+    Build the compressed variants of a KNN model as IVF indexes
+    
+    Parameters:
+    model (KNeighborsClassifier or KNeighborsRegressor): Fitted model
+    
+    Returns:
+    dict: {variant: (dict of index arrays, settings dict)}, empty if the
+          model cannot be indexed
+    """
+    index = build_ivf_index(model)
+    if index is None:
+        return {}
+    arrays = index.to_arrays()
+    points = arrays.pop('points')
+    
+    float32 = {**arrays, 'points': points.astype(np.float32)}
+    quantized = {**arrays, **quantize_points(points)}
+    return {
+        'float32': (float32, {'point_dtype': 'float32'}),
+        'pruned': (float32, {'point_dtype': 'float32'}),
+        'compact': (quantized, {'point_dtype': 'uint8'})
+    }
+
+def load_variant(path, kind, approximate_knn=False, knn_probes=None):
+    """
+    Load a compressed artifact written by compress_models
+    
+    Parameters:
+    path (str): Artifact path
+    kind (str): 'compiled_trees' or 'knn_index'
+    approximate_knn (bool): Scan only knn_probes cells per KNN query instead
+                            of all of them (exact search over the stored points)
+    knn_probes (int): Index cells scanned per query, None for the saved default
+    
+    Returns:
+    object: CompiledTreeEnsemble or knn_index.IVFNeighbors
+    """
+    if kind == 'compiled_trees':
+        return load_compiled(path)
+    index = load_index(path, knn_probes)
+    if not approximate_knn:
+        index.n_probe = index.n_lists
+    return index
+
+def _validation_set(models, data):
+    from feature_encoder import get_feature_encoder
+    from predict import TASKS, scale_features
+    from train_models import TASK_TARGETS
+    
+    X = scale_features(models['scaler'], get_feature_encoder(models['feature_names']).encode(data))
+    return X, {task: data[TASK_TARGETS[task]].to_numpy() for task in TASKS}
+
+def compress_models(model_dir, data, tolerance=DEFAULT_TOLERANCE):
+    """
+    Write compressed variants of the random forests and KNN models of a model directory
+    
+    The variants are stored next to the original artifacts and recorded in
+    the manifest under each model's 'variants', so load_models(variant=...)
+    finds them. Rewriting the manifest gives the directory a new version.
+    
+    Parameters:
+    model_dir (str): Directory containing saved models with a manifest
+    data (pd.DataFrame): Validation patients including the target columns,
+                         used to choose depths and tree counts
+    tolerance (float): Largest tolerated drop of the validation AUROC / R²
+    
+    Returns:
+    dict: The manifest that was written
+    """
+    from predict import load_models
+    from prediction_cache import invalidate_prediction_caches
+    
+    manifest, _ = read_manifest(model_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No manifest found in {model_dir}")
+    models = load_models(model_dir)
+    X, targets = _validation_set(models, data)
+    
+    model_paths = {}
+    for task, entries in manifest['models'].items():
+        model_paths[task] = {}
+        for model_name, entry in entries.items():
+            paths = {key: value for key, value in entry.items() if key not in ('sha256', 'variants')}
+            model_paths[task][model_name] = paths
+            if model_name not in COMPRESSED_MODEL_TYPES:
+                continue
+            
+            model = models[task][model_name]
+            if model_name == 'random_forest':
+                kind, variants = 'compiled_trees', compress_random_forest(task, model, X, targets[task], tolerance)
+            else:
+                kind, variants = 'knn_index', compress_knn(model)
+            
+            paths['variants'] = {}
+            written = {}
+            for variant, (artifact, settings) in variants.items():
+                # Variants that compress no further share the artifact of the previous one
+                path = written.get(id(artifact))
+                if path is None:
+                    path = written[id(artifact)] = variant_path(task, model_name, variant)
+                    if kind == 'compiled_trees':
+                        save_compiled(artifact, os.path.join(model_dir, path))
+                    else:
+                        with open(os.path.join(model_dir, path), "wb") as f:
+                            np.savez(f, **artifact)
+                paths['variants'][variant] = {'path': path, 'kind': kind,
+                                              'sha256': file_sha256(os.path.join(model_dir, path)), **settings}
+                print(f"{task}/{model_name} {variant}: {settings}")
+    
+    extra_files = {name: entry['path'] for name, entry in manifest['files'].items()}
+    manifest = write_manifest(model_dir, manifest['feature_names'], model_paths, extra_files=extra_files)
+    invalidate_prediction_caches()
+    return manifest
+
+def _best_seconds(func, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def benchmark_variants(model_dir, data, n_latency=200, repeats=3):
+    """
+    Measure size, load time, latency and validation metric of every variant
+    
+    Each compressed model is compared with its original pickle and, where
+    save_models wrote one, its exact compiled artifact.
+    
+    Parameters:
+    model_dir (str): Directory with variants written by compress_models
+    data (pd.DataFrame): Validation patients including the target columns;
+                         use other rows than for compress_models
+    n_latency (int): Single-patient predictions timed per model
+    repeats (int): Timed runs of loads and batch predictions; the fastest counts
+    
+    Returns:
+    dict: {task: {model: {variant: measurements}}}, where 'original' is the
+          pickled model and 'metric_loss' the drop of the AUROC / R² against it
+    """
+    from predict import load_models
+    
+    manifest, _ = read_manifest(model_dir)
+    X, targets = _validation_set(load_models(model_dir), data)
+    
+    report = {}
+    for task, entries in manifest['models'].items():
+        for model_name, entry in entries.items():
+            if not entry.get('variants'):
+                continue
+            
+            def load_original(path=os.path.join(model_dir, entry['path'])):
+                with open(path, "rb") as f:
+                    return pickle.load(f)
+            
+            loaders = {'original': (entry['path'], load_original)}
+            if entry.get('compiled_path'):
+                loaders['compiled'] = (entry['compiled_path'],
+                                       lambda path=os.path.join(model_dir, entry['compiled_path']): load_compiled(path))
+            for variant, variant_entry in entry['variants'].items():
+                loaders[variant] = (variant_entry['path'],
+                                    lambda path=os.path.join(model_dir, variant_entry['path']),
+                                    kind=variant_entry['kind']: load_variant(path, kind))
+            
+            results = {}
+            for variant, (path, loader) in loaders.items():
+                model = loader()
+                predict = model.predict_proba if task == 'mortality_classification' else model.predict
+                row = X[:1]
+                start = time.perf_counter()
+                for _ in range(n_latency):
+                    predict(row)
+                latency = (time.perf_counter() - start) / n_latency
+                
+                results[variant] = {
+                    'size_bytes': os.path.getsize(os.path.join(model_dir, path)),
+                    'load_seconds': _best_seconds(loader, repeats),
+                    'latency_us': latency * 1e6,
+                    'batch_seconds': _best_seconds(lambda: predict(X), repeats),
+                    'metric': validation_score(task, model, X, targets[task])
+                }
+                results[variant].update({key: value for key, value in entry.get('variants', {}).get(variant, {}).items()
+                                         if key not in ('path', 'kind', 'sha256')})
+            
+            for measurements in results.values():
+                measurements['metric_loss'] = results['original']['metric'] - measurements['metric']
+                measurements['size_ratio'] = measurements['size_bytes'] / results['original']['size_bytes']
+            report.setdefault(task, {})[model_name] = results
+    
+    return report
+
+if __name__ == "__main__":
+    import pandas as pd
+    from generate_data import generate_sample_data
+    
+    parser = argparse.ArgumentParser(description="Write compressed model variants and report their trade-offs")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--data', default=None, help="Validation patient CSV with targets, generated if omitted")
+    parser.add_argument('--n-samples', type=int, default=2000, help="Number of samples to generate without --data")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="Largest tolerated drop of the validation AUROC / R2")
+    parser.add_argument('--output', default=None, help="Write the report to this JSON file")
+    args = parser.parse_args()
+    
+    # A different seed than training, so depths and tree counts are chosen on unseen patients
+    data = pd.read_csv(args.data) if args.data else generate_sample_data(args.n_samples, seed=7)
+    # Choose the settings on one half and report on the other
+    selection_rows = data.sample(frac=0.5, random_state=0)
+    report_rows = data.drop(selection_rows.index)
+    
+    compress_models(args.model_dir, selection_rows, args.tolerance)
+    report = benchmark_variants(args.model_dir, report_rows)
+    
+    for task, task_report in report.items():
+        for model_name, results in task_report.items():
+            for variant, m in results.items():
+                print(f"{task}/{model_name} {variant}: {m['size_bytes'] / 1e6:.2f} MB ({m['size_ratio']:.0%}), "
+                      f"load {m['load_seconds'] * 1e3:.1f} ms, latency {m['latency_us']:.0f} us, "
+                      f"batch {m['batch_seconds'] * 1e3:.1f} ms, metric {m['metric']:.4f} "
+                      f"(loss {m['metric_loss']:+.4f})")
+    
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
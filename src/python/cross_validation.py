@@ -0,0 +1,257 @@
+import argparse
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from sklearn.model_selection import StratifiedKFold
+from sklearn.preprocessing import StandardScaler
+from generate_data import generate_sample_data
+from train_models import (MODEL_SPECS, TASKS, TASK_TARGETS, apply_hyperparams, encode_training_features, fit_model,
+                          plan_threads, save_metrics)
+
+# Regression targets are stratified on this many quantile bins, so every fold
+# covers the whole range of the target
+REGRESSION_STRATA = 10
+
+# Bootstrap resamples are processed in blocks of at most this many
+# (resample, row) weights, bounding memory on large datasets
+BOOTSTRAP_BLOCK_ELEMENTS = 1 << 22
+
+def fold_strata(task, y):
+    """
+    Labels the folds are stratified on
+    
+    Parameters:
+    task (str): Prediction task name
+    y (pd.Series): Targets
+    
+    Returns:
+    np.ndarray: Class labels, or quantile bins of a regression target
+    """
+    if task == 'mortality_classification':
+        return y.to_numpy()
+    ranks = y.rank(method='first').to_numpy()
+    return np.minimum((ranks - 1) * REGRESSION_STRATA // len(y), REGRESSION_STRATA - 1).astype(np.int64)
+
+def fit_fold(spec, X, y, train_index, test_index, feature_names, n_threads=1):
+    """
+    Fit one model on one cross-validation fold
+    
+    The scaler is fitted on the training part of the fold only, like
+    prepare_training_data does for the hold-out split.
+    
+    Parameters:
+    spec (dict): Entry of MODEL_SPECS
+    X (np.ndarray): Unscaled features
+    y (pd.Series): Targets
+    train_index (np.ndarray): Training rows of the fold
+    test_index (np.ndarray): Test rows of the fold
+    feature_names (list): Feature names
+    n_threads (int): Cores the estimator may use internally
+    
+    Returns:
+    dict: Fold metrics, out-of-fold predictions under 'pred' (and 'prob' for
+          classifiers) and the feature importances or coefficients
+    """
+    scaler = StandardScaler()
+    X_train = scaler.fit_transform(X[train_index])
+    X_test = scaler.transform(X[test_index])
+    
+    entry = fit_model(spec, X_train, y.iloc[train_index], X_test, y.iloc[test_index], feature_names, n_threads)
+    model = entry.pop('model')
+    entry['pred'] = model.predict(X_test)
+    if spec['task'] == 'mortality_classification':
+        entry['prob'] = model.predict_proba(X_test)[:, 1]
+    return entry
+
+def bootstrap_weights(n_rows, n_resamples, rng):
+    """
+    Draw bootstrap resamples as per-row counts
+    
+    Parameters:
+    n_rows (int): Number of rows
+    n_resamples (int): Number of resamples
+    rng (np.random.Generator): Random generator
+    
+    Returns:
+    np.ndarray: Shape (n_resamples, n_rows); how often each row was drawn
+    """
+    draws = rng.integers(0, n_rows, size=(n_resamples, n_rows))
+    draws += np.arange(n_resamples)[:, None] * n_rows
+    return np.bincount(draws.ravel(), minlength=n_resamples * n_rows).reshape(n_resamples, n_rows).astype(np.float64)
+
+def weighted_auroc(weights, y, prob):
+    """
+    Compute the AUROC of every bootstrap resample at once
+    
+    Uses the Mann-Whitney form of the AUROC on the rows sorted by score, with
+    ties counting half, so no resample needs its own sort.
+    
+    Parameters:
+    weights (np.ndarray): Resample row counts, shape (n_resamples, n_rows)
+    y (np.ndarray): Binary labels
+    prob (np.ndarray): Predicted probabilities
+    
+    Returns:
+    np.ndarray: AUROC per resample (NaN where a resample holds one class only)
+    """
+    order = np.argsort(prob, kind='stable')
+    sorted_prob = prob[order]
+    starts = np.flatnonzero(np.r_[True, sorted_prob[1:] != sorted_prob[:-1]])
+    
+    positive = y[order].astype(bool)
+    weights = weights[:, order]
+    pos = np.add.reduceat(weights * positive, starts, axis=1)
+    neg = np.add.reduceat(weights * ~positive, starts, axis=1)
+    
+    # Negatives scored below every group of tied scores
+    neg_below = np.cumsum(neg, axis=1) - neg
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (pos * (neg_below + 0.5 * neg)).sum(axis=1) / (pos.sum(axis=1) * neg.sum(axis=1))
+
+def bootstrap_metrics(task, y, pred, prob=None, n_resamples=1000, seed=0):
+    """
+    Compute the metrics of evaluate_model on bootstrap resamples of predictions
+    
+    Every metric is a weighted sum over the rows, so a block of resamples is
+    one matrix product per statistic instead of one metric call per resample.
+    
+    Parameters:
+    task (str): Prediction task name
+    y (np.ndarray): True targets
+    pred (np.ndarray): Predicted classes or values
+    prob (np.ndarray): Predicted probabilities, for classification
+    n_resamples (int): Number of bootstrap resamples
+    seed (int): Random seed
+    
+    Returns:
+    dict: Array of n_resamples values per metric
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = len(y)
+    block = max(1, BOOTSTRAP_BLOCK_ELEMENTS // n_rows)
+    y = np.asarray(y, dtype=np.float64)
+    pred = np.asarray(pred, dtype=np.float64)
+    
+    samples = {}
+    for start in range(0, n_resamples, block):
+        weights = bootstrap_weights(n_rows, min(block, n_resamples - start), rng)
+        
+        if task == 'mortality_classification':
+            actual, predicted = y == 1, pred == 1
+            tp = weights @ (actual & predicted)
+            fp = weights @ (~actual & predicted)
+            fn = weights @ (actual & ~predicted)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                # Undefined precision/recall/F1 count as 0, like sklearn's zero_division default
+                values = {
+                    'accuracy': weights @ (actual == predicted) / n_rows,
+                    'auroc': weighted_auroc(weights, y, np.asarray(prob, dtype=np.float64)),
+                    'precision': np.nan_to_num(tp / (tp + fp)),
+                    'recall': np.nan_to_num(tp / (tp + fn)),
+                    'f1': np.nan_to_num(2 * tp / (2 * tp + fp + fn))
+                }
+        else:
+            sse = weights @ (y - pred) ** 2
+            sst = weights @ y ** 2 - (weights @ y) ** 2 / n_rows
+            with np.errstate(divide='ignore', invalid='ignore'):
+                values = {'mse': sse / n_rows, 'r2': 1 - sse / sst}
+        
+        for name, value in values.items():
+            samples.setdefault(name, []).append(value)
+    
+    return {name: np.concatenate(value) for name, value in samples.items()}
+
+def cross_validate_models(data, n_splits=5, n_jobs=-1, n_resamples=1000, confidence=0.95, seed=42,
+                          hyperparams=None):
+    """
+    Benchmark every model with stratified k-fold cross-validation
+    
+    All (model, fold) fits run concurrently on a process pool. For every
+    metric the result holds the mean over the folds under the usual key, its
+    standard deviation under '<metric>_std' and a bootstrap confidence
+    interval [low, high] under '<metric>_ci'. The interval is computed on the
+    pooled out-of-fold predictions, so it reflects every patient once.
+    
+    Parameters:
+    data (pd.DataFrame): Patient data including the target columns
+    n_splits (int): Number of folds
+    n_jobs (int): Core budget, -1 uses all cores
+    n_resamples (int): Bootstrap resamples per metric
+    confidence (float): Coverage of the confidence intervals
+    seed (int): Random seed of the folds and the bootstrap
+    hyperparams (dict): Hyperparameters overriding MODEL_SPECS, see train_models
+    
+    Returns:
+    dict: Metrics in the layout of train_models' performance metrics
+    """
+    X_frame = encode_training_features(data)
+    feature_names = X_frame.columns.tolist()
+    X = X_frame.to_numpy(dtype=np.float64)
+    targets = {task: data[TASK_TARGETS[task]].reset_index(drop=True) for task in TASKS}
+    
+    folds = {}
+    for task in TASKS:
+        splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+        folds[task] = list(splitter.split(X, fold_strata(task, targets[task])))
+    
+    specs = apply_hyperparams(MODEL_SPECS, hyperparams)
+    jobs = [(spec, fold) for spec in specs for fold in range(n_splits)]
+    n_workers, threads = plan_threads([spec for spec, _ in jobs], n_jobs)
+    entries = Parallel(n_jobs=n_workers)(
+        delayed(fit_fold)(spec, X, targets[spec['task']], *folds[spec['task']][fold], feature_names, n_threads)
+        for (spec, fold), n_threads in zip(jobs, threads)
+    )
+    
+    alpha = (1 - confidence) / 2
+    perf_metrics = {task: {} for task in TASKS}
+    for i, spec in enumerate(specs):
+        task = spec['task']
+        fold_entries = entries[i * n_splits:(i + 1) * n_splits]
+        
+        # Reassemble the out-of-fold predictions in row order
+        pred = np.empty(len(X))
+        prob = np.empty(len(X)) if task == 'mortality_classification' else None
+        for (_, test_index), entry in zip(folds[task], fold_entries):
+            pred[test_index] = entry['pred']
+            if prob is not None:
+                prob[test_index] = entry['prob']
+        
+        samples = bootstrap_metrics(task, targets[task].to_numpy(), pred, prob, n_resamples, seed)
+        metrics = {'cv_folds': n_splits, 'bootstrap_resamples': n_resamples, 'confidence': confidence}
+        for name, values in samples.items():
+            fold_values = np.array([entry[name] for entry in fold_entries], dtype=np.float64)
+            metrics[name] = float(fold_values.mean())
+            metrics[f"{name}_std"] = float(fold_values.std(ddof=1))
+            metrics[f"{name}_ci"] = [float(v) for v in np.nanquantile(values, [alpha, 1 - alpha])]
+        
+        # Importances and coefficients averaged over the folds
+        for key in ('feature_importance', 'coefficients'):
+            if key in fold_entries[0]:
+                metrics[key] = {name: float(np.mean([entry[key][name] for entry in fold_entries]))
+                                for name in feature_names}
+        
+        perf_metrics[task][spec['name']] = metrics
+    
+    return perf_metrics
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cross-validate every model with bootstrap confidence intervals")
+    parser.add_argument('--data', default=None, help="Patient CSV file, generates synthetic data if omitted")
+    parser.add_argument('--n-samples', type=int, default=500, help="Number of samples to generate without --data")
+    parser.add_argument('--folds', type=int, default=5, help="Number of cross-validation folds")
+    parser.add_argument('--n-jobs', type=int, default=-1, help="Core budget, -1 uses all cores")
+    parser.add_argument('--resamples', type=int, default=1000, help="Bootstrap resamples per metric")
+    parser.add_argument('--confidence', type=float, default=0.95, help="Coverage of the confidence intervals")
+    parser.add_argument('--hyperparams', default=None, help="Tuned hyperparameters written by tuning.py")
+    parser.add_argument('--output', default='models/cv_metrics.json', help="Metrics JSON file")
+    args = parser.parse_args()
+    
+    data = pd.read_csv(args.data) if args.data else generate_sample_data(args.n_samples)
+    hyperparams = None
+    if args.hyperparams:
+        from tuning import load_hyperparams
+        hyperparams = load_hyperparams(args.hyperparams)
+    
+    metrics = cross_validate_models(data, n_splits=args.folds, n_jobs=args.n_jobs, n_resamples=args.resamples,
+                                    confidence=args.confidence, hyperparams=hyperparams)
+    save_metrics(metrics, args.output)
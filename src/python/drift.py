@@ -0,0 +1,423 @@
+import os
+import json
+import threading
+import argparse
+from datetime import datetime, timezone
+import numpy as np
+
+DRIFT_REFERENCE_FILE = 'drift_reference.json'
+REFERENCE_VERSION = 1
+
+# Histogram bins per feature, bounded by training quantiles so every bin held
+# about the same share of the training rows (fewer for features with ties,
+# e.g. one-hot dummies)
+DEFAULT_BINS = 10
+
+# Population stability index levels commonly read as a moderate and a major shift
+PSI_WARNING = 0.1
+PSI_DRIFT = 0.25
+
+# Features are only rated once this many non-missing values were seen
+MIN_ROWS = 100
+
+# Floor of the bin fractions in the PSI, so empty bins do not divide by zero
+_EPSILON = 1e-4
+
+def build_reference(X, feature_names, n_bins=DEFAULT_BINS):
+    """
+    Summarize the training distribution of every feature
+    
+    Parameters:
+    X (np.ndarray): Encoded, unscaled training features
+    feature_names (list): Column names of X
+    n_bins (int): Quantile bins per feature
+    
+    Returns:
+    dict: JSON-serializable reference with, per feature, the inner bin edges,
+          the fraction of training rows per bin and the mean, variance,
+          minimum and maximum
+    """
+    X = np.asarray(X, dtype=np.float64)
+    probabilities = np.linspace(0, 1, n_bins + 1)[1:-1]
+    features = {}
+    for column, name in enumerate(feature_names):
+        values = X[:, column]
+        values = values[np.isfinite(values)]
+        edges = np.unique(np.quantile(values, probabilities)) if len(values) else np.empty(0)
+        counts = np.bincount(np.searchsorted(edges, values, side='right'), minlength=len(edges) + 1)
+        features[name] = {
+            'edges': edges.tolist(),
+            'fractions': (counts / max(len(values), 1)).tolist(),
+            'mean': float(values.mean()) if len(values) else 0.0,
+            'variance': float(values.var()) if len(values) else 0.0,
+            'min': float(values.min()) if len(values) else 0.0,
+            'max': float(values.max()) if len(values) else 0.0
+        }
+    
+    return {'format_version': REFERENCE_VERSION, 'rows': len(X), 'n_bins': n_bins, 'features': features}
+
+def extend_reference(reference, X):
+    """
+    Add training rows to a reference, e.g. after an incremental update
+    
+    The bin edges stay those of the original training data; the bin
+    fractions and the moments are updated as if the reference had been built
+    from all rows.
+    
+    Parameters:
+    reference (dict): Reference from build_reference
+    X (np.ndarray): Encoded, unscaled new training features
+    
+    Returns:
+    dict: Extended reference
+    """
+    monitor = DriftMonitor(reference)
+    monitor.update(X)
+    
+    features = {}
+    for column, name in enumerate(monitor.feature_names):
+        feature = reference['features'][name]
+        n_old = reference['rows']
+        n_new = int(monitor.count[column])
+        total = max(n_old + n_new, 1)
+        n_bins = len(feature['fractions'])
+        delta = monitor.mean[column] - feature['mean']
+        features[name] = {
+            'edges': feature['edges'],
+            'fractions': ((np.asarray(feature['fractions']) * n_old + monitor.bin_counts[column, :n_bins]) / total).tolist(),
+            'mean': float(feature['mean'] + delta * n_new / total),
+            'variance': float((feature['variance'] * n_old + monitor.m2[column] + delta ** 2 * n_old * n_new / total) / total),
+            'min': float(min(feature['min'], monitor.min[column])),
+            'max': float(max(feature['max'], monitor.max[column]))
+        }
+    
+    return dict(reference, rows=reference['rows'] + len(np.atleast_2d(X)), features=features)
+
+def save_reference(reference, path):
+    """
+    Write a drift reference to a JSON file
+    
+    Parameters:
+    reference (dict): Reference from build_reference
+    path (str): Output file
+    """
+    with open(path, "w") as f:
+        json.dump(reference, f, indent=2)
+
+def load_reference(model_dir='models'):
+    """
+    Read the drift reference saved with a set of models
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    
+    Returns:
+    dict: Reference, or None if the models were saved without one
+    """
+    from model_registry import read_manifest
+    
+    manifest, _ = read_manifest(model_dir)
+    if manifest is not None:
+        entry = manifest['files'].get('drift_reference')
+        path = os.path.join(model_dir, entry['path']) if entry else None
+    else:
+        path = os.path.join(model_dir, DRIFT_REFERENCE_FILE)
+    
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+def population_stability_index(expected, actual):
+    """
+    Population stability index between two binned distributions
+    
+    Parameters:
+    expected (np.ndarray): Reference fractions per bin, one row per feature
+    actual (np.ndarray): Observed fractions per bin, same shape
+    
+    Returns:
+    np.ndarray: PSI per row
+    """
+    expected = np.maximum(expected, _EPSILON)
+    actual = np.maximum(actual, _EPSILON)
+    return np.sum((actual - expected) * np.log(actual / expected), axis=-1)
+
+def binned_ks(expected, actual):
+    """
+    Kolmogorov-Smirnov statistic between two binned distributions
+    
+    The largest gap between the cumulative fractions at the bin edges, a lower
+    bound of the KS statistic of the raw values.
+    
+    Parameters:
+    expected (np.ndarray): Reference fractions per bin, one row per feature
+    actual (np.ndarray): Observed fractions per bin, same shape
+    
+    Returns:
+    np.ndarray: Statistic per row
+    """
+    return np.max(np.abs(np.cumsum(actual, axis=-1) - np.cumsum(expected, axis=-1)), axis=-1)
+
+class DriftMonitor:
+    """
+    Running drift and data-quality statistics of the scored patients
+    
+    Memory is constant in the number of rows: per feature, a Welford
+    mean/variance, the minimum and maximum, counters of missing values and of
+    values outside the training range, and counts of the reference histogram
+    bins. update takes a batch at a time and is vectorized over rows and
+    features; the PSI and KS scores are computed from the bin counts when a
+    snapshot is taken. The monitor is thread-safe.
+    """
+    
+    def __init__(self, reference, model_version=None):
+        self.reference = reference
+        self.model_version = model_version
+        self.feature_names = list(reference['features'])
+        features = [reference['features'][name] for name in self.feature_names]
+        self.n_bins = max(len(feature['fractions']) for feature in features)
+        
+        # Inner edges padded with +inf, so every feature has n_bins - 1 of them
+        self.edges = np.full((len(features), self.n_bins - 1), np.inf)
+        self.expected = np.zeros((len(features), self.n_bins))
+        for column, feature in enumerate(features):
+            self.edges[column, :len(feature['edges'])] = feature['edges']
+            self.expected[column, :len(feature['fractions'])] = feature['fractions']
+        self.reference_mean = np.array([feature['mean'] for feature in features])
+        self.reference_std = np.sqrt([feature['variance'] for feature in features])
+        self.reference_min = np.array([feature['min'] for feature in features])
+        self.reference_max = np.array([feature['max'] for feature in features])
+        
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """
+        Forget every row seen so far
+        """
+        n_features = len(self.feature_names)
+        self.rows = 0
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.count = np.zeros(n_features, dtype=np.int64)
+        self.mean = np.zeros(n_features)
+        self.m2 = np.zeros(n_features)
+        self.min = np.full(n_features, np.inf)
+        self.max = np.full(n_features, -np.inf)
+        self.missing = np.zeros(n_features, dtype=np.int64)
+        self.below_range = np.zeros(n_features, dtype=np.int64)
+        self.above_range = np.zeros(n_features, dtype=np.int64)
+        self.bin_counts = np.zeros((n_features, self.n_bins), dtype=np.int64)
+    
+    def update(self, X):
+        """
+        Add a batch of scored patients
+        
+        Parameters:
+        X (np.ndarray): Encoded, unscaled features in the column order of the
+                        reference, e.g. from feature_encoder.FeatureEncoder.encode
+        """
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X[None, :]
+        if not len(X):
+            return
+        
+        valid = np.isfinite(X)
+        values = np.where(valid, X, 0.0)
+        count = valid.sum(axis=0)
+        mean = values.sum(axis=0) / np.maximum(count, 1)
+        m2 = (np.where(valid, X - mean, 0.0) ** 2).sum(axis=0)
+        
+        # Bin index of every value: the number of inner edges at or below it
+        bins = (values[:, :, None] >= self.edges[None, :, :]).sum(axis=2)
+        offsets = np.arange(len(self.feature_names)) * self.n_bins
+        bin_counts = np.bincount((bins + offsets)[valid], minlength=self.bin_counts.size).reshape(self.bin_counts.shape)
+        
+        below = (valid & (X < self.reference_min)).sum(axis=0)
+        above = (valid & (X > self.reference_max)).sum(axis=0)
+        low = np.where(valid, X, np.inf).min(axis=0)
+        high = np.where(valid, X, -np.inf).max(axis=0)
+        
+        self._merge_state({
+            'rows': len(X), 'count': count, 'mean': mean, 'm2': m2, 'min': low, 'max': high,
+            'missing': len(X) - count, 'below_range': below, 'above_range': above, 'bin_counts': bin_counts
+        })
+    
+    def merge(self, other):
+        """
+        Add the rows seen by another monitor with the same reference, e.g. one
+        per worker process
+        
+        Parameters:
+        other (DriftMonitor): Monitor to merge into this one
+        """
+        with other._lock:
+            state = other._state()
+        self._merge_state(state)
+    
+    def _state(self):
+        return {
+            'rows': self.rows, 'count': self.count.copy(), 'mean': self.mean.copy(), 'm2': self.m2.copy(),
+            'min': self.min.copy(), 'max': self.max.copy(), 'missing': self.missing.copy(),
+            'below_range': self.below_range.copy(), 'above_range': self.above_range.copy(),
+            'bin_counts': self.bin_counts.copy()
+        }
+    
+    def _merge_state(self, state):
+        with self._lock:
+            # Chan et al.'s pairwise combination of the running and the added moments
+            total = self.count + state['count']
+            delta = state['mean'] - self.mean
+            share = np.divide(state['count'], total, out=np.zeros(len(total)), where=total > 0)
+            self.mean += delta * share
+            self.m2 += state['m2'] + delta ** 2 * self.count * share
+            self.count = total
+            self.rows += state['rows']
+            self.min = np.minimum(self.min, state['min'])
+            self.max = np.maximum(self.max, state['max'])
+            for name in ('missing', 'below_range', 'above_range', 'bin_counts'):
+                setattr(self, name, getattr(self, name) + state[name])
+    
+    def snapshot(self):
+        """
+        Score the drift of every feature
+        
+        Returns:
+        dict: JSON-serializable snapshot; per feature the running statistics,
+              the PSI, the binned KS statistic, the mean shift in training
+              standard deviations and a status of 'stable', 'warning', 'drift'
+              or 'insufficient_data', plus the raw state ('state') from which
+              from_snapshot restores the monitor
+        """
+        with self._lock:
+            state = self._state()
+            started_at = self.started_at
+        
+        count = state['count']
+        actual = state['bin_counts'] / np.maximum(count, 1)[:, None]
+        psi = population_stability_index(self.expected, actual)
+        ks = binned_ks(self.expected, actual)
+        variance = state['m2'] / np.maximum(count, 1)
+        mean_shift = np.divide(state['mean'] - self.reference_mean, self.reference_std,
+                               out=np.zeros(len(count)), where=self.reference_std > 0)
+        
+        features = {}
+        for column, name in enumerate(self.feature_names):
+            if count[column] < MIN_ROWS:
+                status = 'insufficient_data'
+            elif psi[column] >= PSI_DRIFT:
+                status = 'drift'
+            elif psi[column] >= PSI_WARNING:
+                status = 'warning'
+            else:
+                status = 'stable'
+            seen = count[column] > 0
+            features[name] = {
+                'status': status,
+                'count': int(count[column]),
+                'missing': int(state['missing'][column]),
+                'below_training_range': int(state['below_range'][column]),
+                'above_training_range': int(state['above_range'][column]),
+                'mean': float(state['mean'][column]) if seen else None,
+                'std': float(np.sqrt(variance[column])) if seen else None,
+                'min': float(state['min'][column]) if seen else None,
+                'max': float(state['max'][column]) if seen else None,
+                'training_mean': float(self.reference_mean[column]),
+                'training_std': float(self.reference_std[column]),
+                'mean_shift': float(mean_shift[column]),
+                'psi': float(psi[column]),
+                'ks': float(ks[column])
+            }
+        
+        return {
+            'format_version': REFERENCE_VERSION,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'started_at': started_at,
+            'model_version': self.model_version,
+            'rows': state['rows'],
+            'thresholds': {'psi_warning': PSI_WARNING, 'psi_drift': PSI_DRIFT, 'min_rows': MIN_ROWS},
+            'drifted_features': [name for name, entry in features.items() if entry['status'] == 'drift'],
+            'warning_features': [name for name, entry in features.items() if entry['status'] == 'warning'],
+            'max_psi': float(psi.max(initial=0.0)),
+            'features': features,
+            'state': {key: value.tolist() if isinstance(value, np.ndarray) else value for key, value in state.items()}
+        }
+    
+    def write_snapshot(self, path):
+        """
+        Write a snapshot to a JSON file
+        
+        Parameters:
+        path (str): Output file
+        
+        Returns:
+        dict: The snapshot that was written
+        """
+        snapshot = self.snapshot()
+        with open(path, "w") as f:
+            json.dump(snapshot, f, indent=2)
+        return snapshot
+    
+    @classmethod
+    def from_snapshot(cls, reference, snapshot):
+        """
+        Restore a monitor, e.g. to keep accumulating after a restart
+        
+        Parameters:
+        reference (dict): Reference the snapshot was taken against
+        snapshot (dict): Snapshot from snapshot or write_snapshot
+        
+        Returns:
+        DriftMonitor: Monitor holding the snapshot's statistics
+        """
+        monitor = cls(reference, snapshot.get('model_version'))
+        state = {key: np.asarray(value) if isinstance(value, list) else value
+                 for key, value in snapshot['state'].items()}
+        monitor._merge_state(state)
+        monitor.started_at = snapshot['started_at']
+        return monitor
+
+def load_monitor(model_dir='models'):
+    """
+    Create a drift monitor for the models saved in a directory
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    
+    Returns:
+    DriftMonitor: Empty monitor, or None if the models were saved without a
+                  drift reference
+    """
+    from model_registry import read_manifest
+    
+    reference = load_reference(model_dir)
+    if reference is None:
+        return None
+    return DriftMonitor(reference, read_manifest(model_dir)[1])
+
+if __name__ == "__main__":
+    from chunked_io import iter_csv_chunks
+    from feature_encoder import get_feature_encoder
+    
+    parser = argparse.ArgumentParser(description="Check patient CSV files for drift against the training data")
+    parser.add_argument('data', nargs='+', help="Patient CSV files, scanned chunk by chunk")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--chunksize', type=int, default=100000, help="Rows read at a time")
+    parser.add_argument('--output', default='drift_snapshot.json', help="Write the snapshot to this JSON file")
+    args = parser.parse_args()
+    
+    monitor = load_monitor(args.model_dir)
+    if monitor is None:
+        raise SystemExit(f"No {DRIFT_REFERENCE_FILE} saved with the models in {args.model_dir}")
+    
+    encoder = get_feature_encoder(monitor.feature_names)
+    for path in args.data:
+        for chunk in iter_csv_chunks(path, chunksize=args.chunksize):
+            monitor.update(encoder.encode(chunk))
+    
+    snapshot = monitor.write_snapshot(args.output)
+    for name, entry in snapshot['features'].items():
+        print(f"{name}: {entry['status']}, PSI {entry['psi']:.3f}, KS {entry['ks']:.3f}, "
+              f"mean shift {entry['mean_shift']:+.2f} sd, missing {entry['missing']}")
+    print(f"{snapshot['rows']} rows, drifted features: {', '.join(snapshot['drifted_features']) or 'none'}")
@@ -0,0 +1,461 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.metrics import accuracy_score, f1_score, mean_squared_error, precision_score, r2_score, recall_score
+from sklearn.metrics import roc_auc_score
+from feature_encoder import get_feature_encoder
+from predict import TASKS, load_models, predict_encoded, scale_features
+from train_models import TASK_TARGETS
+import profiling
+
+ENSEMBLE_FILE = 'ensemble.json'
+
+# Models from cheapest to most expensive to score: the linear models are one
+# dot product (or one fused matrix multiply for all of them), XGBoost walks
+# shallow trees, the random forests walk 100 deep trees and KNN searches the
+# whole training set
+COST_ORDER = ['logistic_regression', 'linear_regression', 'xgboost', 'random_forest', 'knn']
+
+# The mortality cascade stops for a patient once the ensemble probability so
+# far is at least this far on one side, i.e. p >= confidence or p <= 1 - confidence
+DEFAULT_CONFIDENCE = 0.8
+
+# Stacked weights below this are set to zero
+MIN_WEIGHT = 1e-4
+
+def cost_order(model_names):
+    """
+    Sort model names from cheapest to most expensive to score
+    
+    Parameters:
+    model_names (iterable): Model names of one task
+    
+    Returns:
+    list: Names in COST_ORDER, unknown models last
+    """
+    rank = {name: i for i, name in enumerate(COST_ORDER)}
+    return sorted(model_names, key=lambda name: rank.get(name, len(COST_ORDER)))
+
+def average_config(models, weights=None, confidence=DEFAULT_CONFIDENCE, cascade=False):
+    """
+    Build an averaging ensemble over the loaded models
+    
+    Parameters:
+    models (dict): Models as returned by load_models
+    weights (dict): Optional {task: {model: weight}}; models without a weight
+                    get 1, so None averages every model equally
+    confidence (float): Early-exit threshold of the mortality cascade
+    cascade (bool): Turn the mortality cascade on; it trades some accuracy for
+                    speed, see evaluate_cascade
+    
+    Returns:
+    dict: Ensemble configuration
+    """
+    weights = weights or {}
+    return {
+        'method': 'average',
+        'cascade': bool(cascade),
+        'confidence': confidence,
+        'weights': {task: {name: float(weights.get(task, {}).get(name, 1.0)) for name in models.get(task, {})}
+                    for task in TASKS}
+    }
+
+def stacking_weights(task, predictions, y):
+    """
+    Learn convex combination weights of a task's models on held-out data
+    
+    Classification weights minimize the log loss of the weighted average
+    probability, regression weights the squared error of the weighted
+    average. Weights are non-negative and sum to 1, so any prefix of the
+    models in cost order is again a valid (renormalized) ensemble, which the
+    cascade relies on.
+    
+    Parameters:
+    task (str): Prediction task name
+    predictions (dict): {model: predicted probabilities or values} on the held-out rows
+    y (np.ndarray): Held-out targets
+    
+    Returns:
+    dict: {model: weight}
+    """
+    from scipy.optimize import minimize
+    
+    names = list(predictions)
+    P = np.column_stack([predictions[name] for name in names])
+    y = np.asarray(y, dtype=np.float64)
+    
+    if task == 'mortality_classification':
+        def loss(w):
+            p = np.clip(P @ w, 1e-12, 1 - 1e-12)
+            return -np.mean(y * np.log(p) + (1 - y) * np.log(1 - p))
+    else:
+        def loss(w):
+            return np.mean((P @ w - y) ** 2)
+    
+    start = np.full(len(names), 1 / len(names))
+    result = minimize(loss, start, method='SLSQP', bounds=[(0, 1)] * len(names),
+                      constraints=[{'type': 'eq', 'fun': lambda w: w.sum() - 1}])
+    # Drop models the optimizer left at (numerically) zero, so they are never scored
+    weights = np.where(result.x > MIN_WEIGHT, result.x, 0.0)
+    weights /= weights.sum()
+    return {name: float(w) for name, w in zip(names, weights)}
+
+def fit_ensemble(models, data, method='stacked', confidence=DEFAULT_CONFIDENCE, cascade=False):
+    """
+    Build an ensemble configuration, learning stacked weights on held-out data
+    
+    Parameters:
+    models (dict): Models as returned by load_models
+    data (pd.DataFrame): Held-out patients including the target columns; use
+                         rows the models were not trained on
+    method (str): 'stacked' learns weights, 'average' weighs models equally
+    confidence (float): Early-exit threshold of the mortality cascade
+    cascade (bool): Turn the mortality cascade on, see average_config
+    
+    Returns:
+    dict: Ensemble configuration
+    """
+    config = average_config(models, confidence=confidence, cascade=cascade)
+    if method == 'average':
+        return config
+    
+    X = get_feature_encoder(models['feature_names']).encode(data)
+    predictions = predict_encoded(X, models)
+    config['method'] = 'stacked'
+    for task in TASKS:
+        task_predictions = {name: values['probability'] if isinstance(values, dict) else values
+                            for name, values in predictions[task].items()}
+        if task_predictions:
+            config['weights'][task] = stacking_weights(task, task_predictions, data[TASK_TARGETS[task]].to_numpy())
+    return config
+
+def save_ensemble(config, model_dir='models'):
+    """
+    Save an ensemble configuration next to the models
+    
+    Parameters:
+    config (dict): Ensemble configuration
+    model_dir (str): Directory containing saved models
+    """
+    with open(os.path.join(model_dir, ENSEMBLE_FILE), "w") as f:
+        json.dump(config, f, indent=2)
+    print(f"Ensemble configuration saved to {os.path.join(model_dir, ENSEMBLE_FILE)}")
+
+def load_ensemble(model_dir='models', models=None):
+    """
+    Load the ensemble configuration saved with the models
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    models (dict): Loaded models, used to build an averaging ensemble when the
+                   directory has no configuration
+    
+    Returns:
+    dict: Ensemble configuration, or None if there is neither a saved one nor models
+    """
+    path = os.path.join(model_dir, ENSEMBLE_FILE)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return average_config(models) if models is not None else None
+
+def _score(task, model_name, models, X_scaled, fused_predictions, rows):
+    """
+    Score one model on a subset of rows
+    
+    Parameters:
+    task (str): Prediction task name
+    model_name (str): Model name within the task
+    models (dict): Models as returned by load_models
+    X_scaled (np.ndarray): Scaled features of the whole batch
+    fused_predictions (dict): Output of the fused linear scorer on the whole batch
+    rows (np.ndarray): Rows to score
+    
+    Returns:
+    np.ndarray: Probabilities of class 1 for classification, else predicted values
+    """
+    if (task, model_name) in fused_predictions:
+        values = fused_predictions[(task, model_name)]
+        values = values['probability'] if isinstance(values, dict) else values
+        return values[rows]
+    
+    model = models[task][model_name]
+    with profiling.stage('predict', 'predict', task=task, model=model_name, rows=len(rows)):
+        if task == 'mortality_classification':
+            return model.predict_proba(X_scaled[rows])[:, 1]
+        return np.asarray(model.predict(X_scaled[rows]), dtype=float)
+
+def predict_ensemble_encoded(X, models, config=None, cascade=None, confidence=None, stats=None):
+    """
+    Score encoded, unscaled patient features with the ensemble
+    
+    The features are scaled once (and the linear models scored together by
+    the fused scorer, if any) and shared by every model. Models are evaluated
+    in cost order. With the cascade on, a patient leaves the mortality cascade
+    as soon as the weighted average probability of the models evaluated so
+    far is confident enough, and later (more expensive) models only score the
+    remaining patients. The cascade is off unless the configuration or the
+    caller turns it on. The regression tasks always use every weighted model.
+    
+    Parameters:
+    X (np.ndarray): Features in the column order of models['feature_names']
+    models (dict): Models as returned by load_models
+    config (dict): Ensemble configuration, None averages every model
+    cascade (bool): Stop early for confident mortality predictions, defaults
+                    to the configuration's
+    confidence (float): Early-exit threshold, defaults to the configuration's
+    stats (dict): If given, filled with the rows scored and seconds spent per
+                  '<task>.<model>'
+    
+    Returns:
+    dict: Per task the ensemble prediction: {'class', 'probability',
+          'models_used'} arrays for classification, an array of values for regression
+    """
+    config = config or average_config(models)
+    if cascade is None:
+        cascade = config.get('cascade', False)
+    if confidence is None:
+        confidence = config.get('confidence', DEFAULT_CONFIDENCE)
+    n_rows = len(X)
+    
+    start = time.perf_counter()
+    fused = models.get('fused_linear')
+    fused_predictions = fused.predict(X) if fused is not None else {}
+    X_scaled = scale_features(models['scaler'], X)
+    shared_seconds = time.perf_counter() - start
+    if stats is not None:
+        stats.setdefault('shared', {'rows': 0, 'seconds': 0.0})
+        stats['shared']['rows'] += n_rows
+        stats['shared']['seconds'] += shared_seconds
+    
+    predictions = {}
+    for task in TASKS:
+        weights = {name: w for name, w in config['weights'].get(task, {}).items()
+                   if w > 0 and name in models.get(task, {})}
+        order = cost_order(weights)
+        if not order:
+            continue
+        
+        total = np.zeros(n_rows)
+        weight_sum = np.zeros(n_rows)
+        models_used = np.zeros(n_rows, dtype=int)
+        active = np.arange(n_rows)
+        classify = task == 'mortality_classification'
+        
+        for stage, name in enumerate(order):
+            start = time.perf_counter()
+            values = _score(task, name, models, X_scaled, fused_predictions, active)
+            if stats is not None:
+                entry = stats.setdefault(f"{task}.{name}", {'rows': 0, 'seconds': 0.0})
+                entry['rows'] += len(active)
+                entry['seconds'] += time.perf_counter() - start
+            
+            total[active] += weights[name] * values
+            weight_sum[active] += weights[name]
+            models_used[active] += 1
+            
+            if classify and cascade and stage < len(order) - 1:
+                prob = total[active] / weight_sum[active]
+                confident = np.maximum(prob, 1 - prob) >= confidence
+                active = active[~confident]
+                if not len(active):
+                    break
+        
+        combined = total / weight_sum
+        if classify:
+            predictions[task] = {'class': (combined >= 0.5).astype(int), 'probability': combined,
+                                 'models_used': models_used}
+        else:
+            predictions[task] = combined
+    
+    return predictions
+
+@profiling.profiled()
+def predict_ensemble(data, models, config=None, cascade=None, confidence=None, stats=None):
+    """
+    Predict outcomes of a batch of patients with the ensemble
+    
+    Parameters:
+    data (pd.DataFrame, list or dict): Patient records, or a single record
+    models (dict): Models as returned by load_models
+    config (dict): Ensemble configuration, None averages every model
+    cascade (bool): Stop early for confident mortality predictions, defaults
+                    to the configuration's
+    confidence (float): Early-exit threshold, defaults to the configuration's
+    stats (dict): Filled with per-model work, see predict_ensemble_encoded
+    
+    Returns:
+    dict: Ensemble predictions, see predict_ensemble_encoded
+    """
+    with profiling.stage('encode'):
+        X = get_feature_encoder(models['feature_names']).encode(data)
+    return predict_ensemble_encoded(X, models, config, cascade, confidence, stats)
+
+def split_ensemble_predictions(predictions, n_rows):
+    """
+    Split ensemble predictions into one dictionary per patient
+    
+    Parameters:
+    predictions (dict): Predictions as returned by predict_ensemble
+    n_rows (int): Number of patients in the batch
+    
+    Returns:
+    list: Per-patient predictions, {task: {'ensemble': ...}} in the layout of
+          predict_patient_outcomes
+    """
+    rows = [{task: {} for task in TASKS} for _ in range(n_rows)]
+    for task, values in predictions.items():
+        if isinstance(values, dict):
+            for row, pred_class, pred_prob, used in zip(rows, values['class'].tolist(),
+                                                        values['probability'].tolist(),
+                                                        values['models_used'].tolist()):
+                row[task]['ensemble'] = {'class': int(pred_class), 'probability': float(pred_prob),
+                                         'models_used': int(used)}
+        else:
+            for row, value in zip(rows, values.tolist()):
+                row[task]['ensemble'] = float(value)
+    return rows
+
+def task_metrics(task, y, values):
+    """
+    Compute the metrics train_models reports from predicted probabilities or values
+    
+    Parameters:
+    task (str): Prediction task name
+    y (np.ndarray): True targets
+    values (np.ndarray): Probabilities of class 1 for classification, else predicted values
+    
+    Returns:
+    dict: Classification or regression metrics
+    """
+    if task == 'mortality_classification':
+        pred = (values >= 0.5).astype(int)
+        return {
+            'accuracy': accuracy_score(y, pred),
+            'auroc': roc_auc_score(y, values),
+            'precision': precision_score(y, pred, zero_division=0),
+            'recall': recall_score(y, pred, zero_division=0),
+            'f1': f1_score(y, pred, zero_division=0)
+        }
+    return {
+        'mse': mean_squared_error(y, values),
+        'r2': r2_score(y, values)
+    }
+
+def evaluate_cascade(data, models, config=None, confidence=None, repeats=3):
+    """
+    Compare the cascade against scoring every model of the ensemble
+    
+    Parameters:
+    data (pd.DataFrame): Patients including the target columns
+    models (dict): Models as returned by load_models
+    config (dict): Ensemble configuration, None averages every model
+    confidence (float): Early-exit threshold, defaults to the configuration's
+    repeats (int): Timed runs of each mode; the fastest counts
+    
+    Returns:
+    dict: Work and time of both modes, the savings of the cascade, ensemble
+          and single-model metrics, and the cascade's metric deltas
+    """
+    config = config or average_config(models)
+    if confidence is None:
+        confidence = config.get('confidence', DEFAULT_CONFIDENCE)
+    X = get_feature_encoder(models['feature_names']).encode(data)
+    
+    # Warm up lazily loaded models so neither mode pays for loading them
+    predict_ensemble_encoded(X[:1], models, config, cascade=False)
+    
+    runs = {}
+    for mode, cascade in (('all_models', False), ('cascade', True)):
+        best = None
+        for _ in range(repeats):
+            stats = {}
+            start = time.perf_counter()
+            predictions = predict_ensemble_encoded(X, models, config, cascade, confidence, stats)
+            seconds = time.perf_counter() - start
+            if best is None or seconds < best[0]:
+                best = (seconds, predictions, stats)
+        runs[mode] = best
+    
+    task = 'mortality_classification'
+    y = data[TASK_TARGETS[task]].to_numpy()
+    full, cascaded = runs['all_models'][1][task], runs['cascade'][1][task]
+    n_stages = int(full['models_used'].max())
+    
+    # The cascade only changes the mortality models; compare their work alone
+    def mortality_work(stats):
+        entries = [entry for key, entry in stats.items() if key.startswith(f"{task}.")]
+        return sum(entry['rows'] for entry in entries), sum(entry['seconds'] for entry in entries)
+    
+    full_rows, full_seconds = mortality_work(runs['all_models'][2])
+    cascade_rows, cascade_seconds = mortality_work(runs['cascade'][2])
+    
+    full_metrics = task_metrics(task, y, full['probability'])
+    cascade_metrics = task_metrics(task, y, cascaded['probability'])
+    single = predict_encoded(X, models)[task]
+    
+    return {
+        'rows': len(X),
+        'method': config['method'],
+        'confidence': confidence,
+        'weights': config['weights'][task],
+        'exit_fraction_by_models_used': {str(k): float(np.mean(cascaded['models_used'] == k))
+                                         for k in range(1, n_stages + 1)},
+        'mean_models_used': float(cascaded['models_used'].mean()),
+        'model_rows_scored': {'all_models': full_rows, 'cascade': cascade_rows},
+        'model_rows_saved': 1 - cascade_rows / full_rows,
+        'mortality_model_seconds': {'all_models': full_seconds, 'cascade': cascade_seconds},
+        'mortality_model_speedup': full_seconds / cascade_seconds if cascade_seconds else None,
+        'total_seconds': {'all_models': runs['all_models'][0], 'cascade': runs['cascade'][0]},
+        'class_agreement': float(np.mean(full['class'] == cascaded['class'])),
+        'max_probability_difference': float(np.max(np.abs(full['probability'] - cascaded['probability']))),
+        'metrics': {
+            'all_models': full_metrics,
+            'cascade': cascade_metrics,
+            'delta': {name: cascade_metrics[name] - value for name, value in full_metrics.items()},
+            'single_models': {name: task_metrics(task, y, values['probability']) for name, values in single.items()}
+        },
+        'regression_metrics': {
+            other: task_metrics(other, data[TASK_TARGETS[other]].to_numpy(), runs['all_models'][1][other])
+            for other in TASKS if other != task and other in runs['all_models'][1]
+        }
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit and benchmark the ensemble and its early-exit cascade")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--data', default=None, help="Held-out patient CSV with targets, generated if omitted")
+    parser.add_argument('--n-samples', type=int, default=2000, help="Number of samples to generate without --data")
+    parser.add_argument('--method', default='stacked', choices=['stacked', 'average'],
+                        help="Learn the weights on --data, or weigh the models equally")
+    parser.add_argument('--confidence', type=float, default=DEFAULT_CONFIDENCE,
+                        help="Early-exit threshold of the mortality cascade")
+    parser.add_argument('--cascade', action='store_true',
+                        help="Turn the early-exit cascade on in the saved configuration (costs some AUROC)")
+    parser.add_argument('--save', action='store_true', help=f"Save the configuration to <model-dir>/{ENSEMBLE_FILE}")
+    parser.add_argument('--output', default=None, help="Write the cascade report to this JSON file")
+    args = parser.parse_args()
+    
+    if args.data:
+        data = pd.read_csv(args.data)
+    else:
+        from generate_data import generate_sample_data
+        # A different seed than training, so the weights are learnt on unseen patients
+        data = generate_sample_data(args.n_samples, seed=7)
+    
+    models = load_models(args.model_dir)
+    # Learn the weights on one half and report on the other
+    fit_rows = data.sample(frac=0.5, random_state=0)
+    report_rows = data.drop(fit_rows.index)
+    config = fit_ensemble(models, fit_rows, method=args.method, confidence=args.confidence, cascade=args.cascade)
+    if args.save:
+        save_ensemble(config, args.model_dir)
+    
+    report = evaluate_cascade(report_rows, models, config)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,539 @@
+import re
+import json
+import time
+import argparse
+import numpy as np
+from joblib import Parallel, delayed
+from feature_encoder import get_feature_encoder
+from predict import TASKS, load_models, predict_encoded, scale_features
+from prediction_cache import PredictionCache, models_cache_key
+from train_models import resolve_n_jobs
+import profiling
+
+# Smallest number of rows per TreeSHAP task sent to a worker process. Exact
+# TreeSHAP over 100 fully grown trees takes 0.1-0.5 s per row, so a few rows
+# already outweigh sending the forest to a worker; smaller batches are
+# explained in-process
+DEFAULT_BLOCK_ROWS = 16
+
+# Parent of the root node in XGBoost's JSON model format
+_NO_PARENT = 2147483647
+
+def _is_forest(model):
+    return hasattr(model, 'estimators_') and hasattr(getattr(model, 'estimators_')[0], 'tree_')
+
+def _is_xgboost(model):
+    return hasattr(model, 'get_booster')
+
+def _is_linear(model):
+    return hasattr(model, 'coef_') and hasattr(model, 'intercept_')
+
+def is_explainable(model):
+    """
+    Check whether per-patient attributions can be computed for a model
+    
+    KNN models and compiled or approximate artifacts (tree_compiler,
+    knn_index) have no attributions; explain them through the exact models
+    loaded with the default load_models options.
+    
+    Parameters:
+    model (object): Fitted model
+    
+    Returns:
+    bool: True for sklearn random forests, XGBoost and linear models
+    """
+    return _is_forest(model) or _is_xgboost(model) or _is_linear(model)
+
+def output_space(model, task):
+    """
+    Name the scale the attributions of a model add up to
+    
+    Parameters:
+    model (object): Explainable model
+    task (str): Prediction task name
+    
+    Returns:
+    str: 'probability' for random forest classifiers, 'log_odds' for the other
+         classifiers and 'value' for regressors
+    """
+    if task != 'mortality_classification':
+        return 'value'
+    return 'probability' if _is_forest(model) else 'log_odds'
+
+def linear_contributions(model, X_scaled):
+    """
+    Exact attributions of a linear or logistic regression
+    
+    The scaled training features have mean zero, so coefficient times scaled
+    value is each feature's contribution relative to the average training
+    patient and the intercept is the prediction for that patient.
+    
+    Parameters:
+    model (object): Fitted model with coef_ and intercept_
+    X_scaled (np.ndarray): Scaled features
+    
+    Returns:
+    tuple: (contributions (n_rows, n_features), bias (n_rows,)) in the model's
+           output space, log-odds for classifiers
+    """
+    coef = np.ravel(model.coef_)
+    intercept = float(np.ravel(model.intercept_)[0])
+    contributions = np.asarray(X_scaled, dtype=np.float64) * coef
+    return contributions, np.full(len(contributions), intercept)
+
+def xgboost_contributions(model, X_scaled):
+    """
+    TreeSHAP attributions of an XGBoost model from its built-in pred_contribs
+    
+    Parameters:
+    model (xgb.XGBClassifier or xgb.XGBRegressor): Fitted model
+    X_scaled (np.ndarray): Scaled features
+    
+    Returns:
+    tuple: (contributions, bias) in margin space, log-odds for classifiers
+    """
+    import xgboost as xgb
+    
+    contributions = model.get_booster().predict(xgb.DMatrix(X_scaled), pred_contribs=True)
+    return contributions[:, :-1].astype(np.float64), contributions[:, -1].astype(np.float64)
+
+def _breadth_first(left, right):
+    # XGBoost's TreeSHAP expects nodes numbered level by level
+    order = [np.zeros(1, dtype=np.int64)]
+    frontier = order[0]
+    while len(frontier):
+        internal = frontier[left[frontier] >= 0]
+        frontier = np.column_stack([left[internal], right[internal]]).ravel()
+        order.append(frontier)
+    return np.concatenate(order)
+
+def _forest_tree(tree, is_classifier, n_trees, tree_id):
+    left = tree.children_left.astype(np.int64)
+    right = tree.children_right.astype(np.int64)
+    if is_classifier:
+        counts = tree.value[:, 0, :]
+        value = counts[:, 1] / counts.sum(axis=1)
+    else:
+        value = tree.value[:, 0, 0]
+    # Leaves hold their share of the forest mean, so the trees sum to it
+    value = value / n_trees
+    
+    # sklearn sends x <= threshold left, XGBoost x < condition on float32
+    # features, so the condition is the next float32 above the threshold
+    # rounded down to float32 (the same rounding as tree_compiler)
+    threshold = tree.threshold.astype(np.float32)
+    rounded_up = threshold > tree.threshold
+    threshold[rounded_up] = np.nextafter(threshold[rounded_up], np.float32(-np.inf))
+    condition = np.nextafter(threshold, np.float32(np.inf))
+    default_left = getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=np.uint8))
+    
+    order = _breadth_first(left, right)
+    new_id = np.empty_like(order)
+    new_id[order] = np.arange(len(order))
+    left, right = left[order], right[order]
+    is_leaf = left < 0
+    left = np.where(is_leaf, -1, new_id[np.maximum(left, 0)])
+    right = np.where(is_leaf, -1, new_id[np.maximum(right, 0)])
+    parents = np.full(len(order), _NO_PARENT, dtype=np.int64)
+    parents[left[~is_leaf]] = np.flatnonzero(~is_leaf)
+    parents[right[~is_leaf]] = np.flatnonzero(~is_leaf)
+    value = value[order]
+    n_nodes = len(order)
+    
+    return {
+        'base_weights': value.tolist(),
+        'categories': [], 'categories_nodes': [], 'categories_segments': [], 'categories_sizes': [],
+        'default_left': np.asarray(default_left, dtype=int)[order].tolist(),
+        'id': tree_id,
+        'left_children': left.tolist(),
+        'right_children': right.tolist(),
+        'loss_changes': [0.0] * n_nodes,
+        'parents': parents.tolist(),
+        # For leaves XGBoost stores the leaf value in split_conditions
+        'split_conditions': np.where(is_leaf, value, condition[order].astype(np.float64)).tolist(),
+        'split_indices': np.where(is_leaf, 0, tree.feature[order]).tolist(),
+        'split_type': [0] * n_nodes,
+        # TreeSHAP weighs the branches by their cover, as shap does for sklearn trees
+        'sum_hessian': tree.weighted_n_node_samples[order].tolist(),
+        'tree_param': {'num_deleted': '0', 'num_feature': str(tree.n_features), 'num_nodes': str(n_nodes),
+                       'size_leaf_vector': '1'}
+    }
+
+def forest_to_booster(model):
+    """
+    Convert a fitted sklearn random forest into an equivalent XGBoost booster
+    
+    The booster predicts the forest's mean (the positive-class probability
+    for classifiers) with a base score of zero, so its pred_contribs are the
+    path-dependent TreeSHAP values of the forest, computed by XGBoost's native
+    implementation.
+    
+    Parameters:
+    model (RandomForestClassifier or RandomForestRegressor): Fitted forest
+                                                             (binary classifier or regressor)
+    
+    Returns:
+    xgb.Booster: Booster with one tree per estimator
+    """
+    import xgboost as xgb
+    
+    is_classifier = hasattr(model, 'classes_')
+    n_trees = len(model.estimators_)
+    n_features = str(model.n_features_in_)
+    trees = [_forest_tree(estimator.tree_, is_classifier, n_trees, i) for i, estimator in enumerate(model.estimators_)]
+    
+    document = {
+        'learner': {
+            'attributes': {},
+            'feature_names': [],
+            'feature_types': [],
+            'gradient_booster': {
+                'name': 'gbtree',
+                'model': {
+                    'cats': {'enc': [], 'feature_segments': [], 'sorted_idx': []},
+                    'gbtree_model_param': {'num_parallel_tree': '1', 'num_trees': str(n_trees)},
+                    'iteration_indptr': list(range(n_trees + 1)),
+                    'tree_info': [0] * n_trees,
+                    'trees': trees
+                }
+            },
+            'learner_model_param': {'base_score': '0', 'boost_from_average': '0', 'num_class': '0',
+                                    'num_feature': n_features, 'num_target': '1'},
+            'objective': {'name': 'reg:squarederror', 'reg_loss_param': {'scale_pos_weight': '1'}}
+        },
+        'version': [int(part) for part in re.findall(r'\d+', xgb.__version__)[:3]]
+    }
+    
+    booster = xgb.Booster()
+    booster.load_model(bytearray(json.dumps(document).encode('utf-8')))
+    return booster
+
+def _tree_shap_block(booster, X):
+    import xgboost as xgb
+    
+    # One thread per worker process; the pool provides the parallelism
+    booster.set_param({'nthread': 1})
+    return booster.predict(xgb.DMatrix(X), pred_contribs=True)
+
+def forest_contributions(booster, X_scaled, n_jobs=1, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Batched TreeSHAP attributions of a random forest converted with forest_to_booster
+    
+    Batches of more than block_rows rows are split into one block per worker
+    and explained across a joblib process pool.
+    
+    Parameters:
+    booster (xgb.Booster): Converted forest
+    X_scaled (np.ndarray): Scaled features
+    n_jobs (int): Worker processes, see train_models.resolve_n_jobs
+    block_rows (int): Smallest number of rows per worker
+    
+    Returns:
+    tuple: (contributions, bias), probabilities for classifiers
+    """
+    import xgboost as xgb
+    
+    X_scaled = np.asarray(X_scaled, dtype=np.float32)
+    n_blocks = min(resolve_n_jobs(n_jobs), len(X_scaled) // block_rows)
+    if n_blocks <= 1:
+        contributions = booster.predict(xgb.DMatrix(X_scaled), pred_contribs=True)
+    else:
+        blocks = Parallel(n_jobs=n_blocks)(
+            delayed(_tree_shap_block)(booster, block) for block in np.array_split(X_scaled, n_blocks)
+        )
+        contributions = np.concatenate(blocks)
+    return contributions[:, :-1].astype(np.float64), contributions[:, -1].astype(np.float64)
+
+class Explainer:
+    """
+    Per-patient feature attributions for a set of loaded models
+    
+    For each model, the bias plus the feature contributions of a patient
+    add up to the model's prediction for that patient (in log-odds for XGBoost
+    and logistic regression, see output_space). Random forests are converted
+    to XGBoost boosters on first use and kept for later calls. With a cache,
+    patients explained before by the same model version are answered from it.
+    Explanations are cached under their own models key, so a cache shared
+    with predict_patients never returns one for the other; as a cache holds
+    one models key at a time, give the explainer a cache of its own.
+    Rows and seconds spent are counted per model, see stats.
+    """
+    
+    def __init__(self, models, n_jobs=1, block_rows=DEFAULT_BLOCK_ROWS, cache=None):
+        self.models = models
+        self.n_jobs = n_jobs
+        self.block_rows = block_rows
+        self.cache = cache
+        self.rows = {}
+        self.seconds = {}
+        self._boosters = {}
+    
+    @property
+    def feature_names(self):
+        return self.models['feature_names']
+    
+    def _forest_booster(self, task, model_name, model):
+        key = (task, model_name)
+        if key not in self._boosters:
+            with profiling.stage('convert_forest', 'explain', task=task, model=model_name):
+                self._boosters[key] = forest_to_booster(model)
+        return self._boosters[key]
+    
+    def explain_encoded(self, X):
+        """
+        Attribute the predictions for a matrix of encoded, unscaled features
+        
+        Parameters:
+        X (np.ndarray): Features in the column order of feature_names
+        
+        Returns:
+        dict: {task: {model: {'contributions': (n_rows, n_features) array,
+              'bias': (n_rows,) array, 'output': output space}}} for every
+              explainable model
+        """
+        X_scaled = scale_features(self.models['scaler'], X)
+        
+        explanations = {}
+        for task in TASKS:
+            task_models = self.models.get(task, {})
+            for model_name in task_models:
+                if model_name == 'knn':
+                    # Not loaded at all, KNN has no attributions
+                    continue
+                model = task_models[model_name]
+                if not is_explainable(model):
+                    continue
+                
+                if _is_forest(model):
+                    booster = self._forest_booster(task, model_name, model)
+                
+                start = time.perf_counter()
+                with profiling.stage('explain', 'explain', task=task, model=model_name, rows=len(X)):
+                    if _is_forest(model):
+                        contributions, bias = forest_contributions(booster, X_scaled, self.n_jobs, self.block_rows)
+                    elif _is_xgboost(model):
+                        contributions, bias = xgboost_contributions(model, X_scaled)
+                    else:
+                        contributions, bias = linear_contributions(model, X_scaled)
+                name = f"{task}.{model_name}"
+                self.rows[name] = self.rows.get(name, 0) + len(X)
+                self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+                
+                explanations.setdefault(task, {})[model_name] = {
+                    'contributions': contributions,
+                    'bias': bias,
+                    'output': output_space(model, task)
+                }
+        
+        return explanations
+    
+    def split(self, explanations, n_rows):
+        """
+        Split batch explanations into one dictionary per patient
+        
+        Parameters:
+        explanations (dict): Explanations as returned by explain_encoded
+        n_rows (int): Number of patients in the batch
+        
+        Returns:
+        list: Per-patient {task: {model: {'bias': float, 'output': str,
+              'contributions': {feature: float}}}}
+        """
+        rows = [{} for _ in range(n_rows)]
+        for task, task_explanations in explanations.items():
+            for model_name, explanation in task_explanations.items():
+                for row, contributions, bias in zip(rows, explanation['contributions'].tolist(),
+                                                    explanation['bias'].tolist()):
+                    row.setdefault(task, {})[model_name] = {
+                        'bias': bias,
+                        'output': explanation['output'],
+                        'contributions': dict(zip(self.feature_names, contributions))
+                    }
+        return rows
+    
+    def explain(self, data):
+        """
+        Explain the predictions for a batch of patients
+        
+        Parameters:
+        data (pd.DataFrame or list): Patient records as a DataFrame or a list of dictionaries
+        
+        Returns:
+        list: Per-patient explanations in the format of split
+        """
+        X = get_feature_encoder(self.feature_names).encode(data)
+        models_key = models_cache_key(self.models)
+        if self.cache is None or models_key is None:
+            return self.split(self.explain_encoded(X), len(X))
+        # Predictions are cached under the plain key
+        models_key = models_key + ('explain',)
+        
+        keys = self.cache.row_keys(X)
+        results = self.cache.get_many(keys, models_key)
+        missing = [row for row, result in enumerate(results) if result is None]
+        if missing:
+            # Keep the encoder's column-major layout, see FeatureEncoder.allocate
+            X_missing = X if len(missing) == len(X) else np.asfortranarray(X[missing])
+            explained = self.split(self.explain_encoded(X_missing), len(missing))
+            self.cache.put_many([keys[row] for row in missing], explained, models_key)
+            for row, result in zip(missing, explained):
+                results[row] = result
+        
+        return [_copy_explanation(result) for result in results]
+    
+    def stats(self):
+        """
+        Summarize the counters
+        
+        Returns:
+        dict: JSON-serializable rows, seconds and rows per second per
+              '<task>.<model>', plus the cache statistics when caching is on
+        """
+        models = {name: {'rows': rows, 'seconds': self.seconds[name],
+                         'rows_per_second': rows / self.seconds[name] if self.seconds[name] else None}
+                  for name, rows in self.rows.items()}
+        stats = {'models': models}
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+    
+    def reset_stats(self):
+        """
+        Zero the per-model counters
+        """
+        self.rows.clear()
+        self.seconds.clear()
+
+def _copy_explanation(explanation):
+    return {task: {name: dict(value, contributions=dict(value['contributions'])) for name, value in task_explanations.items()}
+            for task, task_explanations in explanation.items()}
+
+def explain_patient(patient_data, models=None, model_dir='models', explainer=None):
+    """
+    Explain the predictions for one patient
+    
+    Parameters:
+    patient_data (dict): Patient data as a dictionary
+    models (dict): Dictionary containing models, if None, loads from files
+    model_dir (str): Directory containing saved models
+    explainer (Explainer): Explainer to reuse (and its cache); one is created
+                           for the models if None
+    
+    Returns:
+    dict: {task: {model: {'bias', 'output', 'contributions'}}}
+    """
+    if explainer is None:
+        explainer = Explainer(models if models is not None else load_models(model_dir))
+    return explainer.explain([patient_data])[0]
+
+def additivity_error(explanations, predictions):
+    """
+    Check that the attributions add up to the predictions
+    
+    Parameters:
+    explanations (dict): Explanations as returned by Explainer.explain_encoded
+    predictions (dict): Predictions for the same rows as returned by predict_encoded
+    
+    Returns:
+    dict: Largest absolute difference per '<task>.<model>'
+    """
+    errors = {}
+    for task, task_explanations in explanations.items():
+        for model_name, explanation in task_explanations.items():
+            total = explanation['contributions'].sum(axis=1) + explanation['bias']
+            predicted = predictions[task][model_name]
+            if isinstance(predicted, dict):
+                probability = np.clip(predicted['probability'], 1e-15, 1 - 1e-15)
+                predicted = probability if explanation['output'] == 'probability' else np.log(probability / (1 - probability))
+            errors[f"{task}.{model_name}"] = float(np.max(np.abs(total - predicted), initial=0.0))
+    return errors
+
+def benchmark_explanations(models, records, n_jobs=1, n_single=10, repeats=3, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Measure explanation throughput
+    
+    Compares the batched engine against explaining one patient per call (the
+    naive per-request approach), and the same batch answered from the cache.
+    Exact TreeSHAP over large forests is slow, so the batch is explained once;
+    only the cached lookups are repeated.
+    
+    Parameters:
+    models (dict): Dictionary containing models, as returned by load_models
+    records (list): Patient dictionaries
+    n_jobs (int): Worker processes for the random forests
+    n_single (int): Patients explained one at a time
+    repeats (int): Timed runs of the cached lookup; the fastest counts
+    block_rows (int): Smallest number of rows per TreeSHAP worker
+    
+    Returns:
+    dict: Rows per second overall and per model, the cache statistics and the
+          largest deviation of the attributions from the predictions
+    """
+    X = get_feature_encoder(models['feature_names']).encode(records)
+    explainer = Explainer(models, n_jobs=n_jobs, block_rows=block_rows, cache=PredictionCache(max_entries=len(X)))
+    # Load every model and convert the forests before timing
+    explainer.explain_encoded(X[:1])
+    explainer.reset_stats()
+    
+    start = time.perf_counter()
+    explainer.explain(records)
+    batch_seconds = time.perf_counter() - start
+    model_stats = explainer.stats()['models']
+    
+    cached_seconds = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        explainer.explain(records)
+        cached_seconds = min(cached_seconds, time.perf_counter() - start)
+    
+    # Bypass the cache, as a service explaining every request on its own would
+    n_single = min(n_single, len(X))
+    start = time.perf_counter()
+    for row in range(n_single):
+        explainer.split(explainer.explain_encoded(X[row:row + 1]), 1)
+    single_seconds = time.perf_counter() - start
+    
+    X_check = X[:n_single]
+    
+    return {
+        'rows': len(X),
+        'n_jobs': resolve_n_jobs(n_jobs),
+        'rows_per_second': {
+            'batch': len(X) / batch_seconds,
+            'single_patient': n_single / single_seconds,
+            'cached': len(X) / cached_seconds
+        },
+        'batch_speedup': (len(X) / batch_seconds) / (n_single / single_seconds),
+        'models': model_stats,
+        'cache': explainer.cache.stats(),
+        'additivity_error': additivity_error(explainer.explain_encoded(X_check), predict_encoded(X_check, models))
+    }
+
+if __name__ == "__main__":
+    from benchmark import sample_patients
+    
+    parser = argparse.ArgumentParser(description="Benchmark per-patient prediction explanations")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--rows', type=int, default=200, help="Patients explained per batch")
+    parser.add_argument('--single', type=int, default=10, help="Patients explained one at a time")
+    parser.add_argument('--n-jobs', type=int, default=-1, help="Worker processes for the random forests, -1 uses all cores")
+    parser.add_argument('--block-rows', type=int, default=DEFAULT_BLOCK_ROWS,
+                        help="Smallest number of rows per TreeSHAP worker")
+    parser.add_argument('--repeats', type=int, default=3, help="Timed runs of the cached lookup")
+    parser.add_argument('--output', default=None, help="Write the report to this JSON file")
+    args = parser.parse_args()
+    
+    models = load_models(args.model_dir)
+    report = benchmark_explanations(models, sample_patients(args.rows, seed=7), n_jobs=args.n_jobs,
+                                    n_single=args.single, repeats=args.repeats, block_rows=args.block_rows)
+    
+    rates = report['rows_per_second']
+    print(f"{report['rows']} patients, {report['n_jobs']} workers: batch {rates['batch']:.1f} rows/s, "
+          f"one at a time {rates['single_patient']:.1f} rows/s ({report['batch_speedup']:.1f}x), "
+          f"cached {rates['cached']:.0f} rows/s")
+    for name, entry in report['models'].items():
+        print(f"{name}: {entry['rows_per_second']:.1f} rows/s, additivity error {report['additivity_error'][name]:.2e}")
+    
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
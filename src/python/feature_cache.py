@@ -0,0 +1,213 @@
+import json
+import os
+import time
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+from model_registry import file_sha256
+from model_bundle import scaler_to_arrays, scaler_from_arrays
+
+FEATURE_CACHE_DIR = '.feature_cache'
+FEATURE_CACHE_MAX_BYTES = 2 << 30
+
+# Bump when prepare_training_data changes, so stale entries are never reused
+PREPARE_VERSION = 2
+
+FILE_HASHES = 'file_hashes.json'
+
+def cached_file_sha256(file_path, cache_dir=FEATURE_CACHE_DIR):
+    """
+    Hash a file, reusing the last hash while its size and modification time are unchanged
+    
+    Parameters:
+    file_path (str): File to hash
+    cache_dir (str): Feature cache directory holding the hash index
+    
+    Returns:
+    str: SHA-256 hex digest
+    """
+    index_path = os.path.join(cache_dir, FILE_HASHES)
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    
+    stat = os.stat(file_path)
+    key = os.path.abspath(file_path)
+    entry = index.get(key)
+    if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+    
+    digest = file_sha256(file_path)
+    index[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(index_path, "w") as f:
+        json.dump(index, f, indent=2)
+    return digest
+
+def feature_cache_key(file_hash, columns, test_size, random_state):
+    """
+    Build the content address of a prepared dataset
+    
+    Parameters:
+    file_hash (str): SHA-256 of the input file
+    columns (list): Input columns (the raw feature list and targets)
+    test_size (float): Fraction of patients held out for testing
+    random_state (int): Seed of the train/test split
+    
+    Returns:
+    str: Hex key
+    """
+    description = {'file_sha256': file_hash, 'columns': list(columns), 'test_size': test_size,
+                   'random_state': random_state, 'prepare_version': PREPARE_VERSION}
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+def save_prepared(prepared, entry_dir):
+    """
+    Store the output of prepare_training_data as .npy arrays plus a JSON description
+    
+    The entry is written to a temporary directory and renamed into place, so
+    concurrent runs never see a partial entry.
+    
+    Parameters:
+    prepared (dict): Output of prepare_training_data
+    entry_dir (str): Cache entry directory
+    """
+    from train_models import TASKS
+    
+    tmp_dir = f"{entry_dir}.tmp-{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    
+    arrays = {'X_train': prepared['X_train'], 'X_test': prepared['X_test'], 'X_train_raw': prepared['X_train_raw']}
+    arrays.update({f"scaler_{name}": np.asarray(value) for name, value in scaler_to_arrays(prepared['scaler']).items()})
+    for split in ('train', 'test'):
+        arrays[f"index_{split}"] = prepared[f"y_{split}"][TASKS[0]].index.to_numpy()
+        for task in TASKS:
+            arrays[f"y_{split}_{task}"] = prepared[f"y_{split}"][task].to_numpy()
+    
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array, allow_pickle=False)
+    
+    targets = {task: prepared['y_train'][task].name for task in TASKS}
+    with open(os.path.join(tmp_dir, 'meta.json'), "w") as f:
+        json.dump({'feature_names': prepared['feature_names'], 'targets': targets, 'created': time.time()}, f)
+    
+    try:
+        os.replace(tmp_dir, entry_dir)
+    except OSError:
+        # Another run stored the same entry first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def load_prepared(entry_dir):
+    """
+    Load a cache entry written by save_prepared
+    
+    Parameters:
+    entry_dir (str): Cache entry directory
+    
+    Returns:
+    dict: Same layout as prepare_training_data
+    """
+    from train_models import TASKS
+    
+    with open(os.path.join(entry_dir, 'meta.json'), "r") as f:
+        meta = json.load(f)
+    
+    def load(name):
+        return np.load(os.path.join(entry_dir, f"{name}.npy"), allow_pickle=False)
+    
+    prepared = {
+        'feature_names': meta['feature_names'],
+        'scaler': scaler_from_arrays({name: load(f"scaler_{name}") for name in ('mean', 'scale', 'var', 'n_samples_seen')},
+                                     meta['feature_names']),
+        'X_train': load('X_train'),
+        'X_test': load('X_test'),
+        'X_train_raw': load('X_train_raw')
+    }
+    for split in ('train', 'test'):
+        index = load(f"index_{split}")
+        prepared[f"y_{split}"] = {task: pd.Series(load(f"y_{split}_{task}"), index=index, name=meta['targets'][task])
+                                  for task in TASKS}
+    
+    # Mark the entry as recently used for eviction
+    os.utime(os.path.join(entry_dir, 'meta.json'))
+    return prepared
+
+def directory_size(path):
+    """
+    Sum the sizes of the files in a directory tree
+    
+    Parameters:
+    path (str): Directory
+    
+    Returns:
+    int: Size in bytes
+    """
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+def evict_feature_cache(cache_dir=FEATURE_CACHE_DIR, max_bytes=FEATURE_CACHE_MAX_BYTES):
+    """
+    Delete the least recently used entries until the cache fits in max_bytes
+    
+    Parameters:
+    cache_dir (str): Feature cache directory
+    max_bytes (int): Size limit of the cache
+    
+    Returns:
+    list: Keys of the deleted entries
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    
+    entries = []
+    for key in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, key, 'meta.json')
+        if os.path.exists(meta_path):
+            entries.append((os.path.getmtime(meta_path), key, directory_size(os.path.join(cache_dir, key))))
+    
+    total = sum(size for _, _, size in entries)
+    evicted = []
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+        evicted.append(key)
+    return evicted
+
+def prepare_training_file(file_path, test_size=0.2, random_state=42, cache_dir=FEATURE_CACHE_DIR,
+                          max_bytes=FEATURE_CACHE_MAX_BYTES):
+    """
+    Prepare a patient file for training, reusing the on-disk feature cache
+    
+    The cache is addressed by the file's content hash, its columns and the
+    split settings, so a repeated run on the same extract skips CSV parsing,
+    encoding, splitting and scaling and only loads the stored arrays.
+    
+    Parameters:
+    file_path (str): Patient CSV file including the target columns
+    test_size (float): Fraction of patients held out for testing
+    random_state (int): Seed of the train/test split
+    cache_dir (str): Feature cache directory
+    max_bytes (int): Size limit of the cache, older entries are evicted
+    
+    Returns:
+    dict: Same layout as prepare_training_data
+    """
+    from train_models import prepare_training_data
+    
+    columns = pd.read_csv(file_path, nrows=0).columns.tolist()
+    key = feature_cache_key(cached_file_sha256(file_path, cache_dir), columns, test_size, random_state)
+    entry_dir = os.path.join(cache_dir, key)
+    
+    if os.path.exists(os.path.join(entry_dir, 'meta.json')):
+        print(f"Loaded prepared features for {file_path} from cache {key[:12]}")
+        return load_prepared(entry_dir)
+    
+    prepared = prepare_training_data(pd.read_csv(file_path), test_size=test_size, random_state=random_state)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_prepared(prepared, entry_dir)
+    evict_feature_cache(cache_dir, max_bytes)
+    print(f"Prepared features for {file_path} and cached them as {key[:12]}")
+    return prepared
@@ -0,0 +1,192 @@
+import functools
+import numpy as np
+import pandas as pd
+
+# Patient fields one-hot encoded by pd.get_dummies at training time
+CATEGORICAL_FIELDS = ('admission_type',)
+
+class FeatureEncoder:
+    """
+    Precompiled encoder turning patient records into model feature rows
+    
+    Built once from the feature names saved with the models: numeric fields
+    map straight to their column, and every level of a categorical field to
+    the column of its one-hot dummy. Encoding writes into a preallocated
+    NumPy array instead of building and reindexing a DataFrame, and produces
+    exactly what pd.get_dummies plus column selection produced: the
+    reference level dropped at training time, unknown levels and absent
+    categorical fields all encode as zeros, and fields the models do not use
+    are ignored (or rejected with strict=True). Levels are not validated,
+    since the dropped reference level is not recorded with the feature names
+    and cannot be told apart from an unknown one.
+    """
+    
+    def __init__(self, feature_names, categorical_fields=CATEGORICAL_FIELDS, dtype=np.float64):
+        self.feature_names = list(feature_names)
+        self.dtype = dtype
+        self.levels = {field: {} for field in categorical_fields}
+        numeric = {}
+        for column, name in enumerate(self.feature_names):
+            for field in categorical_fields:
+                if name.startswith(f"{field}_"):
+                    self.levels[field][name[len(field) + 1:]] = column
+                    break
+            else:
+                numeric[name] = column
+        
+        self.numeric_fields = list(numeric)
+        self.numeric_columns = np.array(list(numeric.values()), dtype=np.intp)
+        self._numeric_items = list(numeric.items())
+        self._categorical_items = [(field, levels) for field, levels in self.levels.items() if levels]
+        self._known_fields = set(numeric) | set(categorical_fields)
+    
+    @property
+    def n_features(self):
+        return len(self.feature_names)
+    
+    def allocate(self, n_rows):
+        """
+        Allocate a zero-filled feature matrix
+        
+        Column-major like the DataFrame.to_numpy() result the models were
+        scored on before, so BLAS-backed models (the fused linear scorer) see
+        the same memory layout and return bit-identical results.
+        
+        Parameters:
+        n_rows (int): Number of patients
+        
+        Returns:
+        np.ndarray: Array of shape (n_rows, n_features)
+        """
+        return np.zeros((n_rows, self.n_features), dtype=self.dtype, order='F')
+    
+    def validate(self, record, strict=False):
+        """
+        Check a patient record for missing and (with strict=True) unknown fields
+        
+        Parameters:
+        record (dict): Patient data
+        strict (bool): Also reject fields the models do not use
+        
+        Raises:
+        KeyError: If a numeric field the models need is missing
+        ValueError: In strict mode, for unknown fields
+        """
+        missing = [field for field in self.numeric_fields if field not in record]
+        if missing:
+            raise KeyError(f"Missing patient fields: {', '.join(missing)}")
+        if strict:
+            unknown = [field for field in record if field not in self._known_fields]
+            if unknown:
+                raise ValueError(f"Unknown patient fields: {', '.join(map(str, unknown))}")
+    
+    def encode_row(self, record, out=None, strict=False):
+        """
+        Encode one patient record
+        
+        Parameters:
+        record (dict): Patient data
+        out (np.ndarray): Zero-filled row of n_features values to write into,
+                          allocated if None
+        strict (bool): Reject fields the models do not use
+        
+        Returns:
+        np.ndarray: Feature row of shape (n_features,)
+        """
+        if out is None:
+            out = np.zeros(self.n_features, dtype=self.dtype)
+        try:
+            for field, column in self._numeric_items:
+                out[column] = record[field]
+        except KeyError:
+            self.validate(record)
+            raise
+        if strict:
+            self.validate(record, strict=True)
+        
+        for field, levels in self._categorical_items:
+            value = record.get(field)
+            if not _is_missing(value):
+                column = levels.get(str(value))
+                if column is not None:
+                    out[column] = 1
+        return out
+    
+    def encode(self, data, out=None, strict=False):
+        """
+        Encode a batch of patients into a feature matrix
+        
+        Parameters:
+        data (pd.DataFrame, list or dict): Patient records, or a single record
+        out (np.ndarray): Zero-filled (n_rows, n_features) array to write into,
+                          allocated if None
+        strict (bool): Reject fields the models do not use
+        
+        Returns:
+        np.ndarray: Feature matrix of shape (n_rows, n_features)
+        """
+        if isinstance(data, pd.DataFrame):
+            return self.encode_frame(data, out=out, strict=strict)
+        if isinstance(data, dict):
+            data = [data]
+        
+        if out is None:
+            out = self.allocate(len(data))
+        for row, record in enumerate(data):
+            self.encode_row(record, out[row], strict=strict)
+        return out
+    
+    def encode_frame(self, df, out=None, strict=False):
+        """
+        Encode a DataFrame of patients column by column
+        
+        Parameters:
+        df (pd.DataFrame): Patient records, one per row
+        out (np.ndarray): Zero-filled (n_rows, n_features) array to write into,
+                          allocated if None
+        strict (bool): Reject columns the models do not use
+        
+        Returns:
+        np.ndarray: Feature matrix of shape (n_rows, n_features)
+        """
+        missing = [field for field in self.numeric_fields if field not in df.columns]
+        if missing:
+            raise KeyError(f"Missing patient fields: {', '.join(missing)}")
+        if strict:
+            unknown = [column for column in df.columns if column not in self._known_fields]
+            if unknown:
+                raise ValueError(f"Unknown patient fields: {', '.join(map(str, unknown))}")
+        
+        if out is None:
+            out = self.allocate(len(df))
+        if self.numeric_fields:
+            out[:, self.numeric_columns] = df[self.numeric_fields].to_numpy(dtype=self.dtype)
+        
+        for field, levels in self._categorical_items:
+            if field not in df.columns:
+                continue
+            values = df[field]
+            present = values.notna().to_numpy()
+            labels = values.astype(str).to_numpy()
+            for level, column in levels.items():
+                out[:, column] = present & (labels == level)
+        return out
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+@functools.lru_cache(maxsize=8)
+def _cached_encoder(feature_names):
+    return FeatureEncoder(feature_names)
+
+def get_feature_encoder(feature_names):
+    """
+    Return the encoder for a list of feature names, building it on first use
+    
+    Parameters:
+    feature_names (list): Feature names expected by the models
+    
+    Returns:
+    FeatureEncoder: Shared encoder
+    """
+    return _cached_encoder(tuple(feature_names))
@@ -0,0 +1,121 @@
+import numpy as np
+
+FUSED_LINEAR_FILE = 'fused_linear.npz'
+
+# Model types whose prediction is an affine function of the scaled features
+LINEAR_MODEL_TYPES = ('logistic_regression', 'linear_regression')
+
+class FusedLinearScorer:
+    """
+    All linear models of a bundle folded together with the StandardScaler
+    
+    For scaled features z = (x - mean) / scale, a linear model w.z + b equals
+    (w / scale).x + (b - w.(mean / scale)) on the raw features x. The fused
+    weights of every model are the columns of one matrix, so a single matrix
+    multiply scores all linear models of all tasks for a whole batch.
+    """
+    
+    def __init__(self, weights, bias, tasks, model_names, is_classifier):
+        self.weights = weights
+        self.bias = bias
+        self.tasks = [str(task) for task in tasks]
+        self.model_names = [str(name) for name in model_names]
+        self.is_classifier = np.asarray(is_classifier, dtype=bool)
+        self._columns = {(task, name): i for i, (task, name) in enumerate(zip(self.tasks, self.model_names))}
+    
+    def __contains__(self, key):
+        return key in self._columns
+    
+    def decision_function(self, X):
+        """
+        Compute the linear score of every fused model
+        
+        Parameters:
+        X (np.ndarray): Raw (unscaled) features, shape (n_rows, n_features)
+        
+        Returns:
+        np.ndarray: Scores, shape (n_rows, n_models); log-odds for classifiers
+        """
+        return np.asarray(X, dtype=np.float64) @ self.weights + self.bias
+    
+    def predict(self, X):
+        """
+        Predict with every fused model at once
+        
+        Parameters:
+        X (np.ndarray): Raw (unscaled) features, shape (n_rows, n_features)
+        
+        Returns:
+        dict: {(task, model_name): predictions} in the format of predict_batch
+        """
+        scores = self.decision_function(X)
+        predictions = {}
+        for key, column in self._columns.items():
+            score = scores[:, column]
+            if self.is_classifier[column]:
+                predictions[key] = {
+                    'class': (score > 0).astype(int),
+                    'probability': 1 / (1 + np.exp(-score))
+                }
+            else:
+                predictions[key] = score
+        return predictions
+    
+    def save(self, path):
+        """
+        Save the fused coefficients as an uncompressed .npz file
+        
+        Parameters:
+        path (str): Output path
+        """
+        with open(path, "wb") as f:
+            np.savez(f, weights=self.weights, bias=self.bias, tasks=np.array(self.tasks),
+                     model_names=np.array(self.model_names), is_classifier=self.is_classifier)
+    
+    @classmethod
+    def load(cls, path):
+        """
+        Load fused coefficients saved with save
+        
+        Parameters:
+        path (str): Path of the .npz file
+        
+        Returns:
+        FusedLinearScorer: The scorer
+        """
+        with np.load(path) as arrays:
+            return cls(arrays['weights'], arrays['bias'], arrays['tasks'], arrays['model_names'],
+                       arrays['is_classifier'])
+
+def fuse_linear_models(scaler, task_models):
+    """
+    Fold a fitted StandardScaler into every linear model
+    
+    Parameters:
+    scaler (StandardScaler): Scaler the models were trained behind
+    task_models (dict): {task: {model_name: fitted model}}
+    
+    Returns:
+    FusedLinearScorer: Scorer over raw features, or None if there are no linear models
+    """
+    n_features = scaler.n_features_in_
+    mean = scaler.mean_ if scaler.mean_ is not None else np.zeros(n_features)
+    scale = scaler.scale_ if scaler.scale_ is not None else np.ones(n_features)
+    
+    columns, biases, tasks, names, is_classifier = [], [], [], [], []
+    for task, models in task_models.items():
+        for model_name, model in models.items():
+            if model_name not in LINEAR_MODEL_TYPES:
+                continue
+            coef = np.ravel(model.coef_).astype(np.float64)
+            weights = coef / scale
+            columns.append(weights)
+            biases.append(float(np.ravel(model.intercept_)[0]) - float(weights @ mean))
+            tasks.append(task)
+            names.append(model_name)
+            is_classifier.append(hasattr(model, 'classes_'))
+    
+    if not columns:
+        return None
+    
+    return FusedLinearScorer(np.column_stack(columns), np.array(biases), tasks, names, is_classifier)
@@ -3,51 +3,75 @@ import numpy as np
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
 import random
+import argparse
+import json
+import os
+from joblib import Parallel, delayed
+from chunked_io import ChunkWriter
 
-def generate_sample_data(n_samples=500):
+def chunk_seed(seed, chunk_index):
+    """
+    Derive the seed of one block of a chunked dataset
+    
+    The result is child number chunk_index of the seed's SeedSequence, the same
+    as SeedSequence(seed).spawn(...)[chunk_index], so a block can be
+    regenerated without generating the blocks before it.
+    
+    Parameters:
+    seed (int or np.random.SeedSequence): Seed of the whole dataset
+    chunk_index (int): Position of the block
+    
+    Returns:
+    np.random.SeedSequence: Seed for the block
+    """
+    base = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return np.random.SeedSequence(base.entropy, spawn_key=base.spawn_key + (chunk_index,))
+
+def generate_sample_data(n_samples=500, seed=42):
     """
     Generate synthetic patient data for mortality prediction and length of stay
     
     Parameters:
     n_samples (int): Number of samples to generate
+    seed (int or np.random.SeedSequence): Seed for the random generator
     
     Returns:
     pd.DataFrame: Dataframe containing patient features
     """
-    # Set random seed for reproducibility
-    np.random.seed(42)
+    # Explicitly seeded generator for reproducibility
+    rng = np.random.default_rng(seed)
     
     # Create empty dataframe
     data = pd.DataFrame()
     
     # Generate patient demographics
-    data['age'] = np.random.normal(65, 15, n_samples).clip(18, 100).astype(int)
-    data['gender'] = np.random.binomial(1, 0.5, n_samples)  # 0 = female, 1 = male
+    data['age'] = rng.normal(65, 15, n_samples).clip(18, 100).astype(int)
+    data['gender'] = rng.binomial(1, 0.5, n_samples)  # 0 = female, 1 = male
     
     # Generate vital signs
-    data['heart_rate'] = np.random.normal(80, 15, n_samples).clip(40, 180).astype(int)
-    data['systolic_bp'] = np.random.normal(120, 20, n_samples).clip(70, 200).astype(int)
-    data['diastolic_bp'] = np.random.normal(80, 10, n_samples).clip(40, 120).astype(int)
-    data['respiration_rate'] = np.random.normal(16, 4, n_samples).clip(8, 40).astype(int)
-    data['temperature'] = np.random.normal(37, 1, n_samples).clip(35, 41)
-    data['oxygen_saturation'] = np.random.normal(96, 3, n_samples).clip(70, 100).astype(int)
+    data['heart_rate'] = rng.normal(80, 15, n_samples).clip(40, 180).astype(int)
+    data['systolic_bp'] = rng.normal(120, 20, n_samples).clip(70, 200).astype(int)
+    data['diastolic_bp'] = rng.normal(80, 10, n_samples).clip(40, 120).astype(int)
+    data['respiration_rate'] = rng.normal(16, 4, n_samples).clip(8, 40).astype(int)
+    data['temperature'] = rng.normal(37, 1, n_samples).clip(35, 41)
+    data['oxygen_saturation'] = rng.normal(96, 3, n_samples).clip(70, 100).astype(int)
     
     # Generate lab results
-    data['wbc_count'] = np.random.normal(9, 3, n_samples).clip(2, 30)
-    data['hemoglobin'] = np.random.normal(13, 2, n_samples).clip(5, 18)
-    data['platelet_count'] = np.random.normal(250, 100, n_samples).clip(20, 600).astype(int)
-    data['sodium'] = np.random.normal(140, 5, n_samples).clip(120, 160).astype(int)
-    data['potassium'] = np.random.normal(4, 0.5, n_samples).clip(2.5, 7)
-    data['creatinine'] = np.random.normal(1, 0.5, n_samples).clip(0.5, 8)
+    data['wbc_count'] = rng.normal(9, 3, n_samples).clip(2, 30)
+    data['hemoglobin'] = rng.normal(13, 2, n_samples).clip(5, 18)
+    data['platelet_count'] = rng.normal(250, 100, n_samples).clip(20, 600).astype(int)
+    data['sodium'] = rng.normal(140, 5, n_samples).clip(120, 160).astype(int)
+    data['potassium'] = rng.normal(4, 0.5, n_samples).clip(2.5, 7)
+    data['creatinine'] = rng.normal(1, 0.5, n_samples).clip(0.5, 8)
     
     # Generate comorbidities
-    data['diabetes'] = np.random.binomial(1, 0.25, n_samples)
-    data['hypertension'] = np.random.binomial(1, 0.4, n_samples)
-    data['copd'] = np.random.binomial(1, 0.15, n_samples)
-    data['asthma'] = np.random.binomial(1, 0.1, n_samples)
-    data['chf'] = np.random.binomial(1, 0.2, n_samples)
-    data['ckd'] = np.random.binomial(1, 0.15, n_samples)
-    data['cancer'] = np.random.binomial(1, 0.1, n_samples)
+    data['diabetes'] = rng.binomial(1, 0.25, n_samples)
+    data['hypertension'] = rng.binomial(1, 0.4, n_samples)
+    data['copd'] = rng.binomial(1, 0.15, n_samples)
+    data['asthma'] = rng.binomial(1, 0.1, n_samples)
+    data['chf'] = rng.binomial(1, 0.2, n_samples)
+    data['ckd'] = rng.binomial(1, 0.15, n_samples)
+    data['cancer'] = rng.binomial(1, 0.1, n_samples)
     
     # Create risk factors that influence outcomes
     advanced_age = data['age'] > 75
@@ -64,58 +88,197 @@ def generate_sample_data(n_samples=500):
                  abnormal_vitals.astype(int) * 2 + 
                  abnormal_labs.astype(int) * 1.8 + 
                  multiple_comorbidities.astype(int) * 2.5 +
-                 np.random.normal(0, 1, n_samples))
+                 rng.normal(0, 1, n_samples))
     
-    # Normalize risk score to 0-10 range
-    risk_score = (risk_score - risk_score.min()) / (risk_score.max() - risk_score.min()) * 10
+    # Normalize risk score to 0-10 range (a sample without spread sits mid-range)
+    risk_range = risk_score.max() - risk_score.min()
+    if risk_range > 0:
+        risk_score = (risk_score - risk_score.min()) / risk_range * 10
+    else:
+        risk_score = np.full(n_samples, 5.0)
     
     # Generate mortality outcome based on risk score
     # Higher risk = higher chance of mortality
     mortality_prob = 1 / (1 + np.exp(-(risk_score - 6) / 1.5))  # Sigmoid function centered at risk=6
-    data['mortality'] = np.random.binomial(1, mortality_prob)
+    data['mortality'] = rng.binomial(1, mortality_prob)
     
     # For those who survived, create mortality rate as a percentage (for regression task)
     data['mortality_rate'] = mortality_prob * 100
     
     # Generate length of stay (in days) based on risk and randomness
     # Higher risk = longer stay
-    los_base = risk_score * 1.5 + np.random.normal(0, 2, n_samples)
+    los_base = risk_score * 1.5 + rng.normal(0, 2, n_samples)
     data['length_of_stay'] = np.maximum(1, los_base).astype(int)
     
     # Adjust length of stay for mortality cases (typically shorter due to early death or longer due to severity)
-    los_adj = []
-    for i, mort in enumerate(data['mortality']):
-        if mort == 1:
-            # For mortality cases, length of stay can be very short (rapid death)
-            # or very long (prolonged critical condition before death)
-            if np.random.random() < 0.3:  # 30% chance of early death
-                los_adj.append(max(1, int(data['length_of_stay'].iloc[i] * 0.3)))
-            else:  # 70% chance of prolonged critical condition
-                los_adj.append(int(data['length_of_stay'].iloc[i] * 1.5))
-        else:
-            los_adj.append(data['length_of_stay'].iloc[i])
-    
-    data['length_of_stay'] = los_adj
+    # For mortality cases, length of stay can be very short (rapid death)
+    # or very long (prolonged critical condition before death)
+    los = data['length_of_stay'].to_numpy()
+    died = data['mortality'].to_numpy() == 1
+    early_death = rng.random(n_samples) < 0.3  # 30% chance of early death
+    data['length_of_stay'] = np.where(
+        died,
+        np.where(early_death,
+                 np.maximum(1, (los * 0.3).astype(int)),
+                 (los * 1.5).astype(int)),  # 70% chance of prolonged critical condition
+        los
+    )
     
     # Create admission type
     admission_types = ['Emergency', 'Urgent', 'Elective']
-    data['admission_type'] = np.random.choice(admission_types, size=n_samples, 
-                                            p=[0.6, 0.25, 0.15])
+    data['admission_type'] = rng.choice(admission_types, size=n_samples, 
+                                        p=[0.6, 0.25, 0.15])
     
     return data
 
-def save_sample_data(n_samples=500, filename='patient_data.csv'):
+def iter_sample_data_chunks(n_samples, chunk_size=1000000, seed=42):
+    """
+    Generate synthetic patient data as a stream of fixed-size blocks
+    
+    Block i is generated from chunk_seed(seed, i) as an independent sample of
+    its own size (risk scores are normalized within the block), so its rows
+    depend only on the seed, the block index and chunk_size, never on
+    n_samples or on other blocks.
+    
+    Parameters:
+    n_samples (int): Total number of samples to generate
+    chunk_size (int): Number of samples per block
+    seed (int or np.random.SeedSequence): Seed of the whole dataset
+    
+    Returns:
+    generator: Yields pd.DataFrame blocks with a global row index
+    """
+    for chunk_index, start in enumerate(range(0, n_samples, chunk_size)):
+        rows = min(chunk_size, n_samples - start)
+        chunk = generate_sample_data(rows, seed=chunk_seed(seed, chunk_index))
+        chunk.index = pd.RangeIndex(start, start + rows)
+        yield chunk
+
+def save_sample_data(n_samples=500, filename='patient_data.csv', chunk_size=None, seed=42):
     """
-    Generate and save sample data to a CSV file
+    Generate and save sample data to a CSV or Parquet file
     
     Parameters:
     n_samples (int): Number of samples to generate
-    filename (str): Name of output file
+    filename (str): Name of output file (.csv or .parquet)
+    chunk_size (int): If given, generate and write blocks of this many samples
+                      so memory use stays bounded however large n_samples is
+    seed (int): Seed for the random generator
+    
+    Returns:
+    pd.DataFrame: The generated data, or None when written in chunks
     """
-    data = generate_sample_data(n_samples)
-    data.to_csv(filename, index=False)
+    if chunk_size is not None:
+        with ChunkWriter(filename) as writer:
+            for chunk in iter_sample_data_chunks(n_samples, chunk_size, seed):
+                writer.write(chunk)
+        print(f"Generated {n_samples} samples in chunks of {chunk_size} and saved to {filename}")
+        return None
+    
+    data = generate_sample_data(n_samples, seed=seed)
+    with ChunkWriter(filename) as writer:
+        writer.write(data)
     print(f"Generated {n_samples} samples and saved to {filename}")
     return data
 
+def _write_shard(path, n_samples, seed, chunk_size):
+    """
+    Generate one shard of a partitioned dataset and write it to path
+    
+    Parameters:
+    path (str): Output file of the shard
+    n_samples (int): Number of samples in the shard
+    seed (np.random.SeedSequence): Seed of the shard
+    chunk_size (int): Samples generated at a time
+    
+    Returns:
+    int: Number of rows written
+    """
+    with ChunkWriter(path) as writer:
+        for chunk in iter_sample_data_chunks(n_samples, chunk_size, seed):
+            writer.write(chunk)
+    return writer.rows_written
+
+def save_sample_data_sharded(n_samples, output_dir, n_shards=8, n_workers=-1, seed=42,
+                             chunk_size=1000000, file_format='parquet'):
+    """
+    Generate a dataset as independent shards on a process pool
+    
+    Shard i is generated from SeedSequence(seed).spawn(n_shards)[i], so the
+    output depends only on n_samples, n_shards, seed and chunk_size, never on
+    the number of workers. Shards are written to output_dir as
+    part-00000.<format>, ... next to a manifest.json listing them.
+    
+    Parameters:
+    n_samples (int): Total number of samples to generate
+    output_dir (str): Directory for the shards and manifest
+    n_shards (int): Number of shards
+    n_workers (int): Number of worker processes, -1 uses all cores
+    seed (int): Seed of the whole dataset
+    chunk_size (int): Samples generated at a time within a shard
+    file_format (str): 'parquet' or 'csv'
+    
+    Returns:
+    dict: The manifest that was written
+    """
+    # An empty shard would never be created by ChunkWriter, yet still be listed
+    if not 1 <= n_shards <= n_samples:
+        raise ValueError(f"n_shards must be between 1 and n_samples ({n_samples}), got {n_shards}")
+    
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Spread the samples as evenly as possible, earlier shards take the remainder
+    sizes = [n_samples // n_shards + (1 if i < n_samples % n_shards else 0) for i in range(n_shards)]
+    seeds = np.random.SeedSequence(seed).spawn(n_shards)
+    files = [f"part-{i:05d}.{file_format}" for i in range(n_shards)]
+    
+    rows = Parallel(n_jobs=n_workers)(
+        delayed(_write_shard)(os.path.join(output_dir, file), size, shard_seed, chunk_size)
+        for file, size, shard_seed in zip(files, sizes, seeds)
+    )
+    
+    manifest = {
+        'n_samples': n_samples,
+        'n_shards': n_shards,
+        'seed': seed,
+        'chunk_size': chunk_size,
+        'format': file_format,
+        'shards': [{'file': file, 'rows': n_rows} for file, n_rows in zip(files, rows)]
+    }
+    with open(os.path.join(output_dir, 'manifest.json'), "w") as f:
+        json.dump(manifest, f, indent=2)
+    
+    print(f"Generated {n_samples} samples in {n_shards} shards and saved to {output_dir}")
+    return manifest
+
+def shard_paths(output_dir):
+    """
+    List the shard files of a dataset written by save_sample_data_sharded
+    
+    Parameters:
+    output_dir (str): Directory containing the shards and manifest
+    
+    Returns:
+    list: Paths of the shard files in order
+    """
+    with open(os.path.join(output_dir, 'manifest.json'), "r") as f:
+        manifest = json.load(f)
+    return [os.path.join(output_dir, shard['file']) for shard in manifest['shards']]
+
 if __name__ == "__main__":
-    save_sample_data(500, 'patient_data.csv')
+    parser = argparse.ArgumentParser(description="Generate synthetic patient data")
+    parser.add_argument('--n-samples', type=int, default=500, help="Number of samples to generate")
+    parser.add_argument('--output', default='patient_data.csv', help="Output file (.csv or .parquet)")
+    parser.add_argument('--chunk-size', type=int, default=None, help="Generate and write in blocks of this many samples")
+    parser.add_argument('--seed', type=int, default=42, help="Random seed")
+    parser.add_argument('--shards', type=int, default=None, help="Write this many shards to the --output directory")
+    parser.add_argument('--workers', type=int, default=-1, help="Worker processes for sharded output, -1 uses all cores")
+    parser.add_argument('--format', default='parquet', choices=['parquet', 'csv'], help="Shard file format")
+    args = parser.parse_args()
+    
+    if args.shards:
+        save_sample_data_sharded(args.n_samples, args.output, n_shards=args.shards, n_workers=args.workers,
+                                 seed=args.seed, chunk_size=args.chunk_size or 1000000,
+                                 file_format=args.format)
+    else:
+        save_sample_data(args.n_samples, args.output, chunk_size=args.chunk_size, seed=args.seed)
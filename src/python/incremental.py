@@ -0,0 +1,529 @@
+import json
+import os
+import time
+import copy
+import argparse
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import SGDClassifier, SGDRegressor
+from sklearn.model_selection import train_test_split
+from predict import TASKS, load_models, prepare_batch_data
+from model_registry import read_manifest
+from train_models import (MODEL_SPECS, SPLIT_VALUES_FILE, TASK_TARGETS, collect_metrics, evaluate_model, save_metrics,
+                          save_models)
+from out_of_core import explain
+from drift import extend_reference, load_reference
+
+TRAINING_STATE_FILE = 'training_state.json'
+
+# Test metrics of the last update, measured on held-out new rows only, so they
+# are kept apart from the performance_metrics.json of the full training run
+UPDATE_METRICS_FILE = 'update_metrics.json'
+
+# Trees added to every random forest and boosting rounds added to every XGBoost
+# model per update
+RF_UPDATE_TREES = 10
+XGB_UPDATE_ROUNDS = 10
+
+# Incremental replacements of the linear models. A small constant learning rate
+# keeps one pass over a day of data from overwriting what was learnt so far.
+SGD_ESTIMATORS = {
+    'LogisticRegression': (SGDClassifier, {'loss': 'log_loss', 'learning_rate': 'constant', 'eta0': 0.001,
+                                           'random_state': 42}),
+    'LinearRegression': (SGDRegressor, {'loss': 'squared_error', 'learning_rate': 'constant', 'eta0': 0.001,
+                                        'random_state': 42})
+}
+
+def read_training_state(model_dir='models'):
+    """
+    Read the incremental training state saved next to the models
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    
+    Returns:
+    dict: State with the 'rows_seen' watermark and the update history
+    """
+    path = os.path.join(model_dir, TRAINING_STATE_FILE)
+    if not os.path.exists(path):
+        return {'rows_seen': 0, 'updates': []}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def write_training_state(state, model_dir='models'):
+    """
+    Save the incremental training state next to the models
+    
+    Parameters:
+    state (dict): State as returned by read_training_state
+    model_dir (str): Directory containing saved models
+    """
+    with open(os.path.join(model_dir, TRAINING_STATE_FILE), "w") as f:
+        json.dump(state, f, indent=2)
+
+def rescale_coefficients(old_scaler, new_scaler):
+    """
+    Express features scaled by old_scaler in terms of new_scaler
+    
+    Both scalers standardize the same raw features, so the two scaled values
+    are related by x_new = a * x_old + c for every feature.
+    
+    Parameters:
+    old_scaler (StandardScaler): Scaler the models were trained behind
+    new_scaler (StandardScaler): Updated scaler
+    
+    Returns:
+    tuple: (a, c) arrays, one value per feature
+    """
+    a = old_scaler.scale_ / new_scaler.scale_
+    c = (old_scaler.mean_ - new_scaler.mean_) / new_scaler.scale_
+    return a, c
+
+def remap_linear(model, a, c):
+    """
+    Adjust a linear model in place so it gives the same predictions on features
+    scaled by the updated scaler
+    
+    Parameters:
+    model (object): Fitted model with coef_ and intercept_
+    a (np.ndarray): Per-feature scale, see rescale_coefficients
+    c (np.ndarray): Per-feature offset, see rescale_coefficients
+    """
+    coef = model.coef_ / a
+    model.intercept_ = model.intercept_ - coef @ c
+    model.coef_ = coef
+
+def tree_splits(model):
+    """
+    List the split nodes of a random forest or XGBoost model
+    
+    Parameters:
+    model (object): Fitted model
+    
+    Returns:
+    tuple: (feature, threshold, inclusive) with the feature index and threshold
+           of every split node and True if x <= threshold goes left (sklearn)
+           rather than x < threshold (XGBoost), or None for other models
+    """
+    name = type(model).__name__
+    if name in ('RandomForestClassifier', 'RandomForestRegressor'):
+        trees = [estimator.tree_ for estimator in model.estimators_]
+        split = [tree.children_left != -1 for tree in trees]
+        return (np.concatenate([tree.feature[mask] for tree, mask in zip(trees, split)]),
+                np.concatenate([tree.threshold[mask] for tree, mask in zip(trees, split)]), True)
+    if name in ('XGBClassifier', 'XGBRegressor'):
+        raw = json.loads(model.get_booster().save_raw('json'))
+        trees = raw['learner']['gradient_booster']['model']['trees']
+        split = [np.asarray(tree['left_children']) != -1 for tree in trees]
+        return (np.concatenate([np.asarray(tree['split_indices'], dtype=np.int64)[mask]
+                                for tree, mask in zip(trees, split)]),
+                np.concatenate([np.asarray(tree['split_conditions'], dtype=np.float32)[mask]
+                                for tree, mask in zip(trees, split)]).astype(np.float64), False)
+    return None
+
+def collect_split_values(models, scaler, values, feature_names):
+    """
+    Find the training values next to every split threshold of the tree models
+    
+    remap_thresholds can only keep values it knows of on their side of a
+    threshold, and XGBoost places its thresholds exactly on training values.
+    The nearest value on either side of every threshold is therefore saved
+    with the models (SPLIT_VALUES_FILE) for the next update.
+    
+    Parameters:
+    models (list): Fitted models, those without splits are ignored
+    scaler (StandardScaler): Scaler the models were trained behind
+    values (list): Per feature, an array of raw training values
+    feature_names (list): Feature names
+    
+    Returns:
+    dict: Sorted distinct raw values per feature name
+    """
+    splits = [split for split in map(tree_splits, models) if split is not None]
+    split_values = {}
+    for j, name in enumerate(feature_names):
+        raw = np.unique(np.asarray(values[j], dtype=np.float64))
+        raw = raw[np.isfinite(raw)]
+        scaled = ((raw - scaler.mean_[j]) / scaler.scale_[j]).astype(np.float32)
+        keep = np.zeros(len(raw), dtype=bool)
+        for feature, threshold, inclusive in splits:
+            n_left = np.searchsorted(scaled, threshold[feature == j], side='right' if inclusive else 'left')
+            keep[n_left[n_left > 0] - 1] = True
+            keep[n_left[n_left < len(raw)]] = True
+        split_values[name] = raw[keep].tolist()
+    return split_values
+
+def load_split_values(model_dir='models'):
+    """
+    Read the split values saved with a set of models, see collect_split_values
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    
+    Returns:
+    dict: Raw values per feature name, empty if the models were saved without them
+    """
+    manifest, _ = read_manifest(model_dir)
+    if manifest is not None:
+        entry = manifest['files'].get('split_values')
+        path = os.path.join(model_dir, entry['path']) if entry else None
+    else:
+        path = os.path.join(model_dir, SPLIT_VALUES_FILE)
+    
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+def observed_values(X_raw, old_scaler, new_scaler, split_values=None):
+    """
+    Collect the distinct values of every feature under the old and new scaling
+    
+    Parameters:
+    X_raw (pd.DataFrame): Raw (unscaled) features
+    old_scaler (StandardScaler): Scaler the models were trained behind
+    new_scaler (StandardScaler): Updated scaler
+    split_values (dict): Raw training values per feature name to include, see
+                         collect_split_values
+    
+    Returns:
+    list: Per feature, a (old, new) pair of sorted float32 arrays as seen by the trees
+    """
+    split_values = split_values or {}
+    values = []
+    for j, column in enumerate(X_raw.columns):
+        raw = np.unique(np.concatenate([X_raw[column].to_numpy(dtype=np.float64),
+                                        np.asarray(split_values.get(column, []), dtype=np.float64)]))
+        raw = raw[np.isfinite(raw)]
+        values.append((((raw - old_scaler.mean_[j]) / old_scaler.scale_[j]).astype(np.float32),
+                       ((raw - new_scaler.mean_[j]) / new_scaler.scale_[j]).astype(np.float32)))
+    return values
+
+def remap_thresholds(threshold, feature, a, c, values, inclusive):
+    """
+    Move split thresholds to the updated scaling
+    
+    Thresholds are mapped affinely, which is exact in real numbers. Trees
+    compare float32 features though, so a value within rounding error of a
+    threshold may change sides; for every observed value that would, the
+    threshold is nudged just far enough to put it back on its old side.
+    
+    Parameters:
+    threshold (np.ndarray): Thresholds of split nodes
+    feature (np.ndarray): Feature index of every threshold
+    a (np.ndarray): Per-feature scale, see rescale_coefficients
+    c (np.ndarray): Per-feature offset, see rescale_coefficients
+    values (list): Observed values, see observed_values
+    inclusive (bool): True if x <= threshold goes left (sklearn, float64
+                      thresholds), False for x < threshold (XGBoost, float32)
+    
+    Returns:
+    np.ndarray: Remapped thresholds
+    """
+    remapped = a[feature] * threshold + c[feature]
+    if not inclusive:
+        remapped = remapped.astype(np.float32).astype(np.float64)
+    side = 'right' if inclusive else 'left'
+    
+    for j in np.unique(feature):
+        mask = feature == j
+        old, new = values[j]
+        t = remapped[mask]
+        n_left = np.searchsorted(old, threshold[mask], side=side)
+        n_left_now = np.searchsorted(new, t, side=side)
+        
+        # Too low: the largest value that went left now goes right
+        low = n_left_now < n_left
+        last_left = new[n_left[low] - 1].astype(np.float64)
+        t[low] = last_left if inclusive else np.nextafter(new[n_left[low] - 1], np.float32(np.inf))
+        
+        # Too high: the smallest value that went right now goes left
+        high = n_left_now > n_left
+        first_right = new[n_left[high]].astype(np.float64)
+        t[high] = np.nextafter(first_right, -np.inf) if inclusive else first_right
+        remapped[mask] = t
+    return remapped
+
+def remap_random_forest(model, a, c, values):
+    """
+    Move the split thresholds of a random forest in place to the updated scaling
+    
+    Parameters:
+    model (object): Fitted RandomForestClassifier or RandomForestRegressor
+    a (np.ndarray): Per-feature scale, see rescale_coefficients
+    c (np.ndarray): Per-feature offset, see rescale_coefficients
+    values (list): Observed values, see observed_values
+    """
+    for estimator in model.estimators_:
+        state = estimator.tree_.__getstate__()
+        nodes = state['nodes'].copy()
+        split = nodes['left_child'] != -1
+        nodes['threshold'][split] = remap_thresholds(nodes['threshold'][split], nodes['feature'][split],
+                                                     a, c, values, inclusive=True)
+        state['nodes'] = nodes
+        estimator.tree_.__setstate__(state)
+
+def remap_xgboost(model, a, c, values):
+    """
+    Move the split conditions of an XGBoost model in place to the updated scaling
+    
+    Parameters:
+    model (object): Fitted XGBClassifier or XGBRegressor
+    a (np.ndarray): Per-feature scale, see rescale_coefficients
+    c (np.ndarray): Per-feature offset, see rescale_coefficients
+    values (list): Observed values, see observed_values
+    """
+    booster = model.get_booster()
+    raw = json.loads(booster.save_raw('json'))
+    for tree in raw['learner']['gradient_booster']['model']['trees']:
+        split = np.asarray(tree['left_children']) != -1
+        # Conditions are float32 values written as shortest decimals
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32).astype(np.float64)
+        conditions[split] = remap_thresholds(conditions[split], np.asarray(tree['split_indices'])[split],
+                                             a, c, values, inclusive=False)
+        tree['split_conditions'] = conditions.tolist()
+    booster.load_model(bytearray(json.dumps(raw).encode('utf-8')))
+
+def to_sgd(model):
+    """
+    Convert a fitted LogisticRegression or LinearRegression into its SGD
+    counterpart, starting from the same coefficients
+    
+    Parameters:
+    model (object): Fitted linear model; SGD models are returned unchanged
+    
+    Returns:
+    object: SGDClassifier or SGDRegressor ready for partial_fit
+    """
+    if type(model).__name__ not in SGD_ESTIMATORS:
+        return model
+    estimator, params = SGD_ESTIMATORS[type(model).__name__]
+    sgd = estimator(**params)
+    sgd.coef_ = np.array(model.coef_, dtype=np.float64)
+    sgd.intercept_ = np.atleast_1d(np.array(model.intercept_, dtype=np.float64))
+    sgd.n_features_in_ = model.coef_.shape[-1]
+    sgd.t_ = 1.0
+    if hasattr(model, 'classes_'):
+        sgd.classes_ = model.classes_
+    return sgd
+
+def update_model(model_name, model, X, y, classes=None):
+    """
+    Train one model further on new rows, scaled by the updated scaler
+    
+    Parameters:
+    model_name (str): Model name within its task
+    model (object): Fitted model, already remapped to the updated scaling
+    X (np.ndarray): Scaled new features
+    y (np.ndarray): New targets
+    classes (np.ndarray): Classes of a classification task
+    
+    Returns:
+    object: The updated model
+    """
+    if model_name == 'random_forest':
+        if classes is not None and not np.isin(classes, y).all():
+            raise ValueError("New data must contain every class to grow a random forest classifier")
+        model.set_params(warm_start=True, n_estimators=len(model.estimators_) + RF_UPDATE_TREES)
+        return model.fit(X, y)
+    
+    if model_name == 'xgboost':
+        updated = type(model)(**{**model.get_params(), 'n_estimators': XGB_UPDATE_ROUNDS})
+        return updated.fit(X, y, xgb_model=model.get_booster())
+    
+    if model_name == 'knn':
+        # Append the new rows to the stored neighbors
+        old_y = model.classes_[model._y] if classes is not None else model._y
+        return model.fit(np.vstack([model._fit_X, X]), np.concatenate([old_y, y]))
+    
+    model = to_sgd(model)
+    if classes is not None:
+        return model.partial_fit(X, y, classes=classes)
+    return model.partial_fit(X, y)
+
+def remap_model(model_name, model, a, c, values):
+    """
+    Adjust a model in place to the updated scaling, see rescale_coefficients
+    
+    Linear and tree models keep their predictions. KNN keeps its neighbors'
+    positions, but distances are measured in the new scaling.
+    
+    Parameters:
+    model_name (str): Model name within its task
+    model (object): Fitted model
+    a (np.ndarray): Per-feature scale
+    c (np.ndarray): Per-feature offset
+    values (list): Observed values, see observed_values
+    """
+    if model_name == 'random_forest':
+        remap_random_forest(model, a, c, values)
+    elif model_name == 'xgboost':
+        remap_xgboost(model, a, c, values)
+    elif model_name == 'knn':
+        model.fit(np.asarray(model._fit_X) * a + c,
+                  model.classes_[model._y] if hasattr(model, 'classes_') else model._y)
+    else:
+        remap_linear(model, a, c)
+
+def saved_options(manifest):
+    """
+    Find the save_models options a model directory was written with
+    
+    Parameters:
+    manifest (dict): Manifest of the directory, None for a directory without one
+    
+    Returns:
+    dict: Keyword arguments of save_models reproducing the optional artifacts
+    """
+    if manifest is None:
+        return {}
+    entries = [entry for task_entries in manifest['models'].values() for entry in task_entries.values()]
+    return {
+        'mmap_forests': any('mmap_path' in entry for entry in entries),
+        'compile_trees': any('compiled_path' in entry for entry in entries),
+        'knn_index': any('index_path' in entry for entry in entries),
+        'fuse_linear': 'fused_linear' in manifest['files']
+    }
+
+def artifact_paths(manifest):
+    """
+    List every file a manifest refers to
+    
+    Parameters:
+    manifest (dict): Manifest of a model directory
+    
+    Returns:
+    set: Paths relative to the model directory
+    """
+    paths = {manifest['scaler']['path']} | {entry['path'] for entry in manifest['files'].values()}
+    for task_entries in manifest['models'].values():
+        for entry in task_entries.values():
+            paths.update(entry[key] for key in ('path', 'mmap_path', 'compiled_path', 'index_path') if key in entry)
+            paths.update(variant['path'] for variant in entry.get('variants', {}).values())
+    return paths
+
+def update_models(new_data, model_dir='models', watermark=None, test_size=0.2, random_state=42):
+    """
+    Incrementally train saved models on newly appended patients
+    
+    The scaler is updated with partial_fit and every model is first remapped to
+    the new scaling, so it keeps its predictions on old data, then trained on
+    the new rows only: linear models by an SGD pass, XGBoost by continued
+    boosting, random forests by extra trees grown on the new rows (warm_start)
+    and KNN by adding the new rows as neighbors. A test_size fraction of the
+    new rows is held out and the updated models' metrics on it are written to
+    UPDATE_METRICS_FILE; performance_metrics.json keeps those of the training
+    run. The updated models are saved with save_models, with the same optional
+    artifacts as before, which gives the directory a new registry version.
+    Compressed variants are rebuilt from the updated models with the held-out
+    rows as validation data, and files no longer referenced are removed.
+    
+    Parameters:
+    new_data (pd.DataFrame): New patients including the target columns
+    model_dir (str): Directory containing saved models
+    watermark (int): Total rows of the source consumed after this update,
+                     saved in the training state
+    test_size (float): Fraction of the new rows held out for testing
+    random_state (int): Seed of the train/test split
+    
+    Returns:
+    dict: Summary of the update
+    """
+    start = time.perf_counter()
+    manifest, _ = read_manifest(model_dir)
+    models = load_models(model_dir)
+    state = read_training_state(model_dir)
+    feature_names = models['feature_names']
+    train_data, test_data = train_test_split(new_data, test_size=test_size, random_state=random_state)
+    
+    old_scaler = models['scaler']
+    scaler = copy.deepcopy(old_scaler)
+    
+    X_raw = prepare_batch_data(train_data, feature_names)
+    scaler.partial_fit(X_raw)
+    a, c = rescale_coefficients(old_scaler, scaler)
+    split_values = load_split_values(model_dir)
+    values = observed_values(X_raw, old_scaler, scaler, split_values)
+    X = scaler.transform(X_raw)
+    X_test = scaler.transform(prepare_batch_data(test_data, feature_names))
+    
+    results = {'scaler': scaler, 'feature_names': feature_names}
+    reference = load_reference(model_dir)
+    if reference is not None:
+        results['drift_reference'] = extend_reference(reference, X_raw.to_numpy())
+    specs = {(spec['task'], spec['name']): spec for spec in MODEL_SPECS}
+    for task in TASKS:
+        y = train_data[TASK_TARGETS[task]].to_numpy()
+        classes = np.array([0, 1]) if task == 'mortality_classification' else None
+        results[task] = {}
+        for model_name in models.get(task, {}):
+            # Registry models are shared with other callers, so update a copy
+            model = copy.deepcopy(models[task][model_name])
+            remap_model(model_name, model, a, c, values)
+            model = update_model(model_name, model, X, y, classes)
+            entry = {'model': model}
+            entry.update(evaluate_model(task, model, X_test, test_data[TASK_TARGETS[task]]))
+            entry.update(explain(model, specs.get((task, model_name), {}), feature_names))
+            results[task][model_name] = entry
+    
+    # New trees split on the new rows, older ones on the values kept so far
+    candidates = [np.concatenate([X_raw[column].to_numpy(dtype=np.float64), split_values.get(column, [])])
+                  for column in feature_names]
+    fitted = [entry['model'] for task in TASKS for entry in results[task].values()]
+    results['split_values'] = collect_split_values(fitted, scaler, candidates, feature_names)
+    
+    save_models(results, model_dir, **saved_options(manifest))
+    if manifest is not None and any(entry.get('variants') for task_entries in manifest['models'].values()
+                                    for entry in task_entries.values()):
+        # The old variants were compressed from the models before the update
+        from compression import compress_models
+        compress_models(model_dir, test_data)
+    save_metrics(collect_metrics(results), os.path.join(model_dir, UPDATE_METRICS_FILE))
+    
+    if manifest is not None:
+        updated, _ = read_manifest(model_dir)
+        for path in artifact_paths(manifest) - artifact_paths(updated):
+            if os.path.exists(os.path.join(model_dir, path)):
+                os.remove(os.path.join(model_dir, path))
+    
+    seconds = time.perf_counter() - start
+    state['rows_seen'] = watermark if watermark is not None else state['rows_seen'] + len(new_data)
+    state['updates'].append({'rows': len(new_data), 'rows_seen': state['rows_seen'], 'seconds': seconds,
+                             'timestamp': pd.Timestamp.now(tz='UTC').isoformat()})
+    write_training_state(state, model_dir)
+    
+    print(f"Updated models in {model_dir} with {len(new_data)} new rows in {seconds:.1f}s")
+    return state['updates'][-1]
+
+def update_from_file(file_path, model_dir='models'):
+    """
+    Train saved models on the rows appended to a CSV file since the last update
+    
+    Parameters:
+    file_path (str): Append-only CSV file of patients including the target columns
+    model_dir (str): Directory containing saved models
+    
+    Returns:
+    dict: Summary of the update, or None if there were no new rows
+    """
+    rows_seen = read_training_state(model_dir)['rows_seen']
+    new_data = pd.read_csv(file_path, skiprows=range(1, rows_seen + 1))
+    if new_data.empty:
+        print(f"No new rows in {file_path} since row {rows_seen}")
+        return None
+    return update_models(new_data, model_dir, watermark=rows_seen + len(new_data))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally train saved models on newly appended patients")
+    parser.add_argument('--data', required=True, help="Append-only CSV file of patients")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--mark', type=int, default=None,
+                        help="Only set the watermark to this many rows (save_models sets it after a full retrain)")
+    args = parser.parse_args()
+    
+    if args.mark is not None:
+        state = read_training_state(args.model_dir)
+        state['rows_seen'] = args.mark
+        write_training_state(state, args.model_dir)
+    else:
+        update_from_file(args.data, args.model_dir)
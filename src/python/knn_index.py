@@ -0,0 +1,369 @@
+import numpy as np
+
+KNN_INDEX_SUFFIX = '.ivf.npz'
+
+# Queries and training points handled per distance block, bounding memory
+BLOCK_SIZE = 65536
+
+class IVFNeighbors:
+    """
+    Approximate k-nearest-neighbor model over an inverted-file (IVF) index
+    
+    The training points are clustered with k-means into n_lists cells and
+    stored contiguously cell by cell. A query only scans the points of its
+    n_probe nearest cells, so prediction cost grows with n_probe / n_lists of
+    the training set instead of all of it. n_probe is the recall-vs-speed
+    knob: n_probe = n_lists scans everything and returns the exact neighbors.
+    The object exposes predict/predict_proba/classes_ and can stand in for the
+    KNeighborsClassifier or KNeighborsRegressor it was built from.
+    """
+    
+    def __init__(self, centroids, points, targets, offsets, n_neighbors, n_probe, weights='uniform', classes=None):
+        self.centroids = centroids
+        self.points = points
+        self.targets = targets
+        self.offsets = offsets
+        self.n_neighbors = int(n_neighbors)
+        self.n_probe = int(n_probe)
+        self.weights = weights
+        self.classes_ = classes
+        self._point_norms = np.einsum('ij,ij->i', points, points, dtype=np.float64)
+    
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+    
+    def kneighbors(self, X, n_probe=None):
+        """
+        Find the approximate nearest training points of every row
+        
+        Parameters:
+        X (np.ndarray): Feature matrix, scaled like the training data
+        n_probe (int): Cells scanned per row, defaults to self.n_probe
+        
+        Returns:
+        tuple: (distances, indices), both of shape (n_rows, n_neighbors);
+               indices refer to the cell-ordered points of the index
+        """
+        X = np.asarray(X, dtype=np.float64)
+        n_probe = min(max(n_probe or self.n_probe, 1), self.n_lists)
+        if n_probe == self.n_lists:
+            best_dist, best_index = self._scan(X)
+        else:
+            best_dist, best_index = self._search(X, n_probe)
+        
+        # Rows whose probed cells held fewer than k points fall back to a full scan
+        short = np.isinf(best_dist).any(axis=1)
+        if short.any() and n_probe < self.n_lists:
+            best_dist[short], best_index[short] = self._scan(X[short])
+        
+        order = np.argsort(best_dist, axis=1)
+        distances = np.sqrt(np.maximum(np.take_along_axis(best_dist, order, axis=1), 0))
+        return distances, np.take_along_axis(best_index, order, axis=1)
+    
+    def _scan(self, X):
+        # Exact search: every point at once for blocks of rows, without the per-cell loop
+        k = self.n_neighbors
+        rows_per_block = max(1, BLOCK_SIZE * 16 // len(self.points))
+        best_dist = np.empty((len(X), k))
+        best_index = np.empty((len(X), k), dtype=np.int64)
+        for start in range(0, len(X), rows_per_block):
+            block = X[start:start + rows_per_block]
+            dist = np.einsum('ij,ij->i', block, block)[:, None] - 2 * block @ self.points.T + self._point_norms
+            keep = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            best_dist[start:start + rows_per_block] = np.take_along_axis(dist, keep, axis=1)
+            best_index[start:start + rows_per_block] = keep
+        return best_dist, best_index
+    
+    def _search(self, X, n_probe):
+        n_rows, k = len(X), self.n_neighbors
+        
+        # Cells to scan for every row
+        centroid_dist = squared_distances(X, self.centroids)
+        if n_probe < self.n_lists:
+            probes = np.argpartition(centroid_dist, n_probe - 1, axis=1)[:, :n_probe]
+        else:
+            probes = np.broadcast_to(np.arange(self.n_lists), (n_rows, self.n_lists))
+        
+        best_dist = np.full((n_rows, k), np.inf)
+        best_index = np.zeros((n_rows, k), dtype=np.int64)
+        query_norms = np.einsum('ij,ij->i', X, X)
+        
+        # Scan cell by cell, merging every cell's candidates into the running top k
+        # of the rows that probe it
+        rows_by_cell = np.argsort(probes, axis=None, kind='stable') // n_probe
+        cell_bounds = np.searchsorted(np.sort(probes, axis=None), np.arange(self.n_lists + 1))
+        for cell in range(self.n_lists):
+            rows = rows_by_cell[cell_bounds[cell]:cell_bounds[cell + 1]]
+            start, stop = self.offsets[cell], self.offsets[cell + 1]
+            if len(rows) == 0 or start == stop:
+                continue
+            
+            dist = (query_norms[rows, None] - 2 * X[rows] @ self.points[start:stop].T
+                    + self._point_norms[None, start:stop])
+            candidates_dist = np.concatenate([best_dist[rows], dist], axis=1)
+            candidates_index = np.concatenate([best_index[rows],
+                                               np.broadcast_to(np.arange(start, stop), dist.shape)], axis=1)
+            
+            keep = np.argpartition(candidates_dist, k - 1, axis=1)[:, :k]
+            best_dist[rows] = np.take_along_axis(candidates_dist, keep, axis=1)
+            best_index[rows] = np.take_along_axis(candidates_index, keep, axis=1)
+        
+        return best_dist, best_index
+    
+    def _neighbor_weights(self, distances):
+        if self.weights == 'distance':
+            # Like sklearn, an exact match takes all the weight
+            with np.errstate(divide='ignore'):
+                inverse = 1 / distances
+            exact = np.isinf(inverse)
+            inverse[exact.any(axis=1)] = exact[exact.any(axis=1)]
+            return inverse
+        return np.ones_like(distances)
+    
+    def predict_proba(self, X):
+        """
+        Predict class probabilities from the approximate neighbors
+        
+        Parameters:
+        X (np.ndarray): Feature matrix
+        
+        Returns:
+        np.ndarray: Probability of every class, shape (n_rows, n_classes)
+        """
+        distances, indices = self.kneighbors(X)
+        weights = self._neighbor_weights(distances)
+        labels = self.targets[indices].astype(np.int64)
+        
+        proba = np.zeros((len(indices), len(self.classes_)))
+        for class_index in range(len(self.classes_)):
+            proba[:, class_index] = (weights * (labels == class_index)).sum(axis=1)
+        return proba / proba.sum(axis=1, keepdims=True)
+    
+    def predict(self, X):
+        """
+        Predict classes (classifiers) or values (regressors)
+        
+        Parameters:
+        X (np.ndarray): Feature matrix
+        
+        Returns:
+        np.ndarray: Predictions, one per row
+        """
+        if self.classes_ is not None:
+            return self.classes_.take(np.argmax(self.predict_proba(X), axis=1))
+        
+        distances, indices = self.kneighbors(X)
+        weights = self._neighbor_weights(distances)
+        return (weights * self.targets[indices]).sum(axis=1) / weights.sum(axis=1)
+    
+    def to_arrays(self):
+        """
+        Export the index as a dictionary of arrays, see from_arrays
+        
+        Returns:
+        dict: Index arrays and scalar settings
+        """
+        arrays = {
+            'centroids': self.centroids,
+            'points': self.points,
+            'targets': self.targets,
+            'offsets': self.offsets,
+            'n_neighbors': np.array(self.n_neighbors),
+            'n_probe': np.array(self.n_probe),
+            'weights': np.array(self.weights)
+        }
+        if self.classes_ is not None:
+            arrays['classes'] = self.classes_
+        return arrays
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild an index from the arrays of to_arrays
+        
+        The points may also be given quantized, as the 'point_codes',
+        'point_scale' and 'point_offset' of quantize_points.
+        
+        Parameters:
+        arrays (Mapping): Arrays by name, e.g. an np.load result
+        
+        Returns:
+        IVFNeighbors: The index
+        """
+        if 'points' in arrays:
+            points = arrays['points']
+        else:
+            points = dequantize_points(arrays['point_codes'], arrays['point_scale'], arrays['point_offset'])
+        return cls(arrays['centroids'], points, arrays['targets'], arrays['offsets'],
+                   int(arrays['n_neighbors']), int(arrays['n_probe']), str(arrays['weights']),
+                   arrays['classes'] if 'classes' in arrays else None)
+
+def quantize_points(points):
+    """
+    Quantize points to one byte per feature, with a linear scale per feature
+    
+    Parameters:
+    points (np.ndarray): Points, shape (n_points, n_features)
+    
+    Returns:
+    dict: 'point_codes' (uint8), 'point_scale' and 'point_offset' (float32)
+    """
+    low = points.min(axis=0)
+    scale = (points.max(axis=0) - low) / 255
+    # Constant features encode as code 0
+    scale[scale == 0] = 1
+    codes = np.rint((points - low) / scale).astype(np.uint8)
+    return {'point_codes': codes, 'point_scale': scale.astype(np.float32), 'point_offset': low.astype(np.float32)}
+
+def dequantize_points(codes, scale, offset):
+    """
+    Reconstruct points quantized with quantize_points
+    
+    Parameters:
+    codes (np.ndarray): uint8 codes, shape (n_points, n_features)
+    scale (np.ndarray): Scale per feature
+    offset (np.ndarray): Offset per feature
+    
+    Returns:
+    np.ndarray: float32 points
+    """
+    return codes.astype(np.float32) * scale + offset
+
+def squared_distances(X, Y):
+    """
+    Compute squared Euclidean distances between the rows of two matrices
+    
+    Parameters:
+    X (np.ndarray): Shape (n, d)
+    Y (np.ndarray): Shape (m, d)
+    
+    Returns:
+    np.ndarray: Shape (n, m)
+    """
+    dist = np.einsum('ij,ij->i', X, X)[:, None] - 2 * X @ Y.T + np.einsum('ij,ij->i', Y, Y)[None, :]
+    return np.maximum(dist, 0)
+
+def nearest_centroid(X, centroids):
+    """
+    Assign every row to its nearest centroid, in blocks of BLOCK_SIZE rows
+    
+    Parameters:
+    X (np.ndarray): Feature matrix
+    centroids (np.ndarray): Cluster centers
+    
+    Returns:
+    np.ndarray: Centroid index of every row
+    """
+    return np.concatenate([np.argmin(squared_distances(X[start:start + BLOCK_SIZE], centroids), axis=1)
+                           for start in range(0, len(X), BLOCK_SIZE)])
+
+def kmeans(X, n_clusters, n_iter=20, sample_size=100000, seed=0):
+    """
+    Cluster rows with Lloyd's algorithm, fitted on a random sample for large inputs
+    
+    Parameters:
+    X (np.ndarray): Feature matrix
+    n_clusters (int): Number of clusters
+    n_iter (int): Lloyd iterations
+    sample_size (int): Rows used to fit the centroids
+    seed (int): Random seed
+    
+    Returns:
+    np.ndarray: Centroids, shape (n_clusters, n_features)
+    """
+    rng = np.random.default_rng(seed)
+    sample = X[rng.choice(len(X), sample_size, replace=False)] if len(X) > sample_size else X
+    centroids = sample[rng.choice(len(sample), n_clusters, replace=False)].copy()
+    
+    for _ in range(n_iter):
+        assignment = nearest_centroid(sample, centroids)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        # Empty clusters keep their previous center
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+    
+    return centroids
+
+def build_ivf_index(model, n_lists=None, n_probe=None, seed=0):
+    """
+    Build an IVF index from a fitted KNeighborsClassifier or KNeighborsRegressor
+    
+    Parameters:
+    model (object): Fitted KNN model using the Euclidean metric
+    n_lists (int): Number of cells, defaults to sqrt of the training set size
+    n_probe (int): Default number of cells scanned per query, defaults to
+                   sqrt(n_lists), about 99% neighbor recall on the synthetic data
+    seed (int): Random seed for k-means
+    
+    Returns:
+    IVFNeighbors: The index, or None if the model cannot be indexed
+    """
+    if type(model).__name__ not in ('KNeighborsClassifier', 'KNeighborsRegressor'):
+        return None
+    if model.effective_metric_ != 'euclidean' or model.weights not in ('uniform', 'distance'):
+        return None
+    
+    points = np.asarray(model._fit_X, dtype=np.float64)
+    n_lists = n_lists or max(1, int(round(np.sqrt(len(points)))))
+    n_lists = min(n_lists, len(points))
+    n_probe = n_probe or int(np.ceil(np.sqrt(n_lists)))
+    
+    centroids = kmeans(points, n_lists, seed=seed)
+    assignment = nearest_centroid(points, centroids)
+    order = np.argsort(assignment, kind='stable')
+    offsets = np.searchsorted(assignment[order], np.arange(n_lists + 1))
+    
+    is_classifier = hasattr(model, 'classes_')
+    targets = np.asarray(model._y)[order]
+    return IVFNeighbors(centroids, points[order], targets if is_classifier else targets.astype(np.float64),
+                        offsets, model.n_neighbors, n_probe, model.weights,
+                        model.classes_ if is_classifier else None)
+
+def save_index(index, path):
+    """
+    Save an index as an uncompressed .npz file
+    
+    Parameters:
+    index (IVFNeighbors): Index to save
+    path (str): Output path, conventionally ending in KNN_INDEX_SUFFIX
+    """
+    with open(path, "wb") as f:
+        np.savez(f, **index.to_arrays())
+
+def load_index(path, n_probe=None):
+    """
+    Load an index saved with save_index
+    
+    Parameters:
+    path (str): Path of the .npz file
+    n_probe (int): Cells scanned per query, overriding the saved default
+    
+    Returns:
+    IVFNeighbors: The index
+    """
+    with np.load(path) as arrays:
+        index = IVFNeighbors.from_arrays({name: arrays[name] for name in arrays.files})
+    if n_probe is not None:
+        index.n_probe = n_probe
+    return index
+
+def neighbor_recall(model, index, X):
+    """
+    Measure how many of the exact nearest neighbors an index finds
+    
+    Parameters:
+    model (object): The exact KNN model the index was built from
+    index (IVFNeighbors): The approximate index
+    X (np.ndarray): Feature matrix
+    
+    Returns:
+    float: Mean fraction of the exact neighbors among the approximate ones
+    """
+    exact_dist, _ = model.kneighbors(X)
+    approx_dist, _ = index.kneighbors(X)
+    # Compare by distance so ties between equally distant points do not count as misses
+    radius = exact_dist[:, -1:] * (1 + 1e-9) + 1e-12
+    return float(np.mean(np.minimum((approx_dist <= radius).sum(axis=1), index.n_neighbors) / index.n_neighbors))
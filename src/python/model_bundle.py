@@ -0,0 +1,341 @@
+import json
+import os
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from model_registry import file_sha256, describe_variant, REGISTRY_CACHE_SIZE
+
+BUNDLE_MANIFEST = 'bundle.json'
+BUNDLE_FORMAT_VERSION = 1
+
+# Linear model classes stored as coefficient arrays, with the parameters they are rebuilt with
+LINEAR_ESTIMATORS = {
+    'LogisticRegression': {},
+    'LinearRegression': {},
+    'SGDClassifier': {'loss': 'log_loss'},
+    'SGDRegressor': {}
+}
+
+_bundle_cache = OrderedDict()
+
+def _save_arrays(bundle_dir, prefix, arrays):
+    """
+    Save named arrays as uncompressed .npy files; 0-d arrays become JSON scalars
+    
+    Parameters:
+    bundle_dir (str): Bundle directory
+    prefix (str): Relative directory of the arrays within the bundle
+    arrays (dict): Arrays by name
+    
+    Returns:
+    dict: {'arrays': {name: {'path', 'sha256'}}, 'scalars': {name: value}}
+    """
+    os.makedirs(os.path.join(bundle_dir, prefix), exist_ok=True)
+    entry = {'arrays': {}, 'scalars': {}}
+    for name, array in arrays.items():
+        array = np.asarray(array)
+        if array.ndim == 0:
+            entry['scalars'][name] = array.item()
+            continue
+        relative_path = f"{prefix}/{name}.npy"
+        np.save(os.path.join(bundle_dir, relative_path), np.ascontiguousarray(array), allow_pickle=False)
+        entry['arrays'][name] = {'path': relative_path,
+                                 'sha256': file_sha256(os.path.join(bundle_dir, relative_path))}
+    return entry
+
+def _load_arrays(bundle_dir, entry, mmap=True):
+    """
+    Load the arrays and scalars saved by _save_arrays
+    
+    Parameters:
+    bundle_dir (str): Bundle directory
+    entry (dict): Manifest entry written by _save_arrays
+    mmap (bool): Memory-map the arrays read-only instead of reading them
+    
+    Returns:
+    dict: Arrays and scalars by name
+    """
+    values = dict(entry['scalars'])
+    for name, array_entry in entry['arrays'].items():
+        values[name] = np.load(os.path.join(bundle_dir, array_entry['path']), mmap_mode='r' if mmap else None,
+                               allow_pickle=False)
+    return values
+
+def write_bundle(models, bundle_dir):
+    """
+    Write models as a columnar, memory-mappable bundle
+    
+    Every artifact is stored as plain uncompressed .npy arrays, except XGBoost
+    which is stored in its native binary format (alongside its compiled node
+    arrays). Nothing is pickled:
+    - the scaler and linear models as their coefficient arrays, plus the
+      fused linear scorer of fused_linear.py
+    - random forests as compiled node arrays (tree_compiler.py)
+    - KNN models as their IVF index (knn_index.py) holding the training points
+    The manifest is written last and its hash is the bundle version.
+    
+    Parameters:
+    models (dict): Models in the layout returned by load_models
+    bundle_dir (str): Output directory
+    
+    Returns:
+    dict: The manifest that was written
+    """
+    from tree_compiler import compile_model
+    from knn_index import build_ivf_index
+    from fused_linear import fuse_linear_models
+    from predict import TASKS
+    
+    os.makedirs(bundle_dir, exist_ok=True)
+    scaler = models['scaler']
+    task_models = {task: dict(models.get(task, {})) for task in TASKS}
+    
+    manifest = {
+        'format_version': BUNDLE_FORMAT_VERSION,
+        'feature_names': list(models['feature_names']),
+        'scaler': _save_arrays(bundle_dir, 'scaler', scaler_to_arrays(scaler)),
+        'fused_linear': None,
+        'models': {}
+    }
+    
+    fused = fuse_linear_models(scaler, task_models)
+    if fused is not None:
+        manifest['fused_linear'] = _save_arrays(bundle_dir, 'fused_linear', {
+            'weights': fused.weights, 'bias': fused.bias, 'tasks': np.array(fused.tasks),
+            'model_names': np.array(fused.model_names), 'is_classifier': fused.is_classifier})
+    
+    for task, named_models in task_models.items():
+        manifest['models'][task] = {}
+        for model_name, model in named_models.items():
+            prefix = f"{task}/{model_name}"
+            kind = type(model).__name__
+            
+            if kind in LINEAR_ESTIMATORS:
+                arrays = {'coef': model.coef_, 'intercept': np.atleast_1d(model.intercept_)}
+                if hasattr(model, 'classes_'):
+                    arrays['classes'] = model.classes_
+                entry = {'kind': 'linear', 'estimator': kind, **_save_arrays(bundle_dir, prefix, arrays)}
+            elif kind in ('KNeighborsClassifier', 'KNeighborsRegressor'):
+                # Every cell holds ~sqrt(n) points; the loader scans all cells, i.e. exact KNN
+                entry = {'kind': 'knn_index', **_save_arrays(bundle_dir, prefix, build_ivf_index(model).to_arrays())}
+            else:
+                compiled = compile_model(model)
+                if compiled is None:
+                    raise ValueError(f"Cannot store {kind} ({task}/{model_name}) in a bundle")
+                entry = {'kind': 'compiled_trees', **_save_arrays(bundle_dir, prefix, compiled.to_arrays())}
+                
+                if kind in ('XGBClassifier', 'XGBRegressor'):
+                    native_path = f"{prefix}/model.ubj"
+                    model.save_model(os.path.join(bundle_dir, native_path))
+                    entry.update({'kind': 'xgboost', 'estimator': kind, 'native_path': native_path,
+                                  'native_sha256': file_sha256(os.path.join(bundle_dir, native_path))})
+            manifest['models'][task][model_name] = entry
+    
+    with open(os.path.join(bundle_dir, BUNDLE_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    
+    print(f"Model bundle saved to {bundle_dir}")
+    return manifest
+
+def scaler_to_arrays(scaler):
+    """
+    Export a fitted StandardScaler as arrays, see scaler_from_arrays
+    
+    Parameters:
+    scaler (StandardScaler): Fitted scaler
+    
+    Returns:
+    dict: Mean, scale, variance and sample count
+    """
+    return {'mean': scaler.mean_, 'scale': scaler.scale_, 'var': scaler.var_,
+            'n_samples_seen': scaler.n_samples_seen_}
+
+def scaler_from_arrays(values, feature_names):
+    """
+    Rebuild a fitted StandardScaler from the arrays of scaler_to_arrays
+    
+    Parameters:
+    values (Mapping): Arrays by name
+    feature_names (list): Feature names the scaler was fitted on
+    
+    Returns:
+    StandardScaler: The scaler
+    """
+    from sklearn.preprocessing import StandardScaler
+    
+    scaler = StandardScaler()
+    scaler.mean_ = values['mean']
+    scaler.scale_ = values['scale']
+    scaler.var_ = values['var']
+    scaler.n_samples_seen_ = values['n_samples_seen']
+    scaler.n_features_in_ = len(feature_names)
+    scaler.feature_names_in_ = np.asarray(feature_names, dtype=object)
+    return scaler
+
+def _build_linear(entry, values):
+    from sklearn import linear_model
+    
+    model = getattr(linear_model, entry['estimator'])(**LINEAR_ESTIMATORS[entry['estimator']])
+    model.coef_ = values['coef']
+    model.intercept_ = values['intercept'] if model.coef_.ndim == 2 else values['intercept'][0]
+    model.n_features_in_ = model.coef_.shape[-1]
+    if 'classes' in values:
+        model.classes_ = values['classes']
+    return model
+
+def _build_xgboost(bundle_dir, entry):
+    import xgboost as xgb
+    
+    model = xgb.XGBClassifier() if entry['estimator'] == 'XGBClassifier' else xgb.XGBRegressor()
+    model.load_model(os.path.join(bundle_dir, entry['native_path']))
+    return model
+
+def read_bundle(bundle_dir, mmap=True, compiled=False, approximate_knn=False, knn_probes=None):
+    """
+    Load a bundle written by write_bundle
+    
+    Arrays are memory-mapped read-only, so every process loading the same
+    bundle shares one copy of the model pages through the OS page cache, and
+    loading costs little more than reading the manifest.
+    
+    Parameters:
+    bundle_dir (str): Bundle directory
+    mmap (bool): Memory-map the arrays instead of reading them into memory
+    compiled (bool): Use the compiled node arrays for XGBoost instead of the
+                     native model; those are memory-mapped and shared as well
+    approximate_knn (bool): Scan only knn_probes index cells per KNN query
+                            instead of all of them (exact)
+    knn_probes (int): Index cells scanned per query, None for the saved default
+    
+    Returns:
+    dict: Models in the layout returned by load_models, including 'version',
+          'variant' and 'fused_linear'
+    """
+    from tree_compiler import CompiledTreeEnsemble
+    from knn_index import IVFNeighbors
+    from fused_linear import FusedLinearScorer
+    
+    path = os.path.join(bundle_dir, BUNDLE_MANIFEST)
+    with open(path, "rb") as f:
+        raw = f.read()
+    manifest = json.loads(raw)
+    if manifest['format_version'] > BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"Bundle format {manifest['format_version']} is newer than supported "
+                         f"({BUNDLE_FORMAT_VERSION})")
+    
+    feature_names = manifest['feature_names']
+    models = {
+        'scaler': scaler_from_arrays(_load_arrays(bundle_dir, manifest['scaler'], mmap), feature_names),
+        'feature_names': feature_names,
+        'version': hashlib.sha256(raw).hexdigest(),
+        'variant': describe_variant(compiled, approximate_knn, knn_probes)
+    }
+    
+    if manifest['fused_linear'] is not None:
+        values = _load_arrays(bundle_dir, manifest['fused_linear'], mmap)
+        models['fused_linear'] = FusedLinearScorer(values['weights'], values['bias'], values['tasks'],
+                                                   values['model_names'], values['is_classifier'])
+    
+    for task, entries in manifest['models'].items():
+        models[task] = {}
+        for model_name, entry in entries.items():
+            if entry['kind'] == 'xgboost' and not compiled:
+                model = _build_xgboost(bundle_dir, entry)
+            else:
+                values = _load_arrays(bundle_dir, entry, mmap)
+                if entry['kind'] == 'linear':
+                    model = _build_linear(entry, values)
+                elif entry['kind'] == 'knn_index':
+                    model = IVFNeighbors.from_arrays(values)
+                    if not approximate_knn:
+                        model.n_probe = model.n_lists
+                    elif knn_probes is not None:
+                        model.n_probe = knn_probes
+                else:
+                    model = CompiledTreeEnsemble.from_arrays(values)
+            models[task][model_name] = model
+    
+    return models
+
+def verify_bundle(bundle_dir):
+    """
+    Check every bundle file against the content hashes in its manifest
+    
+    Parameters:
+    bundle_dir (str): Bundle directory
+    
+    Returns:
+    list: Relative paths whose contents no longer match the manifest
+    """
+    with open(os.path.join(bundle_dir, BUNDLE_MANIFEST), "r") as f:
+        manifest = json.load(f)
+    
+    entries = [manifest['scaler']] + ([manifest['fused_linear']] if manifest['fused_linear'] else [])
+    files = []
+    for task_entries in manifest['models'].values():
+        for entry in task_entries.values():
+            entries.append(entry)
+            if 'native_path' in entry:
+                files.append((entry['native_path'], entry['native_sha256']))
+    for entry in entries:
+        files.extend((array['path'], array['sha256']) for array in entry['arrays'].values())
+    
+    return [path for path, digest in files if file_sha256(os.path.join(bundle_dir, path)) != digest]
+
+def is_bundle(model_dir):
+    """
+    Check whether a directory holds a bundle written by write_bundle
+    
+    Parameters:
+    model_dir (str): Directory to check
+    
+    Returns:
+    bool: True if the directory has a bundle manifest
+    """
+    return os.path.exists(os.path.join(model_dir, BUNDLE_MANIFEST))
+
+def load_bundle(bundle_dir='bundle', mmap=True, compiled=False, approximate_knn=False, knn_probes=None):
+    """
+    Return the models of a bundle from the in-process LRU cache
+    
+    The cache key includes the hash of the bundle manifest, so a bundle
+    rewritten in place is picked up on the next call.
+    
+    Parameters:
+    bundle_dir (str): Bundle directory
+    mmap (bool): Memory-map the arrays instead of reading them into memory
+    compiled (bool): Use the compiled node arrays for XGBoost
+    approximate_knn (bool): Scan only knn_probes index cells per KNN query
+    knn_probes (int): Index cells scanned per query, None for the saved default
+    
+    Returns:
+    dict: Models in the layout returned by load_models
+    """
+    with open(os.path.join(bundle_dir, BUNDLE_MANIFEST), "rb") as f:
+        manifest_hash = hashlib.sha256(f.read()).hexdigest()
+    
+    key = (os.path.abspath(bundle_dir), manifest_hash, mmap, compiled, approximate_knn, knn_probes)
+    if key in _bundle_cache:
+        _bundle_cache.move_to_end(key)
+        return _bundle_cache[key]
+    
+    models = read_bundle(bundle_dir, mmap=mmap, compiled=compiled, approximate_knn=approximate_knn,
+                         knn_probes=knn_probes)
+    _bundle_cache[key] = models
+    while len(_bundle_cache) > REGISTRY_CACHE_SIZE:
+        _bundle_cache.popitem(last=False)
+    return models
+
+if __name__ == "__main__":
+    import argparse
+    from predict import load_models
+    
+    parser = argparse.ArgumentParser(description="Convert saved models into a memory-mappable bundle")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--output', default='bundle', help="Bundle directory to write")
+    args = parser.parse_args()
+    
+    write_bundle(load_models(args.model_dir), args.output)
+    mismatched = verify_bundle(args.output)
+    if mismatched:
+        raise SystemExit(f"Bundle files do not match the manifest: {mismatched}")
@@ -0,0 +1,344 @@
+import pickle
+import json
+import os
+import hashlib
+import warnings
+from collections import OrderedDict
+from collections.abc import Mapping
+import profiling
+
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_VERSION = 1
+
+# Number of model directories / bundle versions kept loaded per process
+REGISTRY_CACHE_SIZE = 4
+
+_registry_cache = OrderedDict()
+
+def file_sha256(path, block_size=1 << 20):
+    """
+    Compute the SHA-256 hex digest of a file
+    
+    Parameters:
+    path (str): File to hash
+    block_size (int): Bytes read at a time
+    
+    Returns:
+    str: Hex digest
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_manifest(model_dir, feature_names, model_paths, extra_files=None):
+    """
+    Write the manifest describing every artifact in a model directory
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    feature_names (list): Feature names expected by the models
+    model_paths (dict): {task: {model_type: {'path': ..., ...}}} with paths relative
+                        to model_dir; optional alternative artifacts such as
+                        'mmap_path', 'compiled_path', 'index_path' or the
+                        compressed 'variants' are recorded as given
+    extra_files (dict): Other artifacts to record, {name: relative path}
+    
+    Returns:
+    dict: The manifest that was written
+    """
+    def entry(relative_path):
+        return {'path': relative_path, 'sha256': file_sha256(os.path.join(model_dir, relative_path))}
+    
+    manifest = {
+        'format_version': MANIFEST_VERSION,
+        'feature_names': feature_names,
+        'scaler': entry('scaler.pkl'),
+        'files': {name: entry(path) for name, path in (extra_files or {}).items()},
+        'models': {}
+    }
+    
+    for task, task_paths in model_paths.items():
+        manifest['models'][task] = {}
+        for model_type, paths in task_paths.items():
+            model_entry = entry(paths['path'])
+            model_entry.update({key: path for key, path in paths.items() if key != 'path'})
+            manifest['models'][task][model_type] = model_entry
+    
+    with open(os.path.join(model_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    
+    return manifest
+
+def read_manifest(model_dir):
+    """
+    Read the manifest of a model directory
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    
+    Returns:
+    tuple: (manifest dict, SHA-256 of the manifest file), or (None, None) if
+           the directory has no manifest
+    """
+    path = os.path.join(model_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None, None
+    
+    with open(path, "rb") as f:
+        raw = f.read()
+    return json.loads(raw), hashlib.sha256(raw).hexdigest()
+
+class LazyTaskModels(Mapping):
+    """
+    Read-only mapping of model_type -> model for one task that unpickles each
+    model the first time it is accessed
+    """
+    
+    def __init__(self, registry, task):
+        self._registry = registry
+        self._task = task
+    
+    def __getitem__(self, model_type):
+        return self._registry.get(self._task, model_type)
+    
+    def __iter__(self):
+        return iter(self._registry.model_types(self._task))
+    
+    def __len__(self):
+        return len(self._registry.model_types(self._task))
+
+def describe_variant(compiled=False, approximate_knn=False, knn_probes=None, variant=None):
+    """
+    Describe load options that change what the loaded models predict
+    
+    Together with the version, this identifies the predictions a set of
+    loaded models produces, e.g. for caching them.
+    
+    Parameters:
+    compiled (bool): Compiled tree ensembles are used
+    approximate_knn (bool): Approximate KNN indexes are used
+    knn_probes (int): Index cells scanned per query, None for the saved default
+    variant (str): Compressed model variant used, see compression.py
+    
+    Returns:
+    str: e.g. 'exact' or 'compact+compiled+approximate_knn:16'
+    """
+    parts = [variant] if variant else []
+    if compiled:
+        parts.append('compiled')
+    if approximate_knn:
+        parts.append('approximate_knn' if knn_probes is None else f"approximate_knn:{knn_probes}")
+    return '+'.join(parts) or 'exact'
+
+class ModelRegistry:
+    """
+    Models of one saved model directory, described by its manifest and loaded
+    lazily on first use. Use get_registry to share instances within a process.
+    """
+    
+    def __init__(self, model_dir='models', mmap=False, compiled=False, approximate_knn=False, knn_probes=None,
+                 variant=None, manifest=None, manifest_hash=None):
+        if manifest is None:
+            manifest, manifest_hash = read_manifest(model_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"No {MANIFEST_FILE} found in {model_dir}")
+        
+        self.model_dir = model_dir
+        self.manifest = manifest
+        self.version = manifest_hash
+        self.mmap = mmap
+        self.compiled = compiled
+        self.approximate_knn = approximate_knn
+        self.knn_probes = knn_probes
+        self.variant = variant
+        self._scaler = None
+        self._models = {}
+        self._as_models = None
+        if variant is not None:
+            self._check_variant()
+    
+    def _check_variant(self):
+        """
+        Make sure every model that should have the requested variant has it
+        
+        Raises:
+        ValueError: If the variant is unknown, or a random forest or KNN model
+                    was never compressed, so the variant would silently load
+                    the full model instead
+        """
+        from compression import COMPRESSED_MODEL_TYPES, VARIANTS
+        
+        if self.variant not in VARIANTS:
+            raise ValueError(f"Unknown variant '{self.variant}', expected one of {', '.join(VARIANTS)}")
+        for task, task_models in self.manifest['models'].items():
+            for model_type, entry in task_models.items():
+                if model_type not in COMPRESSED_MODEL_TYPES or self.variant in entry.get('variants', {}):
+                    continue
+                if 'variants' not in entry:
+                    raise ValueError(f"{task}/{model_type} in {self.model_dir} has no compressed variants, "
+                                     f"run compression.py to write the '{self.variant}' variant")
+                # Compressed, but this model could not be (e.g. a KNN model the index does not support)
+                warnings.warn(f"{task}/{model_type} has no '{self.variant}' variant, loading the full model")
+    
+    @property
+    def feature_names(self):
+        return self.manifest['feature_names']
+    
+    @property
+    def scaler(self):
+        if self._scaler is None:
+            with open(os.path.join(self.model_dir, self.manifest['scaler']['path']), "rb") as f:
+                self._scaler = pickle.load(f)
+        return self._scaler
+    
+    def model_types(self, task):
+        """
+        List the models saved for a task
+        
+        Parameters:
+        task (str): Prediction task name
+        
+        Returns:
+        list: Model types in manifest order
+        """
+        return list(self.manifest['models'].get(task, {}))
+    
+    def get(self, task, model_type):
+        """
+        Return a model, loading it on first access
+        
+        With a variant, models that have a compressed artifact of that name
+        (see compression.py) load it instead; the constructor rejects a
+        variant that random forests or KNN models were not compressed to.
+        Otherwise, with compiled=True, tree ensembles that were exported with
+        tree_compiler are loaded as CompiledTreeEnsemble instead, and with
+        approximate_knn=True KNN models with a saved index are loaded as
+        knn_index.IVFNeighbors scanning knn_probes cells per query. With
+        mmap=True, models that were also saved with joblib (the random
+        forests) are loaded with mmap_mode='r'; scikit-learn copies the node
+        arrays of every tree while unpickling it, so this does not share the
+        forests' memory between processes.
+        
+        Parameters:
+        task (str): Prediction task name
+        model_type (str): Model name within the task
+        
+        Returns:
+        object: Fitted model
+        """
+        key = (task, model_type)
+        if key not in self._models:
+            entry = self.manifest['models'][task][model_type]
+            variant_entry = entry.get('variants', {}).get(self.variant) if self.variant else None
+            with profiling.stage('load_model', 'load', task=task, model=model_type):
+                if variant_entry is not None:
+                    from compression import load_variant
+                    model = load_variant(os.path.join(self.model_dir, variant_entry['path']), variant_entry['kind'],
+                                         self.approximate_knn, self.knn_probes)
+                elif self.compiled and entry.get('compiled_path'):
+                    from tree_compiler import load_compiled
+                    model = load_compiled(os.path.join(self.model_dir, entry['compiled_path']))
+                elif self.approximate_knn and entry.get('index_path'):
+                    from knn_index import load_index
+                    model = load_index(os.path.join(self.model_dir, entry['index_path']), self.knn_probes)
+                elif self.mmap and entry.get('mmap_path'):
+                    import joblib
+                    model = joblib.load(os.path.join(self.model_dir, entry['mmap_path']), mmap_mode='r')
+                else:
+                    with open(os.path.join(self.model_dir, entry['path']), "rb") as f:
+                        model = pickle.load(f)
+            self._models[key] = model
+        return self._models[key]
+    
+    def loaded(self):
+        """
+        List the models that have been loaded so far
+        
+        Returns:
+        list: (task, model_type) tuples
+        """
+        return list(self._models)
+    
+    def verify(self):
+        """
+        Check every artifact against the content hashes in the manifest
+        
+        Returns:
+        list: Relative paths whose contents no longer match the manifest
+        """
+        entries = [self.manifest['scaler']] + list(self.manifest['files'].values())
+        for task_models in self.manifest['models'].values():
+            for entry in task_models.values():
+                entries.append(entry)
+                entries.extend(entry.get('variants', {}).values())
+        
+        return [entry['path'] for entry in entries
+                if file_sha256(os.path.join(self.model_dir, entry['path'])) != entry['sha256']]
+    
+    def as_models(self):
+        """
+        Expose the registry in the dictionary layout returned by load_models
+        
+        Returns:
+        dict: {'scaler', 'feature_names', 'version', 'variant', <task>: lazy mapping
+              of models}, plus 'fused_linear' if the directory holds fused linear models
+        """
+        if self._as_models is None:
+            models = {
+                'scaler': self.scaler,
+                'feature_names': self.feature_names,
+                'version': self.version,
+                'variant': describe_variant(self.compiled, self.approximate_knn, self.knn_probes, self.variant)
+            }
+            if 'fused_linear' in self.manifest['files']:
+                from fused_linear import FusedLinearScorer
+                models['fused_linear'] = FusedLinearScorer.load(
+                    os.path.join(self.model_dir, self.manifest['files']['fused_linear']['path']))
+            for task in self.manifest['models']:
+                models[task] = LazyTaskModels(self, task)
+            self._as_models = models
+        return self._as_models
+
+def get_registry(model_dir='models', mmap=False, compiled=False, approximate_knn=False, knn_probes=None,
+                 variant=None):
+    """
+    Return the registry for a model directory from the in-process LRU cache
+    
+    The cache key includes the manifest hash, so saving new models to the same
+    directory is picked up on the next call. The least recently used registry
+    is evicted once more than REGISTRY_CACHE_SIZE are held.
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    mmap (bool): Memory-map models saved with joblib
+    compiled (bool): Use compiled tree ensembles where available
+    approximate_knn (bool): Use the approximate KNN indexes where available
+    knn_probes (int): Index cells scanned per query, None for the saved default
+    variant (str): Compressed model variant to load where available
+    
+    Returns:
+    ModelRegistry: Registry for the directory, or None if it has no manifest
+    """
+    manifest, manifest_hash = read_manifest(model_dir)
+    if manifest is None:
+        return None
+    
+    key = (os.path.abspath(model_dir), manifest_hash, mmap, compiled, approximate_knn, knn_probes, variant)
+    if key in _registry_cache:
+        _registry_cache.move_to_end(key)
+        return _registry_cache[key]
+    
+    registry = ModelRegistry(model_dir, mmap=mmap, compiled=compiled, approximate_knn=approximate_knn,
+                             knn_probes=knn_probes, variant=variant, manifest=manifest, manifest_hash=manifest_hash)
+    _registry_cache[key] = registry
+    while len(_registry_cache) > REGISTRY_CACHE_SIZE:
+        _registry_cache.popitem(last=False)
+    return registry
+
+def clear_registry_cache():
+    """
+    Drop every cached registry, forcing the next load to read from disk
+    """
+    _registry_cache.clear()
@@ -0,0 +1,440 @@
+import os
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+from joblib import Parallel, delayed
+from sklearn.linear_model import SGDClassifier, SGDRegressor
+from sklearn.preprocessing import StandardScaler
+from chunked_io import infer_file_format, iter_csv_chunks
+from feature_encoder import CATEGORICAL_FIELDS, FeatureEncoder
+from drift import build_reference
+from train_models import (MODEL_SPECS, TASKS, TASK_TARGETS, apply_hyperparams, collect_metrics, evaluate_model,
+                          fit_model, plan_threads, resolve_n_jobs, save_metrics, save_models)
+import profiling
+
+# Models that need every training row at once are fitted on a uniform sample
+# of this many training rows; the test metrics of every model are computed on
+# a uniform sample of the same size of the hold-out rows
+DEFAULT_SAMPLE_SIZE = 100000
+
+# Incremental replacements of the closed-form linear models. Averaging the
+# iterates brings a single pass within noise of the closed-form solution, but
+# only once it skips the first SGD_AVERAGE_START samples: averaged from the
+# start, the early iterates dominate small datasets and leave the classifier's
+# probabilities far off the base rate. The classifier also needs a bounded
+# step; the default 'optimal' schedule starts with steps of order 1/alpha.
+SGD_AVERAGE_START = 10000
+SGD_REPLACEMENTS = {
+    'logistic_regression': (SGDClassifier, {'loss': 'log_loss', 'alpha': 1e-5, 'average': SGD_AVERAGE_START,
+                                            'learning_rate': 'constant', 'eta0': 0.01}),
+    'linear_regression': (SGDRegressor, {'loss': 'squared_error', 'alpha': 1e-5, 'average': SGD_AVERAGE_START})
+}
+
+def resolve_data_paths(data):
+    """
+    Expand the training data argument into a list of CSV/Parquet files
+    
+    Parameters:
+    data (str or list): A file, a list of files, a directory of shards written
+                        by generate_data.save_sample_data_sharded or any
+                        directory of .csv/.parquet files
+    
+    Returns:
+    list: File paths in order
+    """
+    if isinstance(data, (list, tuple)):
+        return list(data)
+    if not os.path.isdir(data):
+        return [data]
+    if os.path.exists(os.path.join(data, 'manifest.json')):
+        from generate_data import shard_paths
+        return shard_paths(data)
+    return sorted(os.path.join(data, name) for name in os.listdir(data)
+                  if name.endswith(('.csv', '.parquet', '.pq')))
+
+def read_columns(path):
+    """
+    Read the column names of a CSV or Parquet file without reading its rows
+    
+    Parameters:
+    path (str): Data file
+    
+    Returns:
+    list: Column names in file order
+    """
+    if infer_file_format(path) == 'parquet':
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).schema_arrow.names
+    return pd.read_csv(path, nrows=0).columns.tolist()
+
+def iter_chunks(paths, chunksize=100000, columns=None):
+    """
+    Read CSV/Parquet files lazily in chunks, one file after the other
+    
+    Parameters:
+    paths (list): Data files
+    chunksize (int): Maximum number of rows per chunk
+    columns (list): Optional subset of columns to read
+    
+    Returns:
+    generator: Yields pd.DataFrame chunks
+    """
+    for path in paths:
+        if infer_file_format(path) == 'parquet':
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+                yield batch.to_pandas()
+        else:
+            yield from iter_csv_chunks(path, chunksize=chunksize, usecols=columns)
+
+def scan_features(paths, chunksize=100000):
+    """
+    Derive the model features from a first pass over the categorical columns
+    
+    The feature names are those encode_training_features produces on the
+    whole dataset: the numeric columns in file order, then one dummy per
+    categorical level except the first (pd.get_dummies with drop_first=True).
+    
+    Parameters:
+    paths (list): Data files
+    chunksize (int): Rows read at a time
+    
+    Returns:
+    tuple: (feature names, total number of rows)
+    """
+    columns = read_columns(paths[0])
+    categorical = [field for field in CATEGORICAL_FIELDS if field in columns]
+    levels = {field: set() for field in categorical}
+    n_rows = 0
+    for chunk in iter_chunks(paths, chunksize, columns=categorical or columns[:1]):
+        n_rows += len(chunk)
+        for field in categorical:
+            levels[field].update(chunk[field].dropna().astype(str).unique())
+    
+    numeric = [column for column in columns if column not in TASK_TARGETS.values() and column not in categorical]
+    dummies = [f"{field}_{level}" for field in categorical for level in sorted(levels[field])[1:]]
+    return numeric + dummies, n_rows
+
+def iter_encoded(paths, encoder, chunksize=100000, test_size=0.2, seed=42):
+    """
+    Encode the data chunk by chunk and assign every row to train or test
+    
+    The split is drawn per chunk from a generator seeded with (seed, chunk
+    index), so every pass over the data sees the same split.
+    
+    Parameters:
+    paths (list): Data files
+    encoder (FeatureEncoder): Encoder for the model features
+    chunksize (int): Rows per chunk
+    test_size (float): Fraction of rows held out for testing
+    seed (int): Seed of the split
+    
+    Returns:
+    generator: Yields (unscaled features, {task: targets}, boolean test mask)
+    """
+    for chunk_index, chunk in enumerate(iter_chunks(paths, chunksize)):
+        X = encoder.encode_frame(chunk)
+        targets = {task: chunk[TASK_TARGETS[task]].to_numpy() for task in TASKS}
+        test = np.random.default_rng([seed, chunk_index]).random(len(chunk)) < test_size
+        yield X, targets, test
+
+class Reservoir:
+    """
+    Uniform sample of fixed size from a stream of rows (reservoir sampling,
+    Algorithm R), filled one chunk at a time
+    """
+    
+    def __init__(self, capacity, n_features, seed=42):
+        self.capacity = capacity
+        self.seen = 0
+        self.X = np.empty((capacity, n_features))
+        self.y = {task: np.empty(capacity) for task in TASKS}
+        self._rng = np.random.default_rng(seed)
+    
+    def add(self, X, targets):
+        """
+        Offer a chunk of rows to the sample
+        
+        Parameters:
+        X (np.ndarray): Features of the rows
+        targets (dict): Targets of the rows by task
+        """
+        n_rows = len(X)
+        # Rows that fit while the sample is still filling up
+        n_fill = max(0, min(n_rows, self.capacity - self.seen))
+        slots = np.arange(self.seen, self.seen + n_fill)
+        rows = np.arange(n_fill)
+        
+        # Every later row i replaces a random slot with probability capacity / (i + 1)
+        positions = np.arange(self.seen + n_fill, self.seen + n_rows)
+        draws = self._rng.integers(0, positions + 1)
+        accepted = np.flatnonzero(draws < self.capacity)
+        # A slot drawn twice keeps the later row, as sequential sampling would
+        last = np.unique(draws[accepted][::-1], return_index=True)[1]
+        accepted = accepted[::-1][last]
+        
+        slots = np.concatenate([slots, draws[accepted]])
+        rows = np.concatenate([rows, n_fill + accepted])
+        self.X[slots] = X[rows]
+        for task in TASKS:
+            self.y[task][slots] = targets[task][rows]
+        self.seen += n_rows
+    
+    def sample(self):
+        """
+        Return the sampled rows
+        
+        Returns:
+        tuple: (features, {task: targets})
+        """
+        n_rows = min(self.seen, self.capacity)
+        return self.X[:n_rows], {task: pd.Series(y[:n_rows]) for task, y in self.y.items()}
+
+class TrainingChunkIter(xgb.DataIter):
+    """
+    XGBoost data iterator streaming the scaled training rows of every chunk,
+    so the DMatrix is built (and with ExtMemQuantileDMatrix kept) in external
+    memory instead of from one in-memory array
+    """
+    
+    def __init__(self, paths, encoder, scaler, task, chunksize, test_size, seed, cache_prefix):
+        self._args = (paths, encoder, chunksize, test_size, seed)
+        self._scaler = scaler
+        self._task = task
+        self._chunks = None
+        super().__init__(cache_prefix=cache_prefix)
+    
+    def next(self, input_data):
+        if self._chunks is None:
+            self._chunks = iter_encoded(*self._args)
+        for X, targets, test in self._chunks:
+            if test.all():
+                continue
+            train = ~test
+            input_data(data=self._scaler.transform(X[train]), label=targets[self._task][train])
+            return True
+        return False
+    
+    def reset(self):
+        self._chunks = None
+
+def fit_xgboost(spec, paths, encoder, scaler, chunksize, test_size, seed, n_threads=1):
+    """
+    Train an XGBoost model on every training row through an external-memory iterator
+    
+    Parameters:
+    spec (dict): XGBoost entry of MODEL_SPECS
+    paths (list): Data files
+    encoder (FeatureEncoder): Encoder for the model features
+    scaler (StandardScaler): Fitted scaler
+    chunksize (int): Rows per chunk
+    test_size (float): Fraction of rows held out for testing
+    seed (int): Seed of the split
+    n_threads (int): Cores XGBoost may use
+    
+    Returns:
+    XGBClassifier or XGBRegressor: Fitted model, usable like one from fit_model
+    """
+    model = spec['estimator'](**spec['params'])
+    params = {key: value for key, value in model.get_xgb_params().items() if value is not None}
+    params['nthread'] = n_threads
+    
+    with tempfile.TemporaryDirectory() as cache_dir:
+        data_iter = TrainingChunkIter(paths, encoder, scaler, spec['task'], chunksize, test_size, seed,
+                                      os.path.join(cache_dir, 'cache'))
+        # Older XGBoost releases build external-memory DMatrix objects from the iterator directly
+        matrix_type = getattr(xgb, 'ExtMemQuantileDMatrix', xgb.DMatrix)
+        with profiling.stage('fit', 'fit', task=spec['task'], model=spec['name']):
+            dtrain = matrix_type(data_iter, nthread=n_threads)
+            booster = xgb.train(params, dtrain, num_boost_round=model.n_estimators)
+        # Release the cache pages before their directory is removed
+        del dtrain
+    
+    model.load_model(bytearray(booster.save_raw('ubj')))
+    return model
+
+def fit_sgd(model_name, task, paths, encoder, scaler, chunksize, test_size, seed, n_epochs=1):
+    """
+    Train the incremental replacement of a linear model with partial_fit over the chunks
+    
+    Parameters:
+    model_name (str): 'logistic_regression' or 'linear_regression'
+    task (str): Prediction task name
+    paths (list): Data files
+    encoder (FeatureEncoder): Encoder for the model features
+    scaler (StandardScaler): Fitted scaler
+    chunksize (int): Rows per chunk
+    test_size (float): Fraction of rows held out for testing
+    seed (int): Seed of the split
+    n_epochs (int): Passes over the training rows
+    
+    Returns:
+    SGDClassifier or SGDRegressor: Fitted model
+    """
+    estimator, params = SGD_REPLACEMENTS[model_name]
+    model = estimator(random_state=seed, **params)
+    with profiling.stage('fit', 'fit', task=task, model=model_name, epochs=n_epochs):
+        for _ in range(n_epochs):
+            for X, targets, test in iter_encoded(paths, encoder, chunksize, test_size, seed):
+                train = ~test
+                if not train.any():
+                    continue
+                if estimator is SGDClassifier:
+                    model.partial_fit(scaler.transform(X[train]), targets[task][train], classes=np.array([0, 1]))
+                else:
+                    model.partial_fit(scaler.transform(X[train]), targets[task][train])
+    return model
+
+def explain(model, spec, feature_names):
+    """
+    Global explanation of a model as fit_model records it
+    
+    Parameters:
+    model (object): Fitted model
+    spec (dict): Entry of MODEL_SPECS
+    feature_names (list): Feature names
+    
+    Returns:
+    dict: 'feature_importance' or 'coefficients', empty for models without one
+    """
+    if spec.get('explain') == 'feature_importance':
+        return {'feature_importance': dict(zip(feature_names, model.feature_importances_))}
+    if spec.get('explain') == 'coefficients':
+        return {'coefficients': dict(zip(feature_names, np.ravel(model.coef_)))}
+    return {}
+
+@profiling.profiled()
+def train_out_of_core(data, chunksize=100000, sample_size=DEFAULT_SAMPLE_SIZE, test_size=0.2, seed=42,
+                      n_epochs=1, n_jobs=1, hyperparams=None):
+    """
+    Train every model from CSV/Parquet files too large to load at once
+    
+    Only one chunk of rows is held in memory at a time:
+    
+    - a first pass reads the categorical columns to find the features,
+    - a second pass fits the scaler with partial_fit and draws uniform samples
+      of the training and the test rows,
+    - XGBoost trains on all training rows through an external-memory data
+      iterator, and the linear models are replaced by SGD models trained with
+      partial_fit over n_epochs passes,
+    - random forests and KNN models, which cannot learn incrementally, are
+      fitted on the training sample.
+    
+    Every model is evaluated on the test sample. The result has the layout
+    of train_models, so save_models writes the usual artifacts.
+    
+    Parameters:
+    data (str or list): Data files or a shard directory, see resolve_data_paths
+    chunksize (int): Rows per chunk
+    sample_size (int): Size of the training and the test sample
+    test_size (float): Fraction of rows held out for testing
+    seed (int): Seed of the split, the samples and the models
+    n_epochs (int): Passes of the SGD models over the training rows
+    n_jobs (int): Core budget, -1 uses all cores
+    hyperparams (dict): Hyperparameters overriding MODEL_SPECS, see train_models
+    
+    Returns:
+    tuple: (results as returned by train_models, performance metrics)
+    """
+    paths = resolve_data_paths(data)
+    with profiling.stage('scan', 'load', files=len(paths)):
+        feature_names, n_rows = scan_features(paths, chunksize)
+    encoder = FeatureEncoder(feature_names)
+    print(f"Training on {n_rows} rows in {len(paths)} files, {len(feature_names)} features")
+    
+    scaler = StandardScaler()
+    train_sample = Reservoir(sample_size, len(feature_names), seed)
+    test_sample = Reservoir(sample_size, len(feature_names), seed + 1)
+    with profiling.stage('fit_scaler', 'fit', rows=n_rows):
+        for X, targets, test in iter_encoded(paths, encoder, chunksize, test_size, seed):
+            train = ~test
+            if train.any():
+                scaler.partial_fit(X[train])
+            train_sample.add(X[train], {task: y[train] for task, y in targets.items()})
+            test_sample.add(X[test], {task: y[test] for task, y in targets.items()})
+    
+    X_train, y_train = train_sample.sample()
+    X_test, y_test = test_sample.sample()
+    # The training sample stands in for all training rows in the drift reference
+    drift_reference = build_reference(X_train, feature_names)
+    X_train_raw = X_train
+    X_train, X_test = scaler.transform(X_train), scaler.transform(X_test)
+    
+    results = {
+        'feature_names': feature_names,
+        'scaler': scaler,
+        'rows_seen': n_rows,
+        'drift_reference': drift_reference,
+        'mortality_classification': {},
+        'mortality_rate_regression': {},
+        'length_of_stay_regression': {}
+    }
+    
+    specs = apply_hyperparams(MODEL_SPECS, hyperparams)
+    sampled = [spec for spec in specs if spec['name'] in ('random_forest', 'knn')]
+    n_workers, threads = plan_threads(sampled, n_jobs)
+    entries = profiling.collect(Parallel(n_jobs=n_workers)(
+        delayed(profiling.run_collected)(profiling.is_enabled(), fit_model, spec, X_train, y_train[spec['task']],
+                                         X_test, y_test[spec['task']], feature_names, n_threads)
+        for spec, n_threads in zip(sampled, threads)
+    ))
+    sampled_entries = {(spec['task'], spec['name']): entry for spec, entry in zip(sampled, entries)}
+    
+    # Models are stored in MODEL_SPECS order, like train_models does
+    for spec in specs:
+        task, name = spec['task'], spec['name']
+        if (task, name) in sampled_entries:
+            results[task][name] = sampled_entries[(task, name)]
+            continue
+        
+        if name == 'xgboost':
+            model = fit_xgboost(spec, paths, encoder, scaler, chunksize, test_size, seed, resolve_n_jobs(n_jobs))
+            # Saved models predict one patient at a time, where a thread pool only adds
+            # overhead; n_jobs=None would mean all cores to XGBoost
+            model.set_params(n_jobs=1)
+        else:
+            model = fit_sgd(name, task, paths, encoder, scaler, chunksize, test_size, seed, n_epochs)
+        
+        entry = {'model': model}
+        with profiling.stage('evaluate', 'predict', task=task, model=name, rows=len(X_test)):
+            entry.update(evaluate_model(task, model, X_test, y_test[task]))
+        entry.update(explain(model, spec, feature_names))
+        results[task][name] = entry
+    
+    # The XGBoost models split on every training row, of which only the sample is at hand
+    from incremental import collect_split_values
+    fitted = [entry['model'] for task in TASKS for entry in results[task].values()]
+    results['split_values'] = collect_split_values(fitted, scaler, X_train_raw.T, feature_names)
+    
+    return results, collect_metrics(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train every model from CSV/Parquet files larger than memory")
+    parser.add_argument('data', nargs='+', help="Data files, or a directory of shards")
+    parser.add_argument('--chunksize', type=int, default=100000, help="Rows read at a time")
+    parser.add_argument('--sample-size', type=int, default=DEFAULT_SAMPLE_SIZE,
+                        help="Rows sampled for the random forests and KNN models, and for evaluation")
+    parser.add_argument('--epochs', type=int, default=1, help="Passes of the SGD linear models over the data")
+    parser.add_argument('--n-jobs', type=int, default=1, help="Core budget for training, -1 uses all cores")
+    parser.add_argument('--hyperparams', default=None,
+                        help="Tuned hyperparameters JSON (or its directory) written by tuning.py")
+    parser.add_argument('--output-dir', default='models', help="Directory to save models and metrics")
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help="Record per-stage timings and write them to PATH (plus a Chrome trace)")
+    args = parser.parse_args()
+    
+    if args.profile:
+        profiling.enable_from_cli(args.profile)
+    
+    hyperparams = None
+    if args.hyperparams:
+        from tuning import load_hyperparams
+        hyperparams = load_hyperparams(args.hyperparams)
+    
+    data = args.data[0] if len(args.data) == 1 else args.data
+    results, metrics = train_out_of_core(data, chunksize=args.chunksize, sample_size=args.sample_size,
+                                         n_epochs=args.epochs, n_jobs=args.n_jobs, hyperparams=hyperparams)
+    save_models(results, args.output_dir)
+    save_metrics(metrics, os.path.join(args.output_dir, 'performance_metrics.json'))
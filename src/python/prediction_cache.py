@@ -0,0 +1,194 @@
+import time
+import hashlib
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_TTL_SECONDS = 15 * 60
+
+# Every live cache, so save_models can invalidate them all
+_caches = weakref.WeakSet()
+
+class PredictionCache:
+    """
+    Bounded LRU cache of per-patient predictions with a time-to-live
+    
+    Entries are keyed by a hash of the encoded feature vector, so the same
+    patient submitted again with its fields in another order, with extra
+    fields or with numbers sent as strings still hits. Every entry belongs to
+    one model version and variant (see model_registry.describe_variant): a
+    lookup for other models misses, and the first lookup for a new version
+    drops the entries of the previous one. The cache is thread-safe.
+    """
+    
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl_seconds=DEFAULT_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._models_key = None
+        self._lock = threading.Lock()
+        _caches.add(self)
+    
+    def __len__(self):
+        return len(self._entries)
+    
+    @staticmethod
+    def row_keys(X):
+        """
+        Hash every row of an encoded feature matrix
+        
+        Parameters:
+        X (np.ndarray): Encoded (unscaled) features, one row per patient
+        
+        Returns:
+        list: One bytes key per row
+        """
+        # Adding 0.0 turns -0.0 into 0.0, so both encode to the same key
+        rows = np.ascontiguousarray(X, dtype=np.float64) + 0.0
+        return [hashlib.blake2b(row.tobytes(), digest_size=16).digest() for row in rows]
+    
+    def _check_models(self, models_key):
+        if models_key != self._models_key:
+            if self._entries:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+            self._models_key = models_key
+    
+    def get_many(self, keys, models_key):
+        """
+        Look up the predictions of several patients
+        
+        Parameters:
+        keys (list): Row keys from row_keys
+        models_key (tuple): (version, variant) of the models
+        
+        Returns:
+        list: Cached predictions, None for misses
+        """
+        now = time.monotonic()
+        results = []
+        with self._lock:
+            self._check_models(models_key)
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and now - entry[0] > self.ttl_seconds:
+                    del self._entries[key]
+                    self.expirations += 1
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    results.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    results.append(entry[1])
+        return results
+    
+    def put_many(self, keys, values, models_key):
+        """
+        Store the predictions of several patients
+        
+        Parameters:
+        keys (list): Row keys from row_keys
+        values (list): Per-patient predictions
+        models_key (tuple): (version, variant) of the models that produced them
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._check_models(models_key)
+            for key, value in zip(keys, values):
+                self._entries[key] = (now, value)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self):
+        """
+        Drop every entry
+        """
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._models_key = None
+    
+    def stats(self):
+        """
+        Summarize the counters
+        
+        Returns:
+        dict: JSON-serializable cache statistics
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+def models_cache_key(models):
+    """
+    Identify the predictions a set of loaded models produces
+    
+    Parameters:
+    models (dict): Models as returned by load_models
+    
+    Returns:
+    tuple: (version, variant), or None for models without a version (loaded
+           from a directory without manifest), which are never cached
+    """
+    if models.get('version') is None:
+        return None
+    return (models['version'], models.get('variant', 'exact'))
+
+def copy_predictions(predictions):
+    """
+    Copy per-patient predictions, so callers can modify what they get back
+    without changing the cached entry
+    
+    Parameters:
+    predictions (dict): Predictions in the format of predict_patient_outcomes
+    
+    Returns:
+    dict: Copy
+    """
+    return {task: {name: dict(value) if isinstance(value, dict) else value for name, value in task_predictions.items()}
+            for task, task_predictions in predictions.items()}
+
+def invalidate_prediction_caches():
+    """
+    Drop the entries of every prediction cache in this process, e.g. after new
+    models were saved
+    """
+    for cache in list(_caches):
+        cache.invalidate()
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+def get_prediction_cache():
+    """
+    Return the process-wide prediction cache, creating it on first use
+    
+    Returns:
+    PredictionCache: Shared cache with the default size and TTL
+    """
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PredictionCache()
+        return _default_cache
@@ -0,0 +1,359 @@
+import json
+import os
+import time
+import atexit
+import threading
+import functools
+import contextlib
+
+# Set to 1 to record stages from the start of the process; the events are
+# written to PROFILE_OUTPUT_ENV (default profile.json, plus a Chrome trace
+# next to it) when the process exits
+PROFILE_ENV = 'MODEL_PROFILE'
+PROFILE_OUTPUT_ENV = 'MODEL_PROFILE_OUTPUT'
+# Set to 1 to also record the peak Python heap of every stage with tracemalloc,
+# which slows allocation-heavy code down noticeably
+PROFILE_TRACEMALLOC_ENV = 'MODEL_PROFILE_TRACEMALLOC'
+# Process that writes the profile; pool workers inherit PROFILE_ENV but hand
+# their stages back to it instead of writing files of their own
+PROFILE_OWNER_ENV = 'MODEL_PROFILE_OWNER'
+
+DEFAULT_PROFILE_OUTPUT = 'profile.json'
+
+# Shared no-op context manager returned while profiling is off
+_DISABLED = contextlib.nullcontext()
+
+_enabled = False
+_tracemalloc = False
+_events = []
+_lock = threading.Lock()
+_local = threading.local()
+
+def _peak_rss_mb():
+    import resource
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def enable(tracemalloc=False):
+    """
+    Start recording stages
+    
+    Sets PROFILE_ENV as well, so process-pool workers started afterwards
+    record their stages too (see run_collected).
+    
+    Parameters:
+    tracemalloc (bool): Also record the peak Python heap of every stage
+    """
+    global _enabled, _tracemalloc
+    _enabled = True
+    _tracemalloc = tracemalloc
+    os.environ[PROFILE_ENV] = '1'
+    if tracemalloc:
+        import tracemalloc as tm
+        os.environ[PROFILE_TRACEMALLOC_ENV] = '1'
+        if not tm.is_tracing():
+            tm.start()
+
+def disable():
+    """
+    Stop recording stages; recorded events are kept until reset()
+    """
+    global _enabled
+    _enabled = False
+    os.environ.pop(PROFILE_ENV, None)
+
+def is_enabled():
+    return _enabled
+
+def reset():
+    """
+    Drop all recorded events
+    """
+    with _lock:
+        _events.clear()
+
+def events():
+    """
+    Return a copy of the recorded events
+    
+    Returns:
+    list: One dictionary per finished stage, in order of completion
+    """
+    with _lock:
+        return list(_events)
+
+class _Stage:
+    """
+    Context manager recording one stage while profiling is enabled
+    """
+    
+    __slots__ = ('name', 'category', 'args', 'start', 'cpu_start', 'rss_start', 'heap_peak')
+    
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+    
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        if _tracemalloc:
+            import tracemalloc
+            # Fold the parent's peak so far into it before the peak is reset for this stage
+            if stack:
+                stack[-1].heap_peak = max(stack[-1].heap_peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self.heap_peak = 0
+        stack.append(self)
+        self.rss_start = _peak_rss_mb()
+        self.cpu_start = time.process_time()
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu_start
+        peak_rss = _peak_rss_mb()
+        stack = _local.stack
+        stack.pop()
+        
+        event = {
+            'name': self.name,
+            'category': self.category,
+            'start': self.start,
+            'wall_seconds': wall,
+            'cpu_seconds': cpu,
+            'peak_rss_mb': peak_rss,
+            'rss_growth_mb': peak_rss - self.rss_start,
+            'depth': len(stack),
+            'pid': os.getpid(),
+            'tid': threading.get_ident()
+        }
+        if _tracemalloc:
+            import tracemalloc
+            heap_peak = max(self.heap_peak, tracemalloc.get_traced_memory()[1])
+            event['heap_peak_mb'] = heap_peak / 2 ** 20
+            if stack:
+                stack[-1].heap_peak = max(stack[-1].heap_peak, heap_peak)
+        if exc_type is not None:
+            event['error'] = exc_type.__name__
+        if self.args:
+            event['args'] = self.args
+        
+        with _lock:
+            _events.append(event)
+        return False
+
+def stage(name, category='stage', **args):
+    """
+    Time a block of code
+    
+    Records wall time, CPU time of the process and the peak RSS (plus the
+    peak Python heap when tracemalloc is on) of the block. While profiling is
+    off this returns a shared no-op context manager, so instrumented code
+    pays one function call and one flag check.
+    
+    Parameters:
+    name (str): Stage name
+    category (str): Stage category, e.g. 'fit' or 'predict'
+    **args: Details kept with the event, e.g. task and model names
+    
+    Returns:
+    object: Context manager
+    """
+    if not _enabled:
+        return _DISABLED
+    return _Stage(name, category, args)
+
+def profiled(name=None, category='stage'):
+    """
+    Decorator timing every call of a function as a stage
+    
+    Parameters:
+    name (str): Stage name, defaults to the function name
+    category (str): Stage category
+    
+    Returns:
+    callable: Decorator
+    """
+    def decorator(func):
+        stage_name = name or func.__name__
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(stage_name, category, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def run_collected(profile, func, *args, **kwargs):
+    """
+    Run a function in a process-pool worker and hand back its stages
+    
+    Parameters:
+    profile (bool): Whether the parent process is profiling
+    func (callable): Function to run
+    *args, **kwargs: Its arguments
+    
+    Returns:
+    tuple: (result, list of events recorded by the call)
+    """
+    if not profile:
+        return func(*args, **kwargs), []
+    if not _enabled:
+        enable(tracemalloc=os.environ.get(PROFILE_TRACEMALLOC_ENV) == '1')
+    
+    with _lock:
+        mark = len(_events)
+    result = func(*args, **kwargs)
+    with _lock:
+        recorded = _events[mark:]
+        del _events[mark:]
+    return result, recorded
+
+def collect(results):
+    """
+    Unpack the results of run_collected calls, keeping the workers' stages
+    
+    Parameters:
+    results (list): (result, events) pairs
+    
+    Returns:
+    list: The results
+    """
+    with _lock:
+        for _, recorded in results:
+            _events.extend(recorded)
+    return [result for result, _ in results]
+
+def summarize(recorded=None):
+    """
+    Aggregate events by stage name
+    
+    Parameters:
+    recorded (list): Events, defaults to everything recorded so far
+    
+    Returns:
+    dict: Per stage: call count, total/mean/max wall seconds, total CPU
+          seconds and the highest peak RSS (and heap)
+    """
+    recorded = events() if recorded is None else recorded
+    summary = {}
+    for event in recorded:
+        entry = summary.setdefault(event['name'], {'calls': 0, 'wall_seconds': 0.0, 'max_wall_seconds': 0.0,
+                                                   'cpu_seconds': 0.0, 'peak_rss_mb': 0.0})
+        entry['calls'] += 1
+        entry['wall_seconds'] += event['wall_seconds']
+        entry['max_wall_seconds'] = max(entry['max_wall_seconds'], event['wall_seconds'])
+        entry['cpu_seconds'] += event['cpu_seconds']
+        entry['peak_rss_mb'] = max(entry['peak_rss_mb'], event['peak_rss_mb'])
+        if 'heap_peak_mb' in event:
+            entry['heap_peak_mb'] = max(entry.get('heap_peak_mb', 0.0), event['heap_peak_mb'])
+    
+    for entry in summary.values():
+        entry['mean_wall_seconds'] = entry['wall_seconds'] / entry['calls']
+    return summary
+
+def write_json(path=DEFAULT_PROFILE_OUTPUT):
+    """
+    Write the recorded events and their per-stage summary to a JSON file
+    
+    Parameters:
+    path (str): Output file
+    """
+    recorded = events()
+    with open(path, "w") as f:
+        json.dump({'summary': summarize(recorded), 'events': recorded}, f, indent=2)
+
+def write_chrome_trace(path):
+    """
+    Write the recorded events in Chrome trace format
+    
+    The file opens in chrome://tracing or https://ui.perfetto.dev, with one
+    row per process and thread and nested stages drawn inside each other.
+    
+    Parameters:
+    path (str): Output file
+    """
+    recorded = events()
+    origin = min((event['start'] for event in recorded), default=0.0)
+    trace_events = []
+    for event in recorded:
+        args = {k: v for k, v in event.items() if k not in ('name', 'category', 'start', 'wall_seconds', 'pid', 'tid',
+                                                            'depth', 'args')}
+        args.update(event.get('args', {}))
+        trace_events.append({
+            'name': event['name'],
+            'cat': event['category'],
+            'ph': 'X',
+            'ts': (event['start'] - origin) * 1e6,
+            'dur': event['wall_seconds'] * 1e6,
+            'pid': event['pid'],
+            'tid': event['tid'],
+            'args': args
+        })
+    
+    with open(path, "w") as f:
+        json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+
+def chrome_trace_path(path):
+    """
+    Derive the Chrome trace file name from a profile JSON path
+    
+    Parameters:
+    path (str): Profile JSON path, e.g. profile.json
+    
+    Returns:
+    str: e.g. profile.trace.json
+    """
+    root, ext = os.path.splitext(path)
+    return f"{root}.trace{ext or '.json'}"
+
+def write_profile(path=DEFAULT_PROFILE_OUTPUT):
+    """
+    Write the JSON profile and the Chrome trace next to it, and print the slowest stages
+    
+    Parameters:
+    path (str): Profile JSON path
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    write_json(path)
+    write_chrome_trace(chrome_trace_path(path))
+    
+    summary = sorted(summarize().items(), key=lambda item: item[1]['wall_seconds'], reverse=True)
+    for name, entry in summary[:10]:
+        print(f"{name}: {entry['calls']} calls, {entry['wall_seconds']:.3f}s wall, {entry['cpu_seconds']:.3f}s CPU, "
+              f"peak RSS {entry['peak_rss_mb']:.0f} MB")
+    print(f"Profile saved to {path} and {chrome_trace_path(path)}")
+
+def _write_at_exit():
+    if _events:
+        write_profile(os.environ.get(PROFILE_OUTPUT_ENV, DEFAULT_PROFILE_OUTPUT))
+
+def enable_from_cli(path):
+    """
+    Switch profiling on for a --profile command-line flag
+    
+    Parameters:
+    path (str): Where to write the profile when the process exits
+    """
+    os.environ[PROFILE_OUTPUT_ENV] = path
+    os.environ[PROFILE_OWNER_ENV] = str(os.getpid())
+    enable(tracemalloc=os.environ.get(PROFILE_TRACEMALLOC_ENV) == '1')
+    _register_exit_hook()
+
+_exit_hook_registered = False
+
+def _register_exit_hook():
+    global _exit_hook_registered
+    if not _exit_hook_registered:
+        atexit.register(_write_at_exit)
+        _exit_hook_registered = True
+
+if os.environ.get(PROFILE_ENV) == '1':
+    enable(tracemalloc=os.environ.get(PROFILE_TRACEMALLOC_ENV) == '1')
+    if os.environ.setdefault(PROFILE_OWNER_ENV, str(os.getpid())) == str(os.getpid()):
+        _register_exit_hook()
@@ -0,0 +1,388 @@
+import asyncio
+import argparse
+import json
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from predict import TASKS, load_models, predict_encoded, split_batch_predictions
+from feature_encoder import get_feature_encoder
+from prediction_cache import DEFAULT_MAX_ENTRIES, DEFAULT_TTL_SECONDS, PredictionCache, copy_predictions, models_cache_key
+from drift import load_monitor
+
+MAX_BODY_BYTES = 1 << 20
+
+HTTP_REASONS = {200: 'OK', 204: 'No Content', 400: 'Bad Request', 404: 'Not Found',
+                405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+# Exceptions raised by the prediction path for malformed patient data
+CLIENT_ERRORS = (KeyError, ValueError, TypeError)
+
+class ServiceMetrics:
+    """
+    Request, batch and latency counters of the prediction service. Latencies
+    are kept for the most recent window_size requests only.
+    """
+    
+    def __init__(self, window_size=10000):
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+        self.batched_patients = 0
+        self.max_batch_size = 0
+        self.max_queue_depth = 0
+        self.latencies = deque(maxlen=window_size)
+        self.batch_latencies = deque(maxlen=window_size)
+    
+    def record_batch(self, batch_size, seconds):
+        self.batches += 1
+        self.batched_patients += batch_size
+        self.max_batch_size = max(self.max_batch_size, batch_size)
+        self.batch_latencies.append(seconds)
+    
+    def record_request(self, seconds, error=False):
+        self.requests += 1
+        self.errors += int(error)
+        self.latencies.append(seconds)
+    
+    def snapshot(self, queue_depth):
+        """
+        Summarize the counters
+        
+        Parameters:
+        queue_depth (int): Number of patients currently waiting to be batched
+        
+        Returns:
+        dict: JSON-serializable metrics
+        """
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        
+        def percentiles(values):
+            if not values:
+                return None
+            ms = np.asarray(values) * 1000
+            return {'p50': float(np.percentile(ms, 50)), 'p90': float(np.percentile(ms, 90)),
+                    'p99': float(np.percentile(ms, 99)), 'max': float(ms.max())}
+        
+        return {
+            'uptime_seconds': time.time() - self.started,
+            'requests': self.requests,
+            'errors': self.errors,
+            'batches': self.batches,
+            'mean_batch_size': self.batched_patients / self.batches if self.batches else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'request_latency_ms': percentiles(self.latencies),
+            'batch_latency_ms': percentiles(self.batch_latencies)
+        }
+
+class MicroBatcher:
+    """
+    Coalesces concurrent prediction requests into batches
+    
+    The first queued patient opens a batch; patients arriving within
+    max_wait_ms join it until max_batch_size is reached. Each batch is scored
+    with predict_encoded on a thread pool, so the event loop keeps accepting
+    requests while the models run. With a prediction cache, patients scored
+    before are answered straight away without joining a batch. With a drift
+    monitor, every scored patient (cached or not) is added to its statistics once.
+    """
+    
+    def __init__(self, models, max_batch_size=64, max_wait_ms=5.0, n_threads=2, metrics=None, cache=None,
+                 monitor=None):
+        self.models = models
+        self.cache = cache
+        self.monitor = monitor
+        self.models_key = models_cache_key(models)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = metrics or ServiceMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix='predict')
+        self.queue = None
+        self._collector = None
+        self._pending = set()
+    
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+    
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._collector = asyncio.create_task(self._collect())
+    
+    async def stop(self):
+        if self._collector is not None:
+            self._collector.cancel()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+        self.executor.shutdown(wait=True)
+    
+    async def submit(self, patient):
+        """
+        Queue one patient and wait for its predictions
+        
+        Parameters:
+        patient (dict): Patient data as accepted by predict_patient_outcomes
+        
+        Returns:
+        dict: Predictions in the format of predict_patient_outcomes
+        """
+        key = None
+        if self.cache is not None and self.models_key is not None:
+            X = get_feature_encoder(self.models['feature_names']).encode(patient)
+            key = self.cache.row_keys(X)[0]
+            cached = self.cache.get_many([key], self.models_key)[0]
+            if cached is not None:
+                if self.monitor is not None:
+                    self.monitor.update(X)
+                return copy_predictions(cached)
+        
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((patient, key, future))
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.queue.qsize())
+        return await future
+    
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            task = asyncio.create_task(self._score(batch))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+    
+    def _score_sync(self, patients, keys):
+        start = time.perf_counter()
+        encoder = get_feature_encoder(self.models['feature_names'])
+        try:
+            X = encoder.encode(patients)
+            results = split_batch_predictions(predict_encoded(X, self.models), len(patients))
+        except CLIENT_ERRORS:
+            # One malformed patient must not fail the rest of the batch
+            results, rows = [], []
+            for patient in patients:
+                try:
+                    x = encoder.encode([patient])
+                    results.append(split_batch_predictions(predict_encoded(x, self.models), 1)[0])
+                    rows.append(x)
+                except CLIENT_ERRORS as e:
+                    results.append(e)
+            X = np.vstack(rows) if rows else None
+        
+        # Only patients that were scored, each once
+        if self.monitor is not None and X is not None:
+            self.monitor.update(X)
+        
+        if self.cache is not None:
+            scored = [(key, result) for key, result in zip(keys, results)
+                      if key is not None and not isinstance(result, Exception)]
+            self.cache.put_many([key for key, _ in scored], [copy_predictions(result) for _, result in scored],
+                                self.models_key)
+        return results, time.perf_counter() - start
+    
+    async def _score(self, batch):
+        patients = [patient for patient, _, _ in batch]
+        keys = [key for _, key, _ in batch]
+        loop = asyncio.get_running_loop()
+        try:
+            results, seconds = await loop.run_in_executor(self.executor, self._score_sync, patients, keys)
+            # Metrics are only touched from the event loop thread
+            self.metrics.record_batch(len(batch), seconds)
+        except Exception as e:
+            results = [e] * len(batch)
+        
+        for (_, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+class PredictionServer:
+    """
+    Minimal asyncio HTTP/1.1 server for patient outcome predictions
+    
+    Endpoints:
+    POST /predict   patient JSON object (or a list of them) -> predictions
+    GET  /metrics   latency, batching and queue-depth metrics (plus prediction
+                    cache counters when caching is on)
+    GET  /drift     drift snapshot of the patients scored so far, see drift.py
+    GET  /health    liveness check
+    """
+    
+    def __init__(self, models, max_batch_size=64, max_wait_ms=5.0, n_threads=2, cache=None, monitor=None):
+        self.models = models
+        self.monitor = monitor
+        self.metrics = ServiceMetrics()
+        self.batcher = MicroBatcher(models, max_batch_size, max_wait_ms, n_threads, self.metrics, cache, monitor)
+    
+    async def handle_predict(self, body):
+        start = time.perf_counter()
+        try:
+            payload = json.loads(body)
+            if isinstance(payload, list):
+                result = await asyncio.gather(*[self.batcher.submit(patient) for patient in payload])
+            elif isinstance(payload, dict):
+                result = await self.batcher.submit(payload)
+            else:
+                raise ValueError("Expected a patient object or a list of patient objects")
+        except CLIENT_ERRORS as e:
+            self.metrics.record_request(time.perf_counter() - start, error=True)
+            return 400, {'error': f"{type(e).__name__}: {e}"}
+        except Exception as e:
+            self.metrics.record_request(time.perf_counter() - start, error=True)
+            return 500, {'error': f"{type(e).__name__}: {e}"}
+        
+        self.metrics.record_request(time.perf_counter() - start)
+        return 200, result
+    
+    async def route(self, method, path, body):
+        path = path.split('?', 1)[0]
+        if method == 'OPTIONS':
+            return 204, None
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': "Use POST"}
+            return await self.handle_predict(body)
+        if path == '/metrics' and method == 'GET':
+            snapshot = self.metrics.snapshot(self.batcher.queue_depth)
+            if self.batcher.cache is not None:
+                snapshot['prediction_cache'] = self.batcher.cache.stats()
+            return 200, snapshot
+        if path == '/drift' and method == 'GET':
+            if self.monitor is None:
+                return 404, {'error': "Drift monitoring is off, the models were saved without a drift reference"}
+            return 200, self.monitor.snapshot()
+        if path == '/health' and method == 'GET':
+            return 200, {'status': 'ok', 'version': self.models.get('version')}
+        return 404, {'error': f"No route for {method} {path}"}
+    
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                method, path, version = request_line.decode('latin-1').split()
+                
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                
+                length = int(headers.get('content-length') or 0)
+                if length > MAX_BODY_BYTES:
+                    status, payload = 413, {'error': f"Body larger than {MAX_BODY_BYTES} bytes"}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(length)
+                    status, payload = await self.route(method.upper(), path, body)
+                    keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close')
+                
+                self.write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+    
+    @staticmethod
+    def write_response(writer, status, payload, keep_alive):
+        body = b'' if payload is None else json.dumps(payload).encode('utf-8')
+        headers = [
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Access-Control-Allow-Origin: *",
+            "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+            "Access-Control-Allow-Headers: Content-Type",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}"
+        ]
+        writer.write(('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body)
+    
+    async def serve(self, host='127.0.0.1', port=8000):
+        await self.batcher.start()
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving predictions on http://{host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+def run_server(model_dir='models', host='127.0.0.1', port=8000, max_batch_size=64, max_wait_ms=5.0, n_threads=2,
+               cache_size=DEFAULT_MAX_ENTRIES, cache_ttl=DEFAULT_TTL_SECONDS, drift_snapshot=None):
+    """
+    Load the models once and serve predictions until interrupted
+    
+    Parameters:
+    model_dir (str): Directory containing saved models
+    host (str): Interface to listen on
+    port (int): Port to listen on
+    max_batch_size (int): Largest number of patients scored together
+    max_wait_ms (float): How long a batch waits for more patients to arrive
+    n_threads (int): Threads running the models
+    cache_size (int): Patients kept in the prediction cache, 0 disables it
+    cache_ttl (float): Seconds a cached prediction stays valid
+    drift_snapshot (str): Write the drift snapshot to this JSON file on shutdown;
+                          drift is monitored whenever the models have a drift reference
+    """
+    models = load_models(model_dir)
+    
+    # Load every model now instead of on the first request
+    for task in TASKS:
+        dict(models.get(task, {}))
+    
+    cache = PredictionCache(cache_size, cache_ttl) if cache_size > 0 else None
+    monitor = load_monitor(model_dir)
+    server = PredictionServer(models, max_batch_size, max_wait_ms, n_threads, cache, monitor)
+    try:
+        asyncio.run(server.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if monitor is not None and drift_snapshot:
+            monitor.write_snapshot(drift_snapshot)
+            print(f"Drift snapshot saved to {drift_snapshot}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve patient outcome predictions over HTTP")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--host', default='127.0.0.1', help="Interface to listen on")
+    parser.add_argument('--port', type=int, default=8000, help="Port to listen on")
+    parser.add_argument('--max-batch-size', type=int, default=64, help="Largest number of patients scored together")
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help="Micro-batching window in milliseconds")
+    parser.add_argument('--threads', type=int, default=2, help="Threads running the models")
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_MAX_ENTRIES,
+                        help="Patients kept in the prediction cache, 0 disables it")
+    parser.add_argument('--cache-ttl', type=float, default=DEFAULT_TTL_SECONDS,
+                        help="Seconds a cached prediction stays valid")
+    parser.add_argument('--drift-snapshot', default=None, metavar='PATH',
+                        help="Write the drift snapshot of the scored patients to PATH on shutdown")
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help="Record per-stage timings and write them to PATH (plus a Chrome trace) on shutdown")
+    args = parser.parse_args()
+    
+    if args.profile:
+        import profiling
+        profiling.enable_from_cli(args.profile)
+    
+    run_server(args.model_dir, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.threads,
+               args.cache_size, args.cache_ttl, args.drift_snapshot)
@@ -0,0 +1,47 @@
+import os
+import sys
+import pytest
+
+# The modules live side by side in src/python and import each other by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Smaller ensembles than MODEL_SPECS keep the fixtures fast
+FAST_HYPERPARAMS = {
+    task: {'random_forest': {'n_estimators': 20}, 'xgboost': {'n_estimators': 20}}
+    for task in ('mortality_classification', 'mortality_rate_regression', 'length_of_stay_regression')
+}
+
+@pytest.fixture(scope='session')
+def training_data():
+    from generate_data import generate_sample_data
+    return generate_sample_data(400, seed=3)
+
+@pytest.fixture(scope='session')
+def make_patients():
+    """
+    Factory of patient records without the outcome columns, as sent for prediction
+    """
+    from generate_data import generate_sample_data
+    from train_models import TASK_TARGETS
+    
+    def make(n_rows, seed=5):
+        data = generate_sample_data(n_rows, seed=seed).drop(columns=list(TASK_TARGETS.values()))
+        return data.to_dict(orient='records')
+    return make
+
+@pytest.fixture(scope='session')
+def trained(training_data):
+    from train_models import train_models
+    results, _ = train_models(training_data, hyperparams=FAST_HYPERPARAMS)
+    return results
+
+@pytest.fixture(scope='session')
+def models(trained):
+    """
+    Trained models in the dictionary layout returned by load_models
+    """
+    from predict import TASKS
+    models = {'scaler': trained['scaler'], 'feature_names': trained['feature_names']}
+    for task in TASKS:
+        models[task] = {name: entry['model'] for name, entry in trained[task].items()}
+    return models
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+from compression import (DEFAULT_TOLERANCE, compress_models, compress_random_forest, keep_trees, prune_depth,
+                         to_float32, validation_score)
+from feature_encoder import get_feature_encoder
+from model_registry import ModelRegistry
+from predict import TASKS, load_models, scale_features
+from train_models import TASK_TARGETS, save_models
+from tree_compiler import CompiledTreeEnsemble, compile_random_forest
+
+@pytest.fixture(scope='module')
+def compressed_dir(trained, training_data, tmp_path_factory):
+    model_dir = str(tmp_path_factory.mktemp('compressed'))
+    save_models(trained, model_dir, knn_index=False)
+    compress_models(model_dir, training_data)
+    return model_dir
+
+@pytest.fixture(scope='module')
+def validation(models, training_data):
+    X = scale_features(models['scaler'], get_feature_encoder(models['feature_names']).encode(training_data))
+    return X, {task: training_data[TASK_TARGETS[task]].to_numpy() for task in TASKS}
+
+def threshold_rows(compiled, X, n_rows=200, seed=0):
+    # Rows whose split feature sits exactly at, just below and just above a
+    # threshold, where float32 rounding of the thresholds would show
+    rng = np.random.default_rng(seed)
+    nodes = rng.choice(np.flatnonzero(np.isfinite(compiled.threshold)), n_rows)
+    rows = np.asarray(X, dtype=np.float32)[rng.integers(0, len(X), n_rows)]
+    at = compiled.threshold[nodes].astype(np.float32)
+    edges = []
+    for value in (np.nextafter(at, np.float32(-np.inf)), at, np.nextafter(at, np.float32(np.inf))):
+        edge = rows.copy()
+        edge[np.arange(n_rows), compiled.feature[nodes]] = value
+        edges.append(edge)
+    return np.concatenate(edges)
+
+@pytest.mark.parametrize('task', TASKS)
+def test_float32_variant_keeps_every_split(models, validation, task):
+    model = models[task]['random_forest']
+    compiled = compile_random_forest(model)
+    X = np.concatenate([validation[0], threshold_rows(compiled, validation[0])]).astype(np.float32)
+    
+    float32 = to_float32(compiled)
+    
+    assert float32.threshold.dtype == np.float32
+    np.testing.assert_array_equal(float32.apply(X), compiled.apply(X))
+    expected = model.predict_proba(X)[:, 1] if task == 'mortality_classification' else model.predict(X)
+    np.testing.assert_allclose(float32.decision_function(X), expected, rtol=1e-6, atol=1e-6)
+
+def test_pruning_and_tree_selection_match_the_forest(models, validation):
+    model = models['length_of_stay_regression']['random_forest']
+    compiled = compile_random_forest(model)
+    X = validation[0]
+    
+    first_trees = np.mean([tree.predict(X) for tree in model.estimators_[:5]], axis=0)
+    np.testing.assert_allclose(keep_trees(compiled, 5).predict(X), first_trees, rtol=1e-12)
+    np.testing.assert_allclose(prune_depth(compiled, compiled.max_depth).predict(X), model.predict(X), rtol=1e-12)
+    # A stump per tree predicts from the root split only
+    stumps = prune_depth(compiled, 1)
+    assert len(stumps.feature) == 3 * compiled.n_trees
+
+@pytest.mark.parametrize('task', TASKS)
+def test_compressed_variants_stay_within_tolerance(models, validation, task):
+    model = models[task]['random_forest']
+    X, y = validation[0], validation[1][task]
+    baseline = validation_score(task, model, X, y)
+    
+    variants = compress_random_forest(task, model, X, y)
+    
+    pruned, pruned_settings = variants['pruned']
+    compact, compact_settings = variants['compact']
+    assert baseline - validation_score(task, pruned, X, y) <= DEFAULT_TOLERANCE / 2
+    assert baseline - validation_score(task, compact, X, y) <= DEFAULT_TOLERANCE
+    assert pruned.max_depth == pruned_settings['max_depth'] <= variants['float32'][0].max_depth
+    assert compact.n_trees == compact_settings['n_trees'] <= pruned.n_trees
+
+def test_variant_loads_compressed_models(compressed_dir):
+    models = load_models(compressed_dir, variant='compact')
+    
+    assert isinstance(models['mortality_classification']['random_forest'], CompiledTreeEnsemble)
+
+def test_variant_without_compressed_models_is_rejected(trained, tmp_path):
+    # Loading would otherwise quietly fall back to the full models
+    save_models(trained, str(tmp_path), knn_index=False)
+    
+    with pytest.raises(ValueError, match='no compressed variants'):
+        load_models(str(tmp_path), variant='compact')
+
+def test_unknown_variant_is_rejected(compressed_dir):
+    with pytest.raises(ValueError, match='Unknown variant'):
+        ModelRegistry(compressed_dir, variant='smallest')
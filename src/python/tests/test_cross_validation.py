@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from sklearn.metrics import (accuracy_score, f1_score, mean_squared_error, precision_score, r2_score, recall_score,
+                             roc_auc_score)
+import cross_validation
+from cross_validation import bootstrap_metrics, weighted_auroc
+
+@pytest.fixture
+def unit_weights(monkeypatch):
+    # Every resample holds every row once, i.e. the original sample
+    monkeypatch.setattr(cross_validation, 'bootstrap_weights',
+                        lambda n_rows, n_resamples, rng: np.ones((n_resamples, n_rows)))
+
+def test_unit_weights_reproduce_classification_metrics(unit_weights):
+    rng = np.random.default_rng(0)
+    y = rng.integers(0, 2, 300)
+    # Rounded probabilities leave many ties for the AUROC
+    prob = np.round(np.clip(0.3 * y + rng.uniform(0, 0.7, 300), 0, 1), 1)
+    pred = (prob >= 0.5).astype(int)
+    
+    samples = bootstrap_metrics('mortality_classification', y, pred, prob, n_resamples=3)
+    
+    expected = {'accuracy': accuracy_score(y, pred), 'auroc': roc_auc_score(y, prob),
+                'precision': precision_score(y, pred), 'recall': recall_score(y, pred), 'f1': f1_score(y, pred)}
+    assert set(samples) == set(expected)
+    for name, value in expected.items():
+        np.testing.assert_allclose(samples[name], value, rtol=1e-12, err_msg=name)
+
+def test_unit_weights_reproduce_regression_metrics(unit_weights):
+    rng = np.random.default_rng(1)
+    y = rng.normal(5, 2, 300)
+    pred = y + rng.normal(0, 1, 300)
+    
+    samples = bootstrap_metrics('length_of_stay_regression', y, pred, n_resamples=3)
+    
+    np.testing.assert_allclose(samples['mse'], mean_squared_error(y, pred), rtol=1e-12)
+    np.testing.assert_allclose(samples['r2'], r2_score(y, pred), rtol=1e-12)
+
+def test_weighted_auroc_matches_sample_weights():
+    rng = np.random.default_rng(2)
+    y = rng.integers(0, 2, 200)
+    prob = np.round(rng.uniform(0, 1, 200), 1)
+    weights = cross_validation.bootstrap_weights(200, 4, rng)
+    
+    expected = [roc_auc_score(y, prob, sample_weight=row) for row in weights]
+    
+    np.testing.assert_allclose(weighted_auroc(weights, y, prob), expected, rtol=1e-12)
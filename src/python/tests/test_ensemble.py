@@ -0,0 +1,34 @@
+import numpy as np
+from ensemble import average_config, predict_ensemble
+from predict import predict_patient_outcomes
+
+def test_cascade_is_off_by_default(models, make_patients):
+    config = average_config(models)
+    n_models = len(config['weights']['mortality_classification'])
+    
+    predictions = predict_ensemble(make_patients(50, seed=13), models, config)
+    
+    assert config['cascade'] is False
+    assert np.all(predictions['mortality_classification']['models_used'] == n_models)
+
+def test_configurations_without_the_setting_score_every_model(models, make_patients):
+    config = average_config(models)
+    del config['cascade']
+    n_models = len(config['weights']['mortality_classification'])
+    
+    prediction = predict_patient_outcomes(make_patients(1, seed=13)[0], models, ensemble=config)
+    
+    assert prediction['mortality_classification']['ensemble']['models_used'] == n_models
+
+def test_cascade_is_opt_in(models, make_patients):
+    patients = make_patients(200, seed=13)
+    full = predict_ensemble(patients, models, average_config(models))
+    
+    opted_in = predict_ensemble(patients, models, average_config(models, cascade=True, confidence=0.6))
+    by_argument = predict_ensemble(patients, models, average_config(models), cascade=True, confidence=0.6)
+    
+    for predictions in (opted_in, by_argument):
+        used = predictions['mortality_classification']['models_used']
+        assert used.min() < full['mortality_classification']['models_used'].min()
+    np.testing.assert_array_equal(opted_in['mortality_classification']['models_used'],
+                                  by_argument['mortality_classification']['models_used'])
@@ -0,0 +1,33 @@
+import pytest
+from explanations import Explainer, additivity_error
+from feature_encoder import get_feature_encoder
+from predict import predict_encoded, predict_patients
+from prediction_cache import PredictionCache
+
+@pytest.fixture(scope='module')
+def patients(make_patients):
+    return make_patients(40, seed=17)
+
+def test_forest_attributions_add_up_to_predictions(patients, models):
+    # forest_to_booster writes XGBoost's JSON model format by hand; a tree
+    # converted wrongly shows up as attributions that miss the prediction
+    X = get_feature_encoder(models['feature_names']).encode(patients)
+    
+    errors = additivity_error(Explainer(models).explain_encoded(X), predict_encoded(X, models))
+    
+    forests = {name: error for name, error in errors.items() if name.endswith('.random_forest')}
+    assert len(forests) == 3
+    for name, error in forests.items():
+        assert error < 1e-4, name
+
+def test_cached_explanations_are_not_returned_as_predictions(patients, models):
+    versioned = dict(models, version='v1', variant='exact')
+    cache = PredictionCache()
+    records = patients[:5]
+    
+    predictions = predict_patients(records, versioned, cache=cache)
+    explanations = Explainer(versioned, cache=cache).explain(records)
+    
+    assert cache.hits == 0
+    assert set(explanations[0]['mortality_classification']['random_forest']) == {'bias', 'output', 'contributions'}
+    assert predict_patients(records, versioned, cache=cache) == predictions
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pytest
+import train_models
+from feature_cache import prepare_training_file
+
+def cache_entries(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if os.path.isdir(os.path.join(cache_dir, name)))
+
+@pytest.fixture
+def data_file(training_data, tmp_path):
+    path = tmp_path / 'patients.csv'
+    training_data.to_csv(path, index=False)
+    return str(path)
+
+def test_cache_hit_skips_preparation(data_file, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / 'cache')
+    prepared = prepare_training_file(data_file, cache_dir=cache_dir)
+    
+    def fail(*args, **kwargs):
+        raise AssertionError("prepare_training_data called on a cache hit")
+    monkeypatch.setattr(train_models, 'prepare_training_data', fail)
+    cached = prepare_training_file(data_file, cache_dir=cache_dir)
+    
+    assert len(cache_entries(cache_dir)) == 1
+    assert cached['feature_names'] == prepared['feature_names']
+    for name in ('X_train', 'X_test', 'X_train_raw'):
+        np.testing.assert_array_equal(cached[name], prepared[name])
+    for split in ('y_train', 'y_test'):
+        for task, target in prepared[split].items():
+            np.testing.assert_array_equal(cached[split][task].index, target.index)
+            np.testing.assert_array_equal(cached[split][task], target)
+    np.testing.assert_array_equal(cached['scaler'].mean_, prepared['scaler'].mean_)
+    np.testing.assert_array_equal(cached['scaler'].scale_, prepared['scaler'].scale_)
+
+def test_cache_is_invalidated_by_file_columns_and_split(data_file, training_data, tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    prepare_training_file(data_file, cache_dir=cache_dir)
+    
+    prepare_training_file(data_file, test_size=0.3, cache_dir=cache_dir)
+    assert len(cache_entries(cache_dir)) == 2
+    
+    prepare_training_file(data_file, random_state=7, cache_dir=cache_dir)
+    assert len(cache_entries(cache_dir)) == 3
+    
+    training_data[list(reversed(training_data.columns))].to_csv(data_file, index=False)
+    prepare_training_file(data_file, cache_dir=cache_dir)
+    assert len(cache_entries(cache_dir)) == 4
+    
+    training_data.iloc[:-1].to_csv(data_file, index=False)
+    prepare_training_file(data_file, cache_dir=cache_dir)
+    assert len(cache_entries(cache_dir)) == 5
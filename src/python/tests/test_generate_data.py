@@ -0,0 +1,16 @@
+import os
+
+import pytest
+
+from generate_data import save_sample_data_sharded, shard_paths
+
+def test_sharded_manifest_lists_only_written_files(tmp_path):
+    manifest = save_sample_data_sharded(5, str(tmp_path), n_shards=5, n_workers=1, file_format='csv')
+    
+    assert sum(shard['rows'] for shard in manifest['shards']) == 5
+    assert all(os.path.exists(path) for path in shard_paths(str(tmp_path)))
+
+def test_more_shards_than_samples_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        save_sample_data_sharded(3, str(tmp_path), n_shards=8, n_workers=1, file_format='csv')
+    assert not os.path.exists(tmp_path / 'manifest.json')
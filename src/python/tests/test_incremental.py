@@ -0,0 +1,93 @@
+import copy
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from generate_data import generate_sample_data
+from predict import TASKS, prepare_batch_data
+from train_models import save_metrics, save_models
+import incremental
+
+@pytest.fixture(scope='module')
+def new_data():
+    # A different seed shifts the feature means, so the scaler moves
+    return generate_sample_data(300, seed=7)
+
+def predict(task, model, X):
+    if task == 'mortality_classification':
+        return model.predict_proba(X)[:, 1]
+    return model.predict(X)
+
+@pytest.mark.parametrize('model_name', ['random_forest', 'xgboost'])
+def test_remapped_trees_keep_predictions_on_training_rows(trained, training_data, new_data, model_name):
+    names = trained['feature_names']
+    old_scaler = trained['scaler']
+    scaler = copy.deepcopy(old_scaler)
+    X_new = prepare_batch_data(new_data, names)
+    scaler.partial_fit(X_new)
+    a, c = incremental.rescale_coefficients(old_scaler, scaler)
+    values = incremental.observed_values(X_new, old_scaler, scaler, trained['split_values'])
+    X_old = prepare_batch_data(training_data, names)
+    
+    for task in TASKS:
+        model = trained[task][model_name]['model']
+        remapped = copy.deepcopy(model)
+        incremental.remap_model(model_name, remapped, a, c, values)
+        
+        np.testing.assert_array_equal(predict(task, remapped, scaler.transform(X_old)),
+                                      predict(task, model, old_scaler.transform(X_old)))
+
+def test_update_keeps_training_metrics_and_artifacts(trained, training_data, new_data, tmp_path):
+    from compression import compress_models
+    from model_registry import read_manifest
+    from predict import load_models
+    from tree_compiler import CompiledTreeEnsemble
+    
+    model_dir = str(tmp_path)
+    save_models(trained, model_dir, mmap_forests=True, knn_index=False)
+    compress_models(model_dir, training_data)
+    metrics_file = os.path.join(model_dir, 'performance_metrics.json')
+    save_metrics({task: {} for task in TASKS}, metrics_file)
+    
+    incremental.update_models(new_data, model_dir)
+    
+    with open(metrics_file, "r") as f:
+        assert json.load(f) == {task: {} for task in TASKS}
+    with open(os.path.join(model_dir, incremental.UPDATE_METRICS_FILE), "r") as f:
+        metrics = json.load(f)
+    assert 0 <= metrics['mortality_classification']['xgboost']['auroc'] <= 1
+    assert 'r2' in metrics['length_of_stay_regression']['linear_regression']
+    
+    manifest, _ = read_manifest(model_dir)
+    for task in TASKS:
+        assert 'mmap_path' in manifest['models'][task]['random_forest']
+        assert set(manifest['models'][task]['random_forest']['variants']) == {'float32', 'pruned', 'compact'}
+    assert isinstance(load_models(model_dir, variant='compact')['mortality_classification']['random_forest'],
+                      CompiledTreeEnsemble)
+    
+    # Every artifact is referenced, and every reference exists
+    referenced = incremental.artifact_paths(manifest)
+    on_disk = {os.path.relpath(os.path.join(root, name), model_dir).replace(os.sep, '/')
+               for root, _, names in os.walk(model_dir) for name in names if name.endswith(('.npz', '.joblib', '.pkl'))}
+    assert on_disk <= referenced
+    assert all(os.path.exists(os.path.join(model_dir, path)) for path in referenced)
+    assert incremental.load_split_values(model_dir).keys() == set(trained['feature_names'])
+
+def test_save_models_resets_the_watermark(trained, training_data, new_data, tmp_path):
+    model_dir = str(tmp_path)
+    # Left behind by models trained earlier
+    incremental.write_training_state({'rows_seen': 5, 'updates': [{'rows': 5}]}, model_dir)
+    
+    save_models(trained, model_dir, knn_index=False)
+    assert incremental.read_training_state(model_dir) == {'rows_seen': len(training_data), 'updates': []}
+    
+    # The source file holds the training rows followed by the new ones
+    source = str(tmp_path / 'patients.csv')
+    pd.concat([training_data, new_data]).to_csv(source, index=False)
+    
+    update = incremental.update_from_file(source, model_dir)
+    
+    assert update['rows'] == len(new_data)
+    assert incremental.read_training_state(model_dir)['rows_seen'] == len(training_data) + len(new_data)
@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from model_bundle import load_bundle, verify_bundle, write_bundle
+from predict import batch_predictions_to_frame, load_models, predict_batch
+from train_models import save_models
+
+@pytest.fixture(scope='module')
+def model_dir(trained, tmp_path_factory):
+    model_dir = str(tmp_path_factory.mktemp('models'))
+    save_models(trained, model_dir)
+    return model_dir
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_bundle_round_trip_matches_pickled_models(model_dir, make_patients, tmp_path, compiled):
+    records = make_patients(50, seed=23)
+    pickled = load_models(model_dir)
+    bundle_dir = str(tmp_path / 'bundle')
+    
+    write_bundle(pickled, bundle_dir)
+    bundled = load_bundle(bundle_dir, compiled=compiled)
+    
+    assert verify_bundle(bundle_dir) == []
+    expected = batch_predictions_to_frame(predict_batch(records, pickled))
+    actual = batch_predictions_to_frame(predict_batch(records, bundled))
+    assert list(actual.columns) == list(expected.columns)
+    for column in expected.columns:
+        np.testing.assert_allclose(actual[column], expected[column], rtol=1e-6, atol=1e-6, err_msg=column)
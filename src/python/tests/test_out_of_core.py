@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+import xgboost as xgb
+from sklearn.metrics import log_loss
+from conftest import FAST_HYPERPARAMS
+from generate_data import save_sample_data_sharded, shard_paths
+from out_of_core import train_out_of_core
+from predict import TASKS, load_models, predict_batch
+from train_models import TASK_TARGETS, save_models
+
+@pytest.fixture(scope='module')
+def shard_dir(tmp_path_factory):
+    output_dir = str(tmp_path_factory.mktemp('shards'))
+    save_sample_data_sharded(3000, output_dir, n_shards=3, n_workers=1, seed=5, file_format='csv')
+    return output_dir
+
+@pytest.fixture(scope='module')
+def saved_models(shard_dir, tmp_path_factory):
+    results, _ = train_out_of_core(shard_dir, chunksize=500, sample_size=1000, hyperparams=FAST_HYPERPARAMS)
+    model_dir = str(tmp_path_factory.mktemp('models'))
+    save_models(results, model_dir, knn_index=False)
+    return model_dir
+
+def test_out_of_core_models_load_and_predict(shard_dir, saved_models):
+    data = pd.concat([pd.read_csv(path) for path in shard_paths(shard_dir)], ignore_index=True)
+    models = load_models(saved_models)
+    
+    predictions = predict_batch(data.drop(columns=list(TASK_TARGETS.values())).head(50), models)
+    
+    for task in TASKS:
+        assert set(predictions[task]) == set(models[task])
+    assert len(predictions['mortality_classification']['xgboost']['probability']) == 50
+
+def test_xgboost_is_the_trained_booster(saved_models):
+    model = load_models(saved_models)['mortality_classification']['xgboost']
+    
+    assert isinstance(model, xgb.XGBClassifier)
+    n_estimators = FAST_HYPERPARAMS['mortality_classification']['xgboost']['n_estimators']
+    assert model.get_booster().num_boosted_rounds() == n_estimators
+    assert model.get_params()['n_jobs'] == 1
+
+def test_sgd_logistic_regression_is_calibrated(shard_dir, saved_models):
+    data = pd.concat([pd.read_csv(path) for path in shard_paths(shard_dir)], ignore_index=True)
+    models = load_models(saved_models)
+    y = data['mortality'].to_numpy()
+    
+    prob = predict_batch(data.drop(columns=list(TASK_TARGETS.values())), models)['mortality_classification'][
+        'logistic_regression']['probability']
+    
+    # The unbounded default step left an intercept near -74 and a log loss of 8
+    assert abs(np.mean(prob) - y.mean()) < 0.05
+    assert log_loss(y, prob) < 0.65
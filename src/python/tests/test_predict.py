@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+from generate_data import generate_sample_data
+from predict import TASKS, predict_batch, prepare_batch_data, prepare_input_data
+from train_models import TASK_TARGETS, encode_training_features
+
+@pytest.fixture(scope='module')
+def patients():
+    data = generate_sample_data(60, seed=11)
+    return data.drop(columns=list(TASK_TARGETS.values()))
+
+def reference_features(patients, feature_names):
+    # The encoding used at training time: get_dummies(drop_first=True) over the whole frame
+    targets = pd.DataFrame({target: 0 for target in TASK_TARGETS.values()}, index=patients.index)
+    return encode_training_features(pd.concat([patients, targets], axis=1))[feature_names].to_numpy(dtype=float)
+
+def test_batch_encoding_matches_training_encoding(patients, models):
+    expected = reference_features(patients, models['feature_names'])
+    
+    encoded = prepare_batch_data(patients.to_dict(orient='records'), models['feature_names'])
+    
+    np.testing.assert_array_equal(encoded.to_numpy(dtype=float), expected)
+
+@pytest.mark.parametrize('admission_type', ['Emergency', 'Urgent', 'Elective'])
+def test_single_patient_keeps_its_admission_type(patients, models, admission_type):
+    # With drop_first on a one-row frame the only level present was dropped,
+    # so every single patient was encoded as the reference level ('Elective')
+    patient = dict(patients.iloc[0], admission_type=admission_type)
+    
+    encoded = prepare_input_data(patient, models['feature_names']).iloc[0]
+    
+    assert encoded['admission_type_Emergency'] == (admission_type == 'Emergency')
+    assert encoded['admission_type_Urgent'] == (admission_type == 'Urgent')
+
+def test_predict_batch_matches_per_patient_models(patients, models):
+    records = patients.to_dict(orient='records')
+    X_reference = reference_features(patients, models['feature_names'])
+    
+    batch = predict_batch(records, models)
+    
+    # Score every patient on its own, straight from the models, like the
+    # original per-patient predict_patient_outcomes did
+    for row in range(len(records)):
+        X_scaled = models['scaler'].transform(pd.DataFrame(X_reference[row:row + 1], columns=models['feature_names']))
+        for task in TASKS:
+            for model_name, model in models[task].items():
+                if task == 'mortality_classification':
+                    assert batch[task][model_name]['class'][row] == model.predict(X_scaled)[0]
+                    assert batch[task][model_name]['probability'][row] == pytest.approx(
+                        model.predict_proba(X_scaled)[0, 1], rel=1e-9, abs=1e-12)
+                else:
+                    assert batch[task][model_name][row] == pytest.approx(model.predict(X_scaled)[0], rel=1e-9, abs=1e-12)
+
+def test_check_batch_parity(patients, models):
+    from predict import check_batch_parity
+    
+    deviations = check_batch_parity(patients.head(20), models)
+    
+    assert deviations
+    assert max(deviations.values()) < 1e-9
+
+@pytest.mark.parametrize('file_format', ['csv', 'parquet'])
+def test_score_csv_stream_matches_predict_batch(patients, models, tmp_path, file_format):
+    from predict import batch_predictions_to_frame, score_csv_stream
+    if file_format == 'parquet':
+        pytest.importorskip('pyarrow')
+    input_path = tmp_path / 'patients.csv'
+    patients.assign(patient_id=range(len(patients))).to_csv(input_path, index=False)
+    output_path = tmp_path / f"predictions.{file_format}"
+    
+    # A chunk size that does not divide the file leaves a short last chunk
+    rows = score_csv_stream(str(input_path), str(output_path), models=models, chunksize=7,
+                            passthrough=['patient_id'])
+    
+    scored = pd.read_csv(output_path) if file_format == 'csv' else pd.read_parquet(output_path)
+    expected = batch_predictions_to_frame(predict_batch(pd.read_csv(input_path), models))
+    assert rows == len(patients)
+    assert scored['patient_id'].tolist() == list(range(len(patients)))
+    # XGBoost scores are float32, which the CSV holds to float32 precision only
+    pd.testing.assert_frame_equal(scored.drop(columns='patient_id'), expected, check_dtype=False, rtol=1e-6)
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+import prediction_cache
+from prediction_cache import PredictionCache
+
+MODELS_KEY = ('v1', 'exact')
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+    
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(prediction_cache, 'time', clock)
+    return clock
+
+def row_keys(n_rows):
+    return PredictionCache.row_keys(np.arange(n_rows * 3, dtype=float).reshape(n_rows, 3))
+
+def test_hits_misses_and_evictions():
+    cache = PredictionCache(max_entries=3)
+    keys = row_keys(4)
+    
+    assert cache.get_many(keys[:2], MODELS_KEY) == [None, None]
+    cache.put_many(keys, ['a', 'b', 'c', 'd'], MODELS_KEY)
+    
+    # The oldest entry was evicted to make room for the fourth
+    assert cache.get_many(keys, MODELS_KEY) == [None, 'b', 'c', 'd']
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['entries']) == (3, 3, 1, 3)
+    assert stats['hit_rate'] == 0.5
+
+def test_lookup_refreshes_recency():
+    cache = PredictionCache(max_entries=2)
+    keys = row_keys(3)
+    cache.put_many(keys[:2], ['a', 'b'], MODELS_KEY)
+    
+    cache.get_many(keys[:1], MODELS_KEY)
+    cache.put_many(keys[2:], ['c'], MODELS_KEY)
+    
+    assert cache.get_many(keys, MODELS_KEY) == ['a', None, 'c']
+
+def test_entries_expire_after_ttl(clock):
+    cache = PredictionCache(ttl_seconds=60)
+    keys = row_keys(2)
+    cache.put_many(keys[:1], ['a'], MODELS_KEY)
+    clock.now += 30
+    cache.put_many(keys[1:], ['b'], MODELS_KEY)
+    
+    clock.now += 45
+    
+    assert cache.get_many(keys, MODELS_KEY) == [None, 'b']
+    assert cache.expirations == 1
+    assert len(cache) == 1
+
+def test_new_models_key_drops_entries():
+    cache = PredictionCache()
+    keys = row_keys(2)
+    cache.put_many(keys, ['a', 'b'], MODELS_KEY)
+    
+    assert cache.get_many(keys, ('v2', 'exact')) == [None, None]
+    assert cache.invalidations == 2
+
+def test_save_models_clears_every_cache(trained, tmp_path):
+    from train_models import save_models
+    caches = [PredictionCache(), prediction_cache.get_prediction_cache()]
+    keys = row_keys(2)
+    for cache in caches:
+        cache.put_many(keys, ['a', 'b'], MODELS_KEY)
+    
+    save_models(trained, str(tmp_path / 'models'), knn_index=False)
+    
+    for cache in caches:
+        assert len(cache) == 0
+        assert cache.get_many(keys, MODELS_KEY) == [None, None]
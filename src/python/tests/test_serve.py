@@ -0,0 +1,43 @@
+from drift import DriftMonitor
+from feature_encoder import get_feature_encoder
+from predict import predict_batch, split_batch_predictions
+from serve import MicroBatcher
+from train_models import TASK_TARGETS
+
+def score(models, reference, patients):
+    monitor = DriftMonitor(reference)
+    batcher = MicroBatcher(models, monitor=monitor)
+    try:
+        results, _ = batcher._score_sync(patients, [None] * len(patients))
+    finally:
+        batcher.executor.shutdown()
+    return results, monitor
+
+def test_monitor_counts_every_scored_patient_once(models, trained, make_patients):
+    patients = make_patients(5)
+    
+    results, monitor = score(models, trained['drift_reference'], patients)
+    
+    assert not any(isinstance(result, Exception) for result in results)
+    assert monitor.rows == 5
+
+def test_monitor_skips_rejected_patients(models, trained, make_patients):
+    patients = make_patients(5)
+    patients[2] = None
+    
+    results, monitor = score(models, trained['drift_reference'], patients)
+    
+    assert [isinstance(result, Exception) for result in results] == [False, False, True, False, False]
+    assert monitor.rows == 4
+    assert results[0] == split_batch_predictions(predict_batch([patients[0]], models), 1)[0]
+
+def test_training_patients_show_no_drift(models, trained, training_data):
+    # The reference comes from the encoded training rows, so dummies are exactly 0 and 1
+    patients = training_data.drop(columns=list(TASK_TARGETS.values())).to_dict(orient='records')
+    monitor = DriftMonitor(trained['drift_reference'])
+    monitor.update(get_feature_encoder(models['feature_names']).encode(patients))
+    
+    snapshot = monitor.snapshot()
+    assert trained['drift_reference']['features']['admission_type_Urgent']['min'] == 0.0
+    assert all(feature['psi'] < 0.25 for feature in snapshot['features'].values())
+
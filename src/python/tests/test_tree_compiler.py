@@ -0,0 +1,105 @@
+import json
+
+import numpy as np
+import pytest
+import xgboost as xgb
+from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
+
+from tree_compiler import check_compiled_equivalence, compile_model, load_compiled, save_compiled
+
+def make_data(n_rows=300, seed=0):
+    # Few distinct values per feature, so many rows fall on split boundaries
+    rng = np.random.default_rng(seed)
+    X = rng.integers(0, 6, size=(n_rows, 4)).astype(np.float64) / 3
+    X[:, 3] = rng.normal(size=n_rows)
+    margin = X[:, 0] - X[:, 1] + 0.5 * X[:, 3]
+    return X, (margin > np.median(margin)).astype(int), margin
+
+def split_values(model):
+    if isinstance(model, (xgb.XGBClassifier, xgb.XGBRegressor)):
+        dump = json.loads(model.get_booster().save_raw('json'))
+        splits = []
+        for tree in dump['learner']['gradient_booster']['model']['trees']:
+            is_split = np.asarray(tree['left_children']) >= 0
+            splits.extend(zip(np.asarray(tree['split_indices'])[is_split],
+                              np.asarray(tree['split_conditions'], dtype=np.float32)[is_split]))
+        return splits
+    splits = []
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        is_split = tree.children_left >= 0
+        splits.extend(zip(tree.feature[is_split], tree.threshold[is_split].astype(np.float32)))
+    return splits
+
+def boundary_rows(model, X):
+    """Copies of X with one feature set exactly on, and one float32 step around, each threshold"""
+    rows = [X]
+    for feature, threshold in split_values(model)[:200]:
+        for value in (threshold, np.nextafter(threshold, -np.inf), np.nextafter(threshold, np.inf)):
+            row = X[:1].copy()
+            row[0, feature] = value
+            rows.append(row)
+    return np.vstack(rows)
+
+MODELS = [
+    RandomForestClassifier(n_estimators=15, max_depth=6, random_state=0),
+    RandomForestRegressor(n_estimators=15, max_depth=6, random_state=0),
+    xgb.XGBClassifier(n_estimators=30, max_depth=4, n_jobs=1, random_state=0),
+    xgb.XGBRegressor(n_estimators=30, max_depth=4, n_jobs=1, random_state=0),
+]
+
+@pytest.mark.parametrize('model', MODELS, ids=lambda model: type(model).__name__)
+def test_compiled_matches_original_on_thresholds(model):
+    X, y, margin = make_data()
+    is_classifier = hasattr(model, 'predict_proba')
+    model.fit(X, y if is_classifier else margin)
+    compiled = compile_model(model)
+    
+    X_check = boundary_rows(model, make_data(50, seed=1)[0])
+    if is_classifier:
+        np.testing.assert_array_equal(compiled.predict(X_check), model.predict(X_check))
+        expected = model.predict_proba(X_check)
+        actual = compiled.predict_proba(X_check)
+    else:
+        expected = model.predict(X_check)
+        actual = compiled.predict(X_check)
+    
+    if isinstance(model, (RandomForestClassifier, RandomForestRegressor)):
+        # Same leaves, same float64 mean
+        np.testing.assert_allclose(actual, expected, rtol=1e-12, atol=1e-12)
+    else:
+        # XGBoost sums leaves in float32, the compiled ensemble in float64
+        np.testing.assert_allclose(actual, expected, rtol=1e-5, atol=1e-6)
+    check_compiled_equivalence(model, compiled, X_check)
+
+@pytest.mark.parametrize('model', MODELS, ids=lambda model: type(model).__name__)
+def test_compiled_leaves_match_on_thresholds(model):
+    X, y, margin = make_data()
+    model.fit(X, y if hasattr(model, 'predict_proba') else margin)
+    compiled = compile_model(model)
+    
+    X_check = boundary_rows(model, make_data(50, seed=1)[0])
+    if isinstance(model, (xgb.XGBClassifier, xgb.XGBRegressor)):
+        expected = model.get_booster().predict(xgb.DMatrix(X_check), pred_leaf=True)
+    else:
+        expected = model.apply(X_check)
+    # Compiled node ids are offset per tree, translate back to per-tree ids
+    np.testing.assert_array_equal(compiled.apply(X_check) - compiled.roots, expected)
+
+def test_xgboost_missing_values_follow_default_direction():
+    X, y, _ = make_data()
+    X[::7, 0] = np.nan
+    model = xgb.XGBClassifier(n_estimators=30, max_depth=4, n_jobs=1, random_state=0).fit(X, y)
+    compiled = compile_model(model)
+    
+    X_check = make_data(100, seed=2)[0]
+    X_check[::3, [0, 3]] = np.nan
+    np.testing.assert_allclose(compiled.predict_proba(X_check), model.predict_proba(X_check), rtol=1e-5, atol=1e-6)
+
+def test_save_and_load_round_trip(tmp_path):
+    X, y, _ = make_data()
+    compiled = compile_model(RandomForestClassifier(n_estimators=5, random_state=0).fit(X, y))
+    path = str(tmp_path / 'forest.trees.npz')
+    save_compiled(compiled, path)
+    
+    np.testing.assert_array_equal(load_compiled(path).predict_proba(X), compiled.predict_proba(X))
@@ -12,218 +12,258 @@ import xgboost as xgb
 import pickle
 import json
 import os
+import argparse
+from joblib import Parallel, delayed
 from generate_data import generate_sample_data
+from model_registry import write_manifest
+from tree_compiler import COMPILED_SUFFIX, compile_model, save_compiled
+from fused_linear import FUSED_LINEAR_FILE, fuse_linear_models
+from knn_index import KNN_INDEX_SUFFIX, build_ivf_index, save_index
+from prediction_cache import invalidate_prediction_caches
+from drift import DRIFT_REFERENCE_FILE, build_reference, save_reference
+import profiling
 
-def train_models(data=None, n_samples=500):
+# Training values next to the tree split thresholds, see incremental.collect_split_values
+SPLIT_VALUES_FILE = 'split_values.json'
+
+TASKS = ['mortality_classification', 'mortality_rate_regression', 'length_of_stay_regression']
+
+# Target column for each prediction task
+TASK_TARGETS = {
+    'mortality_classification': 'mortality',
+    'mortality_rate_regression': 'mortality_rate',
+    'length_of_stay_regression': 'length_of_stay'
+}
+
+# Every model trained by train_models, in training/reporting order.
+# 'threads_param' names the estimator parameter controlling its own
+# parallelism, 'explain' which global explanation is kept with the metrics.
+MODEL_SPECS = [
+    {'task': 'mortality_classification', 'name': 'random_forest', 'estimator': RandomForestClassifier,
+     'params': {'n_estimators': 100, 'random_state': 42}, 'threads_param': 'n_jobs', 'explain': 'feature_importance'},
+    {'task': 'mortality_classification', 'name': 'knn', 'estimator': KNeighborsClassifier,
+     'params': {'n_neighbors': 5}},
+    {'task': 'mortality_classification', 'name': 'xgboost', 'estimator': xgb.XGBClassifier,
+     'params': {'n_estimators': 100, 'random_state': 42}, 'threads_param': 'n_jobs', 'explain': 'feature_importance'},
+    {'task': 'mortality_classification', 'name': 'logistic_regression', 'estimator': LogisticRegression,
+     'params': {'random_state': 42, 'max_iter': 1000}, 'explain': 'coefficients'},
+    {'task': 'mortality_rate_regression', 'name': 'random_forest', 'estimator': RandomForestRegressor,
+     'params': {'n_estimators': 100, 'random_state': 42}, 'threads_param': 'n_jobs', 'explain': 'feature_importance'},
+    {'task': 'mortality_rate_regression', 'name': 'knn', 'estimator': KNeighborsRegressor,
+     'params': {'n_neighbors': 5}},
+    {'task': 'mortality_rate_regression', 'name': 'xgboost', 'estimator': xgb.XGBRegressor,
+     'params': {'n_estimators': 100, 'random_state': 42}, 'threads_param': 'n_jobs', 'explain': 'feature_importance'},
+    {'task': 'mortality_rate_regression', 'name': 'linear_regression', 'estimator': LinearRegression,
+     'params': {}, 'explain': 'coefficients'},
+    {'task': 'length_of_stay_regression', 'name': 'random_forest', 'estimator': RandomForestRegressor,
+     'params': {'n_estimators': 100, 'random_state': 42}, 'threads_param': 'n_jobs', 'explain': 'feature_importance'},
+    {'task': 'length_of_stay_regression', 'name': 'knn', 'estimator': KNeighborsRegressor,
+     'params': {'n_neighbors': 5}},
+    {'task': 'length_of_stay_regression', 'name': 'xgboost', 'estimator': xgb.XGBRegressor,
+     'params': {'n_estimators': 100, 'random_state': 42}, 'threads_param': 'n_jobs', 'explain': 'feature_importance'},
+    {'task': 'length_of_stay_regression', 'name': 'linear_regression', 'estimator': LinearRegression,
+     'params': {}, 'explain': 'coefficients'}
+]
+
+def resolve_n_jobs(n_jobs):
     """
-    Train mortality and length of stay prediction models
+    Turn a joblib-style n_jobs value into a number of cores
     
     Parameters:
-    data (pd.DataFrame): Patient data, if None, generates synthetic data
-    n_samples (int): Number of samples to generate if data=None
+    n_jobs (int): Core budget; None means 1, negative values count back from
+                  the number of CPUs (-1 = all cores)
     
     Returns:
-    dict: Dictionary containing trained models and performance metrics
+    int: Number of cores to use, at least 1
     """
-    if data is None:
-        data = generate_sample_data(n_samples)
-    
-    # Split features and targets
-    X = data.drop(['mortality', 'mortality_rate', 'length_of_stay'], axis=1)
-    
-    # Convert categorical variables to dummies
-    X = pd.get_dummies(X, drop_first=True)
-    
-    # Target for mortality classification
-    y_mortality = data['mortality']
-    
-    # Target for mortality rate regression
-    y_mortality_rate = data['mortality_rate']
-    
-    # Target for length of stay regression
-    y_los = data['length_of_stay']
-    
-    # Split data into train and test sets
-    X_train, X_test, y_mort_train, y_mort_test, y_rate_train, y_rate_test, y_los_train, y_los_test = \
-        train_test_split(X, y_mortality, y_mortality_rate, y_los, test_size=0.2, random_state=42)
-    
-    # Scale features
-    scaler = StandardScaler()
-    X_train_scaled = scaler.fit_transform(X_train)
-    X_test_scaled = scaler.transform(X_test)
-    
-    # Dictionary to store models and results
-    results = {
-        'feature_names': X.columns.tolist(),
-        'scaler': scaler,
-        'mortality_classification': {},
-        'mortality_rate_regression': {},
-        'length_of_stay_regression': {}
-    }
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
+
+def plan_threads(specs, n_jobs):
+    """
+    Split a core budget between concurrent model fits
     
-    # Train mortality classification models
-    
-    # Random Forest Classifier
-    rf_clf = RandomForestClassifier(n_estimators=100, random_state=42)
-    rf_clf.fit(X_train_scaled, y_mort_train)
-    rf_pred = rf_clf.predict(X_test_scaled)
-    rf_prob = rf_clf.predict_proba(X_test_scaled)[:, 1]
-    
-    results['mortality_classification']['random_forest'] = {
-        'model': rf_clf,
-        'accuracy': accuracy_score(y_mort_test, rf_pred),
-        'auroc': roc_auc_score(y_mort_test, rf_prob),
-        'precision': precision_score(y_mort_test, rf_pred),
-        'recall': recall_score(y_mort_test, rf_pred),
-        'f1': f1_score(y_mort_test, rf_pred),
-        'feature_importance': dict(zip(X.columns, rf_clf.feature_importances_))
-    }
+    Every fit gets a worker while there are cores for it. Cores left over once
+    each fit has one are shared evenly by the models that parallelize
+    internally (random forests and XGBoost), so nested parallelism never
+    asks for more cores than the budget.
     
-    # KNN Classifier
-    knn_clf = KNeighborsClassifier(n_neighbors=5)
-    knn_clf.fit(X_train_scaled, y_mort_train)
-    knn_pred = knn_clf.predict(X_test_scaled)
-    knn_prob = knn_clf.predict_proba(X_test_scaled)[:, 1]
-    
-    results['mortality_classification']['knn'] = {
-        'model': knn_clf,
-        'accuracy': accuracy_score(y_mort_test, knn_pred),
-        'auroc': roc_auc_score(y_mort_test, knn_prob),
-        'precision': precision_score(y_mort_test, knn_pred),
-        'recall': recall_score(y_mort_test, knn_pred),
-        'f1': f1_score(y_mort_test, knn_pred)
-    }
+    Parameters:
+    specs (list): Model specs to train
+    n_jobs (int): Core budget, see resolve_n_jobs
     
-    # XGBoost Classifier
-    xgb_clf = xgb.XGBClassifier(n_estimators=100, random_state=42)
-    xgb_clf.fit(X_train_scaled, y_mort_train)
-    xgb_pred = xgb_clf.predict(X_test_scaled)
-    xgb_prob = xgb_clf.predict_proba(X_test_scaled)[:, 1]
-    
-    results['mortality_classification']['xgboost'] = {
-        'model': xgb_clf,
-        'accuracy': accuracy_score(y_mort_test, xgb_pred),
-        'auroc': roc_auc_score(y_mort_test, xgb_prob),
-        'precision': precision_score(y_mort_test, xgb_pred),
-        'recall': recall_score(y_mort_test, xgb_pred),
-        'f1': f1_score(y_mort_test, xgb_pred),
-        'feature_importance': dict(zip(X.columns, xgb_clf.feature_importances_))
-    }
+    Returns:
+    tuple: (number of concurrent fits, list of thread counts per spec)
+    """
+    budget = resolve_n_jobs(n_jobs)
+    n_workers = max(1, min(budget, len(specs)))
     
-    # Logistic Regression
-    lr_clf = LogisticRegression(random_state=42, max_iter=1000)
-    lr_clf.fit(X_train_scaled, y_mort_train)
-    lr_pred = lr_clf.predict(X_test_scaled)
-    lr_prob = lr_clf.predict_proba(X_test_scaled)[:, 1]
-    
-    results['mortality_classification']['logistic_regression'] = {
-        'model': lr_clf,
-        'accuracy': accuracy_score(y_mort_test, lr_pred),
-        'auroc': roc_auc_score(y_mort_test, lr_prob),
-        'precision': precision_score(y_mort_test, lr_pred),
-        'recall': recall_score(y_mort_test, lr_pred),
-        'f1': f1_score(y_mort_test, lr_pred),
-        'coefficients': dict(zip(X.columns, lr_clf.coef_[0]))
-    }
+    n_heavy = sum(1 for spec in specs if spec.get('threads_param'))
+    n_light = len(specs) - n_heavy
+    heavy_threads = 1
+    if n_heavy and budget > len(specs):
+        heavy_threads = max(1, (budget - n_light) // n_heavy)
     
-    # Train mortality rate regression models
+    threads = [heavy_threads if spec.get('threads_param') else 1 for spec in specs]
+    return n_workers, threads
+
+def apply_hyperparams(specs, hyperparams):
+    """
+    Override the hyperparameters of model specs, e.g. with tuning results
     
-    # Random Forest Regressor
-    rf_reg = RandomForestRegressor(n_estimators=100, random_state=42)
-    rf_reg.fit(X_train_scaled, y_rate_train)
-    rf_rate_pred = rf_reg.predict(X_test_scaled)
+    Parameters:
+    specs (list): Model specs
+    hyperparams (dict): Parameters by task and model name, {task: {model: params}};
+                        models without an entry keep their defaults
     
-    results['mortality_rate_regression']['random_forest'] = {
-        'model': rf_reg,
-        'mse': mean_squared_error(y_rate_test, rf_rate_pred),
-        'r2': r2_score(y_rate_test, rf_rate_pred),
-        'feature_importance': dict(zip(X.columns, rf_reg.feature_importances_))
-    }
+    Returns:
+    list: Copies of the specs with the overrides merged into 'params'
+    """
+    if not hyperparams:
+        return specs
+    
+    overridden = []
+    for spec in specs:
+        spec = dict(spec)
+        spec['params'] = {**spec['params'], **hyperparams.get(spec['task'], {}).get(spec['name'], {})}
+        overridden.append(spec)
+    return overridden
+
+def evaluate_model(task, model, X_test, y_test):
+    """
+    Compute test-set performance metrics for a fitted model
     
-    # KNN Regressor
-    knn_reg = KNeighborsRegressor(n_neighbors=5)
-    knn_reg.fit(X_train_scaled, y_rate_train)
-    knn_rate_pred = knn_reg.predict(X_test_scaled)
+    Parameters:
+    task (str): Prediction task name
+    model (object): Fitted model
+    X_test (np.ndarray): Scaled test features
+    y_test (pd.Series): Test targets
     
-    results['mortality_rate_regression']['knn'] = {
-        'model': knn_reg,
-        'mse': mean_squared_error(y_rate_test, knn_rate_pred),
-        'r2': r2_score(y_rate_test, knn_rate_pred)
+    Returns:
+    dict: Classification or regression metrics
+    """
+    if task == 'mortality_classification':
+        pred = model.predict(X_test)
+        prob = model.predict_proba(X_test)[:, 1]
+        return {
+            'accuracy': accuracy_score(y_test, pred),
+            'auroc': roc_auc_score(y_test, prob),
+            'precision': precision_score(y_test, pred),
+            'recall': recall_score(y_test, pred),
+            'f1': f1_score(y_test, pred)
+        }
+    
+    pred = model.predict(X_test)
+    return {
+        'mse': mean_squared_error(y_test, pred),
+        'r2': r2_score(y_test, pred)
     }
+
+def fit_model(spec, X_train, y_train, X_test, y_test, feature_names, n_threads=1):
+    """
+    Fit and evaluate the model described by one spec
     
-    # XGBoost Regressor
-    xgb_reg = xgb.XGBRegressor(n_estimators=100, random_state=42)
-    xgb_reg.fit(X_train_scaled, y_rate_train)
-    xgb_rate_pred = xgb_reg.predict(X_test_scaled)
-    
-    results['mortality_rate_regression']['xgboost'] = {
-        'model': xgb_reg,
-        'mse': mean_squared_error(y_rate_test, xgb_rate_pred),
-        'r2': r2_score(y_rate_test, xgb_rate_pred),
-        'feature_importance': dict(zip(X.columns, xgb_reg.feature_importances_))
-    }
+    Parameters:
+    spec (dict): Entry of MODEL_SPECS
+    X_train (np.ndarray): Scaled training features
+    y_train (pd.Series): Training targets
+    X_test (np.ndarray): Scaled test features
+    y_test (pd.Series): Test targets
+    feature_names (list): Feature names, for importances and coefficients
+    n_threads (int): Cores the estimator may use internally
     
-    # Linear Regression
-    lr_reg = LinearRegression()
-    lr_reg.fit(X_train_scaled, y_rate_train)
-    lr_rate_pred = lr_reg.predict(X_test_scaled)
+    Returns:
+    dict: Fitted model under 'model' plus its metrics and explanation
+    """
+    params = dict(spec['params'])
+    if spec.get('threads_param'):
+        params[spec['threads_param']] = n_threads
+    
+    model = spec['estimator'](**params)
+    with profiling.stage('fit', 'fit', task=spec['task'], model=spec['name'], rows=len(X_train)):
+        model.fit(X_train, y_train)
+    
+    # Saved models predict one patient at a time, where a thread pool only adds
+    # overhead. 1 rather than None, which XGBoost reads as all cores
+    if spec.get('threads_param'):
+        model.set_params(**{spec['threads_param']: 1})
+    
+    entry = {'model': model}
+    with profiling.stage('evaluate', 'predict', task=spec['task'], model=spec['name'], rows=len(X_test)):
+        entry.update(evaluate_model(spec['task'], model, X_test, y_test))
+    
+    if spec.get('explain') == 'feature_importance':
+        entry['feature_importance'] = dict(zip(feature_names, model.feature_importances_))
+    elif spec.get('explain') == 'coefficients':
+        coef = model.coef_[0] if model.coef_.ndim > 1 else model.coef_
+        entry['coefficients'] = dict(zip(feature_names, coef))
+    
+    return entry
+
+def encode_training_features(data):
+    """
+    Drop the target columns and one-hot encode the categorical features
     
-    results['mortality_rate_regression']['linear_regression'] = {
-        'model': lr_reg,
-        'mse': mean_squared_error(y_rate_test, lr_rate_pred),
-        'r2': r2_score(y_rate_test, lr_rate_pred),
-        'coefficients': dict(zip(X.columns, lr_reg.coef_))
-    }
+    Parameters:
+    data (pd.DataFrame): Patient data including the target columns
     
-    # Train length of stay regression models
+    Returns:
+    pd.DataFrame: Unscaled model features
+    """
+    # Split features and targets
+    X = data.drop(list(TASK_TARGETS.values()), axis=1)
     
-    # Random Forest Regressor for LOS
-    rf_los = RandomForestRegressor(n_estimators=100, random_state=42)
-    rf_los.fit(X_train_scaled, y_los_train)
-    rf_los_pred = rf_los.predict(X_test_scaled)
+    # Convert categorical variables to dummies
+    return pd.get_dummies(X, drop_first=True)
+
+@profiling.profiled()
+def prepare_training_data(data, test_size=0.2, random_state=42):
+    """
+    Encode, split and scale patient data for training
     
-    results['length_of_stay_regression']['random_forest'] = {
-        'model': rf_los,
-        'mse': mean_squared_error(y_los_test, rf_los_pred),
-        'r2': r2_score(y_los_test, rf_los_pred),
-        'feature_importance': dict(zip(X.columns, rf_los.feature_importances_))
-    }
+    Parameters:
+    data (pd.DataFrame): Patient data including the target columns
+    test_size (float): Fraction of patients held out for testing
+    random_state (int): Seed of the train/test split
     
-    # KNN Regressor for LOS
-    knn_los = KNeighborsRegressor(n_neighbors=5)
-    knn_los.fit(X_train_scaled, y_los_train)
-    knn_los_pred = knn_los.predict(X_test_scaled)
+    Returns:
+    dict: 'feature_names', fitted 'scaler', scaled 'X_train'/'X_test' arrays,
+          the unscaled 'X_train_raw' array and 'y_train'/'y_test' dictionaries
+          of target Series keyed by task
+    """
+    X = encode_training_features(data)
     
-    results['length_of_stay_regression']['knn'] = {
-        'model': knn_los,
-        'mse': mean_squared_error(y_los_test, knn_los_pred),
-        'r2': r2_score(y_los_test, knn_los_pred)
-    }
+    # Split data into train and test sets, the same split for every task
+    split = train_test_split(X, *[data[target] for target in TASK_TARGETS.values()],
+                             test_size=test_size, random_state=random_state)
+    X_train, X_test = split[0], split[1]
     
-    # XGBoost Regressor for LOS
-    xgb_los = xgb.XGBRegressor(n_estimators=100, random_state=42)
-    xgb_los.fit(X_train_scaled, y_los_train)
-    xgb_los_pred = xgb_los.predict(X_test_scaled)
+    # Scale features
+    scaler = StandardScaler()
     
-    results['length_of_stay_regression']['xgboost'] = {
-        'model': xgb_los,
-        'mse': mean_squared_error(y_los_test, xgb_los_pred),
-        'r2': r2_score(y_los_test, xgb_los_pred),
-        'feature_importance': dict(zip(X.columns, xgb_los.feature_importances_))
+    return {
+        'feature_names': X.columns.tolist(),
+        'scaler': scaler,
+        'X_train': scaler.fit_transform(X_train),
+        'X_test': scaler.transform(X_test),
+        'X_train_raw': X_train.to_numpy(dtype=np.float64),
+        'y_train': {task: split[2 + 2 * i] for i, task in enumerate(TASKS)},
+        'y_test': {task: split[3 + 2 * i] for i, task in enumerate(TASKS)}
     }
+
+def collect_metrics(results):
+    """
+    Gather the metrics and explanations of trained models for JSON serialization
     
-    # Linear Regression for LOS
-    lr_los = LinearRegression()
-    lr_los.fit(X_train_scaled, y_los_train)
-    lr_los_pred = lr_los.predict(X_test_scaled)
-    
-    results['length_of_stay_regression']['linear_regression'] = {
-        'model': lr_los,
-        'mse': mean_squared_error(y_los_test, lr_los_pred),
-        'r2': r2_score(y_los_test, lr_los_pred),
-        'coefficients': dict(zip(X.columns, lr_los.coef_))
-    }
+    Parameters:
+    results (dict): Trained models and their metrics, as returned by train_models
     
+    Returns:
+    dict: Performance metrics keyed by task and model name
+    """
     # Prepare performance metrics for JSON serialization
     perf_metrics = {
         'mortality_classification': {},
@@ -231,9 +271,9 @@ def train_models(data=None, n_samples=500):
         'length_of_stay_regression': {}
     }
     
-    for task in ['mortality_classification', 'mortality_rate_regression', 'length_of_stay_regression']:
+    for task in TASKS:
         for model_name, model_data in results[task].items():
-            perf_metrics[task][model_name] = {k: v for k, v in model_data.items() 
+            perf_metrics[task][model_name] = {k: v for k, v in model_data.items()
                                              if k not in ['model', 'coefficients', 'feature_importance']}
             
             # Add feature importance or coefficients if available
@@ -247,15 +287,89 @@ def train_models(data=None, n_samples=500):
                     k: float(v) for k, v in model_data['coefficients'].items()
                 }
     
-    return results, perf_metrics
+    return perf_metrics
 
-def save_models(results, output_dir='models'):
+@profiling.profiled()
+def train_models(data=None, n_samples=500, n_jobs=1, prepared=None, hyperparams=None):
+    """
+    Train mortality and length of stay prediction models
+    
+    The model fits are independent once the scaler is fitted and run
+    concurrently on a process pool when n_jobs allows it.
+    
+    Parameters:
+    data (pd.DataFrame): Patient data, if None, generates synthetic data
+    n_samples (int): Number of samples to generate if data=None
+    n_jobs (int): Core budget for training, -1 uses all cores
+    prepared (dict): Output of prepare_training_data (e.g. from the feature
+                     cache), used instead of data
+    hyperparams (dict): Hyperparameters overriding MODEL_SPECS, {task: {model: params}},
+                        e.g. tuning.load_hyperparams('models')
+    
+    Returns:
+    dict: Dictionary containing trained models and performance metrics
+    """
+    if prepared is None:
+        if data is None:
+            data = generate_sample_data(n_samples)
+        prepared = prepare_training_data(data)
+    n_rows = len(prepared['X_train']) + len(prepared['X_test'])
+    
+    # Dictionary to store models and results
+    feature_names = prepared['feature_names']
+    results = {
+        'feature_names': feature_names,
+        'scaler': prepared['scaler'],
+        'rows_seen': n_rows,
+        'mortality_classification': {},
+        'mortality_rate_regression': {},
+        'length_of_stay_regression': {}
+    }
+    
+    specs = apply_hyperparams(MODEL_SPECS, hyperparams)
+    n_workers, threads = plan_threads(specs, n_jobs)
+    # Workers hand their fit/evaluate stages back when profiling is on
+    entries = profiling.collect(Parallel(n_jobs=n_workers)(
+        delayed(profiling.run_collected)(profiling.is_enabled(), fit_model, spec, prepared['X_train'],
+                                         prepared['y_train'][spec['task']], prepared['X_test'],
+                                         prepared['y_test'][spec['task']], feature_names, n_threads)
+        for spec, n_threads in zip(specs, threads)
+    ))
+    
+    for spec, entry in zip(specs, entries):
+        results[spec['task']][spec['name']] = entry
+    
+    # Training distribution of the unscaled features, for drift monitoring (see drift.py)
+    results['drift_reference'] = build_reference(prepared['X_train_raw'], feature_names)
+    
+    # Lets incremental updates move the split thresholds without moving training rows
+    from incremental import collect_split_values
+    fitted = [entry['model'] for task in TASKS for entry in results[task].values()]
+    results['split_values'] = collect_split_values(fitted, prepared['scaler'], prepared['X_train_raw'].T, feature_names)
+    
+    return results, collect_metrics(results)
+
+@profiling.profiled()
+def save_models(results, output_dir='models', mmap_forests=False, compile_trees=True, fuse_linear=True,
+                knn_index=True):
     """
     Save trained models and metrics to files
     
     Parameters:
-    results (dict): Dictionary containing models and performance metrics
+    results (dict): Dictionary containing models and performance metrics, and
+                    optionally the 'drift_reference' saved for drift.py, the
+                    'split_values' saved for incremental.py and 'rows_seen',
+                    the number of source rows the models were trained on,
+                    which resets the watermark of incremental updates
     output_dir (str): Directory to save models
+    mmap_forests (bool): Also save random forests with joblib so they can be
+                         memory-mapped by the model registry
+    compile_trees (bool): Also export random forests and XGBoost models as
+                          compiled node arrays for fast prediction
+    fuse_linear (bool): Also save the linear models folded together with the
+                        scaler, so they are scored with one matrix multiply
+    knn_index (bool): Also build an approximate nearest-neighbor index for the
+                      KNN models, see load_models(approximate_knn=True)
     
     Returns:
     None
@@ -272,12 +386,59 @@ def save_models(results, output_dir='models'):
         json.dump(results['feature_names'], f)
     
     # Save models
-    for task in ['mortality_classification', 'mortality_rate_regression', 'length_of_stay_regression']:
+    model_paths = {}
+    for task in TASKS:
         os.makedirs(f"{output_dir}/{task}", exist_ok=True)
+        model_paths[task] = {}
         
         for model_name, model_data in results[task].items():
-            with open(f"{output_dir}/{task}/{model_name}.pkl", "wb") as f:
-                pickle.dump(model_data['model'], f)
+            with profiling.stage('save_model', 'save', task=task, model=model_name):
+                with open(f"{output_dir}/{task}/{model_name}.pkl", "wb") as f:
+                    pickle.dump(model_data['model'], f)
+                model_paths[task][model_name] = {'path': f"{task}/{model_name}.pkl"}
+                
+                if mmap_forests and model_name == 'random_forest':
+                    import joblib
+                    joblib.dump(model_data['model'], f"{output_dir}/{task}/{model_name}.joblib")
+                    model_paths[task][model_name]['mmap_path'] = f"{task}/{model_name}.joblib"
+                
+                compiled = compile_model(model_data['model']) if compile_trees else None
+                if compiled is not None:
+                    save_compiled(compiled, f"{output_dir}/{task}/{model_name}{COMPILED_SUFFIX}")
+                    model_paths[task][model_name]['compiled_path'] = f"{task}/{model_name}{COMPILED_SUFFIX}"
+                
+                index = build_ivf_index(model_data['model']) if knn_index else None
+                if index is not None:
+                    save_index(index, f"{output_dir}/{task}/{model_name}{KNN_INDEX_SUFFIX}")
+                    model_paths[task][model_name]['index_path'] = f"{task}/{model_name}{KNN_INDEX_SUFFIX}"
+    
+    extra_files = {'feature_names': 'feature_names.json'}
+    
+    if results.get('drift_reference') is not None:
+        save_reference(results['drift_reference'], f"{output_dir}/{DRIFT_REFERENCE_FILE}")
+        extra_files['drift_reference'] = DRIFT_REFERENCE_FILE
+    
+    if results.get('split_values') is not None:
+        with open(f"{output_dir}/{SPLIT_VALUES_FILE}", "w") as f:
+            json.dump(results['split_values'], f)
+        extra_files['split_values'] = SPLIT_VALUES_FILE
+    
+    fused = fuse_linear_models(results['scaler'], {task: {name: model_data['model'] for name, model_data in results[task].items()}
+                                                   for task in TASKS}) if fuse_linear else None
+    if fused is not None:
+        fused.save(f"{output_dir}/{FUSED_LINEAR_FILE}")
+        extra_files['fused_linear'] = FUSED_LINEAR_FILE
+    
+    if results.get('rows_seen') is not None:
+        # Fresh models: later updates start after the rows they were trained on
+        from incremental import write_training_state
+        write_training_state({'rows_seen': int(results['rows_seen']), 'updates': []}, output_dir)
+    
+    # Write the manifest last so readers never see a half-written directory as a new version
+    write_manifest(output_dir, results['feature_names'], model_paths, extra_files=extra_files)
+    
+    # Predictions cached in this process came from the previous models
+    invalidate_prediction_caches()
     
     print(f"Models saved to {output_dir}")
 
@@ -299,7 +460,29 @@ def save_metrics(metrics, output_file='models/performance_metrics.json'):
     print(f"Performance metrics saved to {output_file}")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train mortality and length of stay models")
+    parser.add_argument('--n-jobs', type=int, default=1, help="Core budget for training, -1 uses all cores")
+    parser.add_argument('--bundle', default=None, help="Also write a memory-mappable model bundle to this directory")
+    parser.add_argument('--hyperparams', default=None,
+                        help="Tuned hyperparameters JSON (or its directory) written by tuning.py")
+    parser.add_argument('--profile', default=None, metavar='PATH',
+                        help="Record per-stage timings and write them to PATH (plus a Chrome trace)")
+    args = parser.parse_args()
+    
+    if args.profile:
+        profiling.enable_from_cli(args.profile)
+    
+    hyperparams = None
+    if args.hyperparams:
+        from tuning import load_hyperparams
+        hyperparams = load_hyperparams(args.hyperparams)
+    
     data = generate_sample_data(500)
-    results, metrics = train_models(data)
+    results, metrics = train_models(data, n_jobs=args.n_jobs, hyperparams=hyperparams)
     save_models(results)
     save_metrics(metrics)
+    
+    if args.bundle:
+        from model_bundle import write_bundle
+        from predict import load_models
+        write_bundle(load_models('models'), args.bundle)
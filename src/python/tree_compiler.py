@@ -0,0 +1,371 @@
+import json
+import numpy as np
+
+COMPILED_SUFFIX = '.trees.npz'
+
+class CompiledTreeEnsemble:
+    """
+    Tree ensemble flattened into contiguous NumPy node arrays
+    
+    All trees share one set of node arrays; roots holds the index of every
+    tree's root node. Leaves point to themselves as both children, so every
+    row can be pushed down every tree for exactly max_depth steps without
+    branching. The object exposes predict/predict_proba/classes_ and can stand
+    in for the sklearn or XGBoost model it was compiled from.
+    """
+    
+    def __init__(self, feature, threshold, children, default_left, value, roots, max_depth,
+                 strict_less, aggregate, base_margin=0.0, is_classifier=False):
+        self.feature = feature
+        self.threshold = threshold
+        self.children = children
+        self.default_left = default_left
+        self.value = value
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.strict_less = bool(strict_less)
+        self.aggregate = aggregate
+        self.base_margin = float(base_margin)
+        self.is_classifier = bool(is_classifier)
+        self.classes_ = np.array([0, 1]) if is_classifier else None
+    
+    @property
+    def n_trees(self):
+        return len(self.roots)
+    
+    def apply(self, X):
+        """
+        Find the leaf every row reaches in every tree
+        
+        Parameters:
+        X (np.ndarray): Feature matrix, shape (n_rows, n_features)
+        
+        Returns:
+        np.ndarray: Leaf node indices, shape (n_rows, n_trees)
+        """
+        # Both sklearn and XGBoost split on float32 feature values
+        X = np.asarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        n_rows, n_features = X.shape
+        
+        # Flat np.take lookups are much cheaper than 2-D fancy indexing
+        flat_X = np.ascontiguousarray(X).ravel()
+        flat_children = self.children.ravel()
+        row_offset = (np.arange(n_rows, dtype=np.int64) * n_features)[:, None]
+        node = np.tile(self.roots, (n_rows, 1))
+        has_missing = np.isnan(flat_X).any()
+        
+        for _ in range(self.max_depth):
+            x = flat_X.take(self.feature.take(node) + row_offset)
+            threshold = self.threshold.take(node)
+            go_right = x >= threshold if self.strict_less else x > threshold
+            if has_missing:
+                go_right = np.where(np.isnan(x), ~self.default_left.take(node), go_right)
+            node = flat_children.take(node * 2 + go_right)
+        return node
+    
+    def decision_function(self, X):
+        """
+        Aggregate the leaf values of all trees
+        
+        Parameters:
+        X (np.ndarray): Feature matrix
+        
+        Returns:
+        np.ndarray: Mean leaf value (random forests) or margin (XGBoost) per row
+        """
+        leaves = self.value[self.apply(X)]
+        if self.aggregate == 'mean':
+            # Accumulate in float64 also for float32 leaf values (compression.py)
+            return leaves.mean(axis=1, dtype=np.float64)
+        return leaves.sum(axis=1, dtype=np.float64) + self.base_margin
+    
+    def predict_proba(self, X):
+        """
+        Predict class probabilities of a compiled classifier
+        
+        Parameters:
+        X (np.ndarray): Feature matrix
+        
+        Returns:
+        np.ndarray: Probabilities of class 0 and 1, shape (n_rows, 2)
+        """
+        score = self.decision_function(X)
+        prob = score if self.aggregate == 'mean' else 1 / (1 + np.exp(-score))
+        return np.column_stack([1 - prob, prob])
+    
+    def predict(self, X):
+        """
+        Predict classes (classifiers) or values (regressors)
+        
+        Parameters:
+        X (np.ndarray): Feature matrix
+        
+        Returns:
+        np.ndarray: Predictions, one per row
+        """
+        if self.is_classifier:
+            return self.classes_.take((self.predict_proba(X)[:, 1] > 0.5).astype(int))
+        return self.decision_function(X)
+    
+    def to_arrays(self):
+        """
+        Export the ensemble as a dictionary of arrays, see from_arrays
+        
+        Returns:
+        dict: Node arrays and scalar settings
+        """
+        return {
+            'feature': self.feature,
+            'threshold': self.threshold,
+            'children': self.children,
+            'default_left': self.default_left,
+            'value': self.value,
+            'roots': self.roots,
+            'max_depth': np.array(self.max_depth),
+            'strict_less': np.array(self.strict_less),
+            'aggregate': np.array(self.aggregate),
+            'base_margin': np.array(self.base_margin),
+            'is_classifier': np.array(self.is_classifier)
+        }
+    
+    @classmethod
+    def from_arrays(cls, arrays):
+        """
+        Rebuild an ensemble from the arrays of to_arrays
+        
+        Parameters:
+        arrays (Mapping): Arrays by name, e.g. an np.load result
+        
+        Returns:
+        CompiledTreeEnsemble: The ensemble
+        """
+        return cls(arrays['feature'], arrays['threshold'], arrays['children'], arrays['default_left'],
+                   arrays['value'], arrays['roots'], int(arrays['max_depth']), bool(arrays['strict_less']),
+                   str(arrays['aggregate']), float(arrays['base_margin']), bool(arrays['is_classifier']))
+
+def _concatenate_trees(trees):
+    """
+    Stack per-tree node arrays into one ensemble
+    
+    Parameters:
+    trees (list): Per tree, a dict of 'feature', 'threshold', 'left', 'right'
+                  (-1 for leaves), 'default_left', 'value' and 'depth'
+    
+    Returns:
+    dict: Concatenated node arrays, tree roots and maximum depth
+    """
+    sizes = [len(tree['feature']) for tree in trees]
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int32)
+    
+    children = []
+    for tree, offset in zip(trees, offsets):
+        own = np.arange(len(tree['left']), dtype=np.int32)
+        is_leaf = np.asarray(tree['left']) < 0
+        # Leaves point to themselves so extra traversal steps stay put
+        left = np.where(is_leaf, own, tree['left']) + offset
+        right = np.where(is_leaf, own, tree['right']) + offset
+        children.append(np.column_stack([left, right]).astype(np.int32))
+    
+    return {
+        'feature': np.ascontiguousarray(np.concatenate([tree['feature'] for tree in trees]), dtype=np.int32),
+        'threshold': np.concatenate([tree['threshold'] for tree in trees]),
+        'children': np.ascontiguousarray(np.concatenate(children)),
+        'default_left': np.concatenate([tree['default_left'] for tree in trees]).astype(bool),
+        'value': np.concatenate([tree['value'] for tree in trees]),
+        'roots': offsets,
+        'max_depth': max(tree['depth'] for tree in trees)
+    }
+
+def compile_random_forest(model):
+    """
+    Flatten a fitted sklearn random forest (binary classifier or regressor)
+    
+    Parameters:
+    model (RandomForestClassifier or RandomForestRegressor): Fitted forest
+    
+    Returns:
+    CompiledTreeEnsemble: Equivalent compiled ensemble
+    """
+    is_classifier = hasattr(model, 'classes_')
+    trees = []
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        is_leaf = tree.children_left < 0
+        if is_classifier:
+            # Normalize counts/fractions to the probability of the positive class
+            counts = tree.value[:, 0, :]
+            value = counts[:, 1] / counts.sum(axis=1)
+        else:
+            value = tree.value[:, 0, 0]
+        default_left = getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=np.uint8))
+        trees.append({
+            'feature': np.where(is_leaf, 0, tree.feature),
+            'threshold': np.where(is_leaf, np.inf, tree.threshold),
+            'left': tree.children_left,
+            'right': tree.children_right,
+            'default_left': np.asarray(default_left, dtype=bool),
+            'value': value.astype(np.float64),
+            'depth': tree.max_depth
+        })
+    
+    arrays = _concatenate_trees(trees)
+    return CompiledTreeEnsemble(strict_less=False, aggregate='mean', is_classifier=is_classifier, **arrays)
+
+def _tree_depth(left, right):
+    depth = np.zeros(len(left), dtype=np.int32)
+    for node in range(len(left)):
+        for child in (left[node], right[node]):
+            if child >= 0:
+                depth[child] = depth[node] + 1
+    return int(depth.max())
+
+def compile_xgboost(model):
+    """
+    Flatten a fitted XGBoost binary classifier or squared-error regressor
+    
+    Parameters:
+    model (xgb.XGBClassifier or xgb.XGBRegressor): Fitted model
+    
+    Returns:
+    CompiledTreeEnsemble: Equivalent compiled ensemble
+    """
+    import xgboost as xgb
+    
+    booster = model.get_booster()
+    dump = json.loads(booster.save_raw('json'))
+    is_classifier = dump['learner']['objective']['name'] == 'binary:logistic'
+    
+    trees = []
+    for tree in dump['learner']['gradient_booster']['model']['trees']:
+        left = np.asarray(tree['left_children'], dtype=np.int32)
+        right = np.asarray(tree['right_children'], dtype=np.int32)
+        is_leaf = left < 0
+        conditions = np.asarray(tree['split_conditions'], dtype=np.float32)
+        trees.append({
+            'feature': np.where(is_leaf, 0, tree['split_indices']),
+            # For leaves XGBoost stores the leaf value in split_conditions
+            'threshold': np.where(is_leaf, np.float32(np.inf), conditions).astype(np.float32),
+            'left': left,
+            'right': right,
+            'default_left': np.asarray(tree['default_left'], dtype=bool),
+            'value': np.where(is_leaf, conditions, 0).astype(np.float32),
+            'depth': _tree_depth(left, right)
+        })
+    
+    arrays = _concatenate_trees(trees)
+    compiled = CompiledTreeEnsemble(strict_less=True, aggregate='sum', is_classifier=is_classifier, **arrays)
+    
+    # Recover the base margin from one prediction rather than parsing base_score,
+    # whose encoding differs between XGBoost versions
+    probe = np.zeros((1, booster.num_features()), dtype=np.float32)
+    margin = booster.predict(xgb.DMatrix(probe), output_margin=True)[0]
+    compiled.base_margin = float(margin - compiled.value[compiled.apply(probe)].sum(dtype=np.float64))
+    return compiled
+
+def compile_model(model):
+    """
+    Compile a random forest or XGBoost model, if it is one
+    
+    Parameters:
+    model (object): Fitted model
+    
+    Returns:
+    CompiledTreeEnsemble: Compiled model, or None for other model types
+    """
+    name = type(model).__name__
+    if name in ('RandomForestClassifier', 'RandomForestRegressor'):
+        return compile_random_forest(model)
+    if name in ('XGBClassifier', 'XGBRegressor'):
+        return compile_xgboost(model)
+    return None
+
+def save_compiled(compiled, path):
+    """
+    Save a compiled ensemble as an uncompressed .npz file
+    
+    Parameters:
+    compiled (CompiledTreeEnsemble): Ensemble to save
+    path (str): Output path, conventionally ending in COMPILED_SUFFIX
+    """
+    with open(path, "wb") as f:
+        np.savez(f, **compiled.to_arrays())
+
+def load_compiled(path):
+    """
+    Load a compiled ensemble saved with save_compiled
+    
+    Parameters:
+    path (str): Path of the .npz file
+    
+    Returns:
+    CompiledTreeEnsemble: The ensemble
+    """
+    with np.load(path) as arrays:
+        return CompiledTreeEnsemble.from_arrays({name: arrays[name] for name in arrays.files})
+
+def check_compiled_equivalence(model, compiled, X, atol=1e-6, rtol=1e-5):
+    """
+    Compare a compiled ensemble with the model it was compiled from
+    
+    XGBoost accumulates leaf values in float32 while the compiled ensemble sums
+    them in float64, hence the relative tolerance.
+    
+    Parameters:
+    model (object): Original fitted model
+    compiled (CompiledTreeEnsemble): Compiled version of model
+    X (np.ndarray): Scaled feature rows to compare on
+    atol (float): Tolerated absolute difference
+    rtol (float): Tolerated difference relative to the original prediction
+    
+    Returns:
+    float: Largest absolute difference in probabilities or predicted values
+    
+    Raises:
+    AssertionError: If a difference exceeds atol + rtol * |original| or
+                    predicted classes differ
+    """
+    if compiled.is_classifier:
+        expected = model.predict_proba(X)[:, 1]
+        actual = compiled.predict_proba(X)[:, 1]
+        if not np.array_equal(model.predict(X), compiled.predict(X)):
+            raise AssertionError("Compiled ensemble predicts different classes")
+    else:
+        expected = model.predict(X)
+        actual = compiled.predict(X)
+    
+    expected = np.asarray(expected, dtype=np.float64)
+    difference = np.abs(expected - actual)
+    if np.any(difference > atol + rtol * np.abs(expected)):
+        raise AssertionError(f"Compiled ensemble deviates by up to {difference.max():.3g}")
+    return float(difference.max(initial=0.0))
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from generate_data import generate_sample_data
+    from predict import TASKS, load_models, prepare_batch_data
+    
+    parser = argparse.ArgumentParser(description="Check compiled tree ensembles against the original models")
+    parser.add_argument('--model-dir', default='models', help="Directory containing saved models")
+    parser.add_argument('--n-rows', type=int, default=2000, help="Number of synthetic patients to compare on")
+    args = parser.parse_args()
+    
+    original = load_models(args.model_dir)
+    compiled = load_models(args.model_dir, compiled=True)
+    data = generate_sample_data(args.n_rows, seed=1)
+    X = original['scaler'].transform(prepare_batch_data(data, original['feature_names']))
+    
+    for task in TASKS:
+        for model_name, model in compiled.get(task, {}).items():
+            # Models without a compiled export are loaded unchanged
+            if type(model) is type(original[task][model_name]):
+                continue
+            deviation = check_compiled_equivalence(original[task][model_name], model, X)
+            
+            start = time.perf_counter()
+            for _ in range(200):
+                model.predict(X[:1])
+            latency_us = (time.perf_counter() - start) / 200 * 1e6
+            print(f"{task}/{model_name}: max deviation {deviation:.3g}, single-row latency {latency_us:.0f} us")
@@ -0,0 +1,380 @@
+import json
+import os
+import math
+import time
+import argparse
+import numpy as np
+from joblib import Parallel, delayed
+from sklearn.model_selection import train_test_split
+from generate_data import generate_sample_data
+from train_models import MODEL_SPECS, evaluate_model, prepare_training_data, resolve_n_jobs
+
+BEST_HYPERPARAMS_FILE = 'best_hyperparameters.json'
+TUNING_TRACE_FILE = 'tuning_trace.json'
+
+# Metric maximized on the validation split for each task
+TUNING_METRICS = {
+    'mortality_classification': 'auroc',
+    'mortality_rate_regression': 'r2',
+    'length_of_stay_regression': 'r2'
+}
+
+# Search space per model name. Every entry is (kind, ...):
+# ('int', low, high), ('log_int', low, high), ('float', low, high),
+# ('log', low, high) or ('choice', options). Models without an entry
+# (linear regression) have nothing to tune and keep their MODEL_SPECS params.
+SEARCH_SPACES = {
+    'random_forest': {
+        'n_estimators': ('int', 50, 400),
+        'max_depth': ('choice', [None, 8, 16, 32]),
+        'min_samples_leaf': ('log_int', 1, 20),
+        'max_features': ('choice', ['sqrt', 0.5, 1.0])
+    },
+    'knn': {
+        'n_neighbors': ('log_int', 3, 50),
+        'weights': ('choice', ['uniform', 'distance'])
+    },
+    'xgboost': {
+        'learning_rate': ('log', 0.01, 0.3),
+        'max_depth': ('int', 3, 10),
+        'min_child_weight': ('log', 1.0, 20.0),
+        'subsample': ('float', 0.5, 1.0),
+        'colsample_bytree': ('float', 0.5, 1.0),
+        'reg_lambda': ('log', 0.1, 10.0)
+    },
+    'logistic_regression': {
+        'C': ('log', 1e-3, 100.0)
+    }
+}
+
+# XGBoost trains up to XGB_MAX_ROUNDS rounds and stops once the validation
+# metric has not improved for XGB_EARLY_STOPPING_ROUNDS rounds; the best round
+# count becomes the tuned n_estimators
+XGB_MAX_ROUNDS = 1000
+XGB_EARLY_STOPPING_ROUNDS = 20
+
+# Fraction of the training set held out to score configurations. The test set
+# of prepare_training_data is never used for tuning.
+VALIDATION_SIZE = 0.2
+
+# Successive halving keeps the best 1/ETA of the configurations at every rung
+# and gives the survivors ETA times more training rows
+ETA = 3
+MIN_FRACTION = 1 / 27
+MIN_ROWS = 100
+
+def sample_config(space, rng):
+    """
+    Draw a random configuration from a search space
+    
+    Parameters:
+    space (dict): Search space, see SEARCH_SPACES
+    rng (np.random.Generator): Random generator
+    
+    Returns:
+    dict: Hyperparameters with plain Python values
+    """
+    config = {}
+    for name, (kind, *args) in space.items():
+        if kind == 'int':
+            config[name] = int(rng.integers(args[0], args[1] + 1))
+        elif kind == 'log_int':
+            config[name] = int(round(math.exp(rng.uniform(math.log(args[0]), math.log(args[1])))))
+        elif kind == 'float':
+            config[name] = float(rng.uniform(args[0], args[1]))
+        elif kind == 'log':
+            config[name] = float(math.exp(rng.uniform(math.log(args[0]), math.log(args[1]))))
+        elif kind == 'choice':
+            config[name] = args[0][int(rng.integers(len(args[0])))]
+        else:
+            raise ValueError(f"Unknown search space kind: {kind}")
+    return config
+
+def subsample_rows(y, n_rows, classification, seed):
+    """
+    Choose the training rows of a successive-halving rung
+    
+    Parameters:
+    y (pd.Series): Training targets
+    n_rows (int): Number of rows to keep
+    classification (bool): Stratify the sample by class
+    seed (int): Random seed
+    
+    Returns:
+    np.ndarray: Row positions
+    """
+    positions = np.arange(len(y))
+    if n_rows >= len(y):
+        return positions
+    sample, _ = train_test_split(positions, train_size=n_rows, random_state=seed,
+                                 stratify=y.to_numpy() if classification else None)
+    return np.sort(sample)
+
+def evaluate_config(spec, config, X_fit, y_fit, X_val, y_val, rows):
+    """
+    Fit one configuration on a subset of the training rows and score it
+    
+    Parameters:
+    spec (dict): Entry of MODEL_SPECS
+    config (dict): Hyperparameters overriding spec['params']
+    X_fit (np.ndarray): Scaled training features
+    y_fit (pd.Series): Training targets
+    X_val (np.ndarray): Scaled validation features
+    y_val (pd.Series): Validation targets
+    rows (np.ndarray): Training rows used at this rung
+    
+    Returns:
+    dict: Validation 'score' and 'metrics', 'fit_seconds', and for XGBoost the
+          early-stopped round count under 'n_estimators'
+    """
+    params = dict(spec['params'])
+    params.update(config)
+    # The process pool already runs one fit per core
+    if spec.get('threads_param'):
+        params[spec['threads_param']] = 1
+    
+    start = time.perf_counter()
+    try:
+        if spec['name'] == 'xgboost':
+            params.update(n_estimators=XGB_MAX_ROUNDS, early_stopping_rounds=XGB_EARLY_STOPPING_ROUNDS)
+            model = spec['estimator'](**params)
+            model.fit(X_fit[rows], y_fit.iloc[rows], eval_set=[(X_val, y_val)], verbose=False)
+        else:
+            model = spec['estimator'](**params)
+            model.fit(X_fit[rows], y_fit.iloc[rows])
+        metrics = evaluate_model(spec['task'], model, X_val, y_val)
+    except ValueError as e:
+        # e.g. more neighbors than rows at the smallest rung
+        return {'score': None, 'error': str(e), 'fit_seconds': time.perf_counter() - start}
+    
+    result = {
+        'score': float(metrics[TUNING_METRICS[spec['task']]]),
+        'metrics': {k: float(v) for k, v in metrics.items()},
+        'fit_seconds': time.perf_counter() - start
+    }
+    if spec['name'] == 'xgboost':
+        result['n_estimators'] = int(model.best_iteration) + 1
+    return result
+
+def successive_halving(spec, configs, X_fit, y_fit, X_val, y_val, min_fraction, eta, deadline, n_workers,
+                       trace, bracket=0, seed=0):
+    """
+    Run one successive-halving bracket over a set of configurations
+    
+    All configurations are scored on min_fraction of the training rows; the
+    best 1/eta move on to eta times as many rows, until the survivors are
+    trained on all of them. Each rung is evaluated in parallel, and no new rung
+    starts after the deadline.
+    
+    Parameters:
+    spec (dict): Entry of MODEL_SPECS
+    configs (list): Candidate hyperparameter dictionaries
+    X_fit (np.ndarray): Scaled training features
+    y_fit (pd.Series): Training targets
+    X_val (np.ndarray): Scaled validation features
+    y_val (pd.Series): Validation targets
+    min_fraction (float): Fraction of the training rows used at the first rung
+    eta (int): Reduction factor between rungs
+    deadline (float): time.perf_counter() value after which the search stops
+    n_workers (int): Concurrent fits
+    trace (list): Every evaluation is appended here
+    bracket (int): Bracket number, recorded in the trace
+    seed (int): Random seed for the row subsamples
+    
+    Returns:
+    list: (config, result, n_rows) of the configurations of the last completed rung
+    """
+    classification = spec['task'] == 'mortality_classification'
+    candidates = list(enumerate(configs))
+    fraction = min_fraction
+    survivors = []
+    rung = 0
+    
+    while candidates and time.perf_counter() < deadline:
+        n_rows = min(len(y_fit), max(MIN_ROWS, int(round(fraction * len(y_fit)))))
+        rows = subsample_rows(y_fit, n_rows, classification, seed + rung)
+        
+        results = Parallel(n_jobs=n_workers)(
+            delayed(evaluate_config)(spec, config, X_fit, y_fit, X_val, y_val, rows)
+            for _, config in candidates
+        )
+        
+        survivors = []
+        for (config_id, config), result in zip(candidates, results):
+            trace.append({'task': spec['task'], 'model': spec['name'], 'bracket': bracket, 'rung': rung,
+                          'config_id': config_id, 'n_rows': n_rows, 'params': config, **result})
+            if result['score'] is not None:
+                survivors.append((config_id, config, result, n_rows))
+        
+        if n_rows >= len(y_fit):
+            break
+        survivors.sort(key=lambda entry: entry[2]['score'], reverse=True)
+        candidates = [(config_id, config) for config_id, config, _, _ in survivors[:max(1, len(survivors) // eta)]]
+        fraction *= eta
+        rung += 1
+    
+    return [(config, result, n_rows) for _, config, result, n_rows in survivors]
+
+def hyperband(spec, X_fit, y_fit, X_val, y_val, deadline, n_workers, trace, eta=ETA, min_fraction=MIN_FRACTION,
+              seed=0):
+    """
+    Tune one model with Hyperband
+    
+    Hyperband runs successive-halving brackets from the most aggressive (many
+    configurations started on min_fraction of the rows) to plain random search
+    (few configurations on all rows), hedging against the early rungs ranking
+    configurations badly.
+    
+    Parameters:
+    spec (dict): Entry of MODEL_SPECS
+    X_fit (np.ndarray): Scaled training features
+    y_fit (pd.Series): Training targets
+    X_val (np.ndarray): Scaled validation features
+    y_val (pd.Series): Validation targets
+    deadline (float): time.perf_counter() value after which the search stops
+    n_workers (int): Concurrent fits
+    trace (list): Every evaluation is appended here
+    eta (int): Reduction factor between rungs
+    min_fraction (float): Smallest fraction of the training rows a configuration is trained on
+    seed (int): Random seed
+    
+    Returns:
+    tuple: (best hyperparameters, their result), or (None, None) if nothing finished
+    """
+    rng = np.random.default_rng(seed)
+    s_max = int(math.floor(math.log(1 / min_fraction, eta) + 1e-9))
+    
+    best_config, best_result, best_rows = None, None, 0
+    for bracket, s in enumerate(range(s_max, -1, -1)):
+        if time.perf_counter() >= deadline:
+            break
+        n_configs = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        configs = [sample_config(SEARCH_SPACES[spec['name']], rng) for _ in range(n_configs)]
+        finished = successive_halving(spec, configs, X_fit, y_fit, X_val, y_val, eta ** -s, eta, deadline,
+                                      n_workers, trace, bracket=bracket, seed=seed)
+        
+        # Prefer configurations trained on more rows, then the better score
+        for config, result, n_rows in finished:
+            if (n_rows, result['score']) > (best_rows, best_result['score'] if best_result else -np.inf):
+                best_config, best_result, best_rows = config, result, n_rows
+    
+    if best_config is None:
+        return None, None
+    
+    best_config = dict(best_config)
+    if 'n_estimators' in best_result:
+        best_config['n_estimators'] = best_result['n_estimators']
+    return best_config, best_result
+
+def tune_models(prepared, budget_seconds=600, n_jobs=-1, eta=ETA, min_fraction=MIN_FRACTION, seed=0):
+    """
+    Tune the hyperparameters of every model in MODEL_SPECS
+    
+    The wall-clock budget is shared by the models: each gets an equal part of
+    what is left when its search starts, so time a model does not use carries
+    over to the next ones.
+    
+    Parameters:
+    prepared (dict): Output of prepare_training_data
+    budget_seconds (float): Wall-clock budget of the whole search
+    n_jobs (int): Core budget, -1 uses all cores
+    eta (int): Successive-halving reduction factor
+    min_fraction (float): Smallest fraction of the training rows a configuration is trained on
+    seed (int): Random seed
+    
+    Returns:
+    tuple: (best hyperparameters {task: {model: params}}, search trace dictionary)
+    """
+    n_workers = resolve_n_jobs(n_jobs)
+    start = time.perf_counter()
+    end = start + budget_seconds
+    
+    best = {}
+    summary = {}
+    trace = []
+    tunable = [spec for spec in MODEL_SPECS if spec['name'] in SEARCH_SPACES]
+    for i, spec in enumerate(tunable):
+        X_fit, X_val, y_fit, y_val = train_test_split(
+            prepared['X_train'], prepared['y_train'][spec['task']], test_size=VALIDATION_SIZE, random_state=seed,
+            stratify=prepared['y_train'][spec['task']] if spec['task'] == 'mortality_classification' else None)
+        
+        deadline = time.perf_counter() + (end - time.perf_counter()) / (len(tunable) - i)
+        config, result = hyperband(spec, X_fit, y_fit, X_val, y_val, deadline, n_workers, trace, eta=eta,
+                                   min_fraction=min_fraction, seed=seed)
+        if config is None:
+            print(f"No configuration of {spec['task']}/{spec['name']} finished within the budget")
+            continue
+        
+        best.setdefault(spec['task'], {})[spec['name']] = config
+        summary.setdefault(spec['task'], {})[spec['name']] = {
+            'metric': TUNING_METRICS[spec['task']], 'score': result['score'], 'params': config,
+            'evaluations': sum(1 for entry in trace if entry['task'] == spec['task'] and entry['model'] == spec['name'])
+        }
+        print(f"{spec['task']}/{spec['name']}: {TUNING_METRICS[spec['task']]}={result['score']:.4f} with {config}")
+    
+    search = {
+        'budget_seconds': budget_seconds,
+        'elapsed_seconds': time.perf_counter() - start,
+        'eta': eta,
+        'min_fraction': min_fraction,
+        'n_workers': n_workers,
+        'validation_size': VALIDATION_SIZE,
+        'best': summary,
+        'evaluations': trace
+    }
+    return best, search
+
+def save_tuning_results(best, search, output_dir='models'):
+    """
+    Write the best hyperparameters and the search trace next to performance_metrics.json
+    
+    Parameters:
+    best (dict): Best hyperparameters {task: {model: params}}
+    search (dict): Search trace from tune_models
+    output_dir (str): Directory to save them in
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, BEST_HYPERPARAMS_FILE), "w") as f:
+        json.dump(best, f, indent=2)
+    with open(os.path.join(output_dir, TUNING_TRACE_FILE), "w") as f:
+        json.dump(search, f, indent=2)
+    
+    print(f"Best hyperparameters saved to {output_dir}/{BEST_HYPERPARAMS_FILE}")
+
+def load_hyperparams(path):
+    """
+    Load hyperparameters written by save_tuning_results
+    
+    Parameters:
+    path (str): Path of the JSON file, or the directory containing it
+    
+    Returns:
+    dict: Hyperparameters {task: {model: params}}, for train_models(hyperparams=...)
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, BEST_HYPERPARAMS_FILE)
+    with open(path, "r") as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tune model hyperparameters with Hyperband")
+    parser.add_argument('--data', default=None, help="Patient CSV file, generates synthetic data if omitted")
+    parser.add_argument('--n-samples', type=int, default=5000, help="Number of samples to generate without --data")
+    parser.add_argument('--budget', type=float, default=600, help="Wall-clock budget in seconds")
+    parser.add_argument('--n-jobs', type=int, default=-1, help="Core budget, -1 uses all cores")
+    parser.add_argument('--eta', type=int, default=ETA, help="Successive-halving reduction factor")
+    parser.add_argument('--min-fraction', type=float, default=MIN_FRACTION,
+                        help="Smallest fraction of the training rows a configuration is trained on")
+    parser.add_argument('--output-dir', default='models', help="Directory for the results")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+    
+    if args.data:
+        from feature_cache import prepare_training_file
+        prepared = prepare_training_file(args.data)
+    else:
+        prepared = prepare_training_data(generate_sample_data(args.n_samples))
+    
+    best, search = tune_models(prepared, budget_seconds=args.budget, n_jobs=args.n_jobs, eta=args.eta,
+                               min_fraction=args.min_fraction, seed=args.seed)
+    save_tuning_results(best, search, args.output_dir)